@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+遅延時間などの統計
+
+直近N個の値を保持し、件数、平均、パーセンタイル、最大値を求める。
+
+Usage:
+--
+from LatencyStat import LatencyStat
+
+st = LatencyStat('cmd')
+st.add(0.012)         # [sec]
+print(st.summary())   # [msec]
+--
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import collections
+import threading
+
+
+class LatencyStat:
+    DEF_SIZE = 1000
+
+    def __init__(self, name='', size=DEF_SIZE):
+        self.name = name
+        self._val = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, sec):
+        with self._lock:
+            self._val.append(sec)
+            self.count += 1
+            if sec > self.max:
+                self.max = sec
+
+    def clear(self):
+        with self._lock:
+            self._val.clear()
+            self.count = 0
+            self.max = 0.0
+
+    @staticmethod
+    def percentile(sorted_val, p):
+        """
+        sorted_val: ソート済みのリスト
+        p: 0 .. 100
+        """
+        if len(sorted_val) == 0:
+            return 0.0
+        idx = int(round((len(sorted_val) - 1) * p / 100))
+        return sorted_val[idx]
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary: dict
+            時間の単位は msec
+        """
+        with self._lock:
+            val = sorted(self._val)
+            count = self.count
+            max_val = self.max
+
+        if len(val) == 0:
+            return {'n': count, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0,
+                    'p99': 0.0, 'max': 0.0}
+
+        return {
+            'n': count,
+            'mean': round(sum(val) / len(val) * 1000, 2),
+            'p50': round(self.percentile(val, 50) * 1000, 2),
+            'p95': round(self.percentile(val, 95) * 1000, 2),
+            'p99': round(self.percentile(val, 99) * 1000, 2),
+            'max': round(max_val * 1000, 2),
+        }
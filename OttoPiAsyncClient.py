@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+ロボット制御クライアント (asyncio版)
+
+OttoPiClient と同じプロトコル(OttoPiProto の framed または binary)で、
+イベントループを止めずに OttoPiServer にコマンドを送る。
+
+ * 接続・送信・受信は、すべてノンブロッキング
+ * 受信は 1つのタスクで行い、返信をリクエストの id で待っている
+   Future に渡す。1つの接続で、複数のリクエストを同時に待てる
+ * 待っているコルーチンがキャンセル(またはタイムアウト)されたら、
+   そのリクエストの返信は、届いても捨てる (接続はそのまま使える)
+ * リクエストの作成と受信データの解釈は、OttoPiClient と共通
+   (OttoPiProto.ClientSession)
+
+Usage:
+--
+async with AsyncOttoPiClient('localhost', 12345, name='ws') as cl:
+    rets = await asyncio.gather(cl.send_cmd(':.happy'),
+                                cl.send_cmd(':auto_on'))
+--
+
+-----------------------------------------------------------------
+AsyncOttoPiClient -- ロボット制御クライアント (asyncio)
+ |
+ +- OttoPiProto -- プロトコル
+ |
+ |(TCP/IP, Unix domain socket)
+ |
+OttoPiServer -- ロボット制御サーバ
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiClient import OttoPiClient
+from OttoPiServer import OttoPiServer, OttoPiDispatcher, unix_path
+from OttoPiProto import ProtoError, ClientSession, Subscription
+from OttoPiProto import CMD_SUBSCRIBE
+import asyncio
+import socket
+import time
+import os
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class AsyncOttoPiClient:
+    DEF_HOST = OttoPiClient.DEF_HOST
+    DEF_PORT = OttoPiClient.DEF_PORT
+    LOCAL_HOST = OttoPiClient.LOCAL_HOST
+
+    DEF_TIMEOUT = OttoPiClient.DEF_TIMEOUT  # sec
+    RECV_SIZE = OttoPiClient.RECV_SIZE
+
+    # テレメトリーをためておく上限 (古いものから捨てる)
+    TLM_MAX = 100
+
+    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, binary=False,
+                 unix=True, name=None, timeout=DEF_TIMEOUT, debug=False):
+        """
+        Parameters
+        ----------
+        binary, unix, name, timeout:
+            OttoPiClient と同じ。接続は、最初のコマンドの時に行う
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('svr_host=%s, svr_port=%d, binary=%s, unix=%s',
+                        svr_host, svr_port, binary, unix)
+        self._log.debug('name=%s, timeout=%s', name, timeout)
+
+        self.svr_host = svr_host
+        self.svr_port = svr_port
+        self.binary = binary
+        self.unix = unix
+        self.name = name
+        self.timeout = timeout
+        self.transport = None
+
+        self._reader = None
+        self._writer = None
+        self._recv_task = None
+        self._proto = None
+        self._pending = {}  # {req_id: Future}
+        self._tlm = []
+        self._tlm_event = asyncio.Event()
+        self._open_lock = asyncio.Lock()
+
+        self.stat = {'request': 0, 'timeout': 0, 'cancelled': 0,
+                     'late': 0, 'reconnect': 0}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def is_open(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        path = unix_path(self.svr_port)
+        if (self.unix and self.svr_host in self.LOCAL_HOST and
+                os.path.exists(path)):
+            try:
+                conn = await asyncio.wait_for(
+                    asyncio.open_unix_connection(path), self.timeout)
+            except OSError as e:
+                self._log.debug('%s:%s .. use TCP', type(e).__name__, e)
+            else:
+                self.transport = 'unix'
+                return conn
+
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(self.svr_host, self.svr_port),
+            self.timeout)
+        sock = conn[1].get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self.transport = 'tcp'
+        return conn
+
+    async def open(self):
+        """
+        接続して、受信タスクを起動する (接続済みなら何もしない)
+        """
+        async with self._open_lock:
+            if self.is_open():
+                return
+
+            self._log.debug('svr_host=%s, svr_port=%d',
+                            self.svr_host, self.svr_port)
+            if self._proto is not None:
+                self.stat['reconnect'] += 1
+
+            (self._reader, self._writer) = await self.connect()
+            self._proto = ClientSession(self.binary,
+                                        OttoPiDispatcher.CMD_KEY,
+                                        debug=self._dbg)
+            self._recv_task = asyncio.create_task(self.recv_loop())
+
+    async def close(self):
+        self._log.debug('')
+        if self._recv_task is not None:
+            self._recv_task.cancel()
+            try:
+                await self._recv_task
+            except asyncio.CancelledError:
+                pass
+            self._recv_task = None
+
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError as e:
+                self._log.debug('%s:%s', type(e).__name__, e)
+            self._writer = None
+
+        self.fail_all(ConnectionError('closed'))
+
+    def fail_all(self, e):
+        """
+        待っているリクエストを、すべてエラーにする
+        """
+        (pending, self._pending) = (self._pending, {})
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(e)
+        self._tlm_event.set()
+
+    async def recv_loop(self):
+        """
+        受信タスク: 返信を id ごとの Future に渡し、テレメトリーをためる
+        """
+        try:
+            while True:
+                in_data = await self._reader.read(self.RECV_SIZE)
+                if len(in_data) == 0:
+                    raise ConnectionError('disconnected')
+
+                (reps, frames) = self._proto.feed(in_data)
+                for rep in reps:
+                    fut = self._pending.pop(rep['id'], None)
+                    if fut is None or fut.done():
+                        # キャンセル・タイムアウトしたリクエストの返信
+                        self._log.debug('late reply: %s', rep)
+                        self.stat['late'] += 1
+                        continue
+                    fut.set_result(rep)
+
+                if len(frames) > 0:
+                    self._tlm = (self._tlm + frames)[-self.TLM_MAX:]
+                    self._tlm_event.set()
+
+        except (OSError, ProtoError) as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self._writer.close()
+            self.fail_all(e)
+
+    async def request(self, cmd, name=None):
+        """
+        コマンドを送り、返信を待つ (他のリクエストと同時に待てる)
+
+        Parameters
+        ----------
+        name: str
+            クライアント名 (None なら self.name)。
+            名前の切り替えとコマンドは続けて送るので、
+            別の名前のリクエストが同時にあっても混ざらない
+
+        Returns
+        -------
+        replies: list of dict
+            リクエストごとの返信 (順番どおり)
+            cmd が空なら [] (送らない)
+        """
+        self._log.debug('cmd=%s, name=%s', cmd, name)
+
+        if len(cmd) == 0:
+            return []
+
+        self.stat['request'] += 1
+
+        if not self.is_open():
+            await self.open()
+
+        # ここから write() まで await しないので、他のリクエストと混ざらない
+        (ids0, data0) = self._proto.name_requests(name or self.name)
+        (ids, data) = self._proto.requests(cmd)
+
+        loop = asyncio.get_running_loop()
+        futs = []
+        for req_id in ids0 + ids:
+            futs.append(loop.create_future())
+            self._pending[req_id] = futs[-1]
+
+        try:
+            self._writer.write(data0 + data)
+            await self._writer.drain()
+            (done, pending) = await asyncio.wait(futs, timeout=self.timeout)
+        except asyncio.CancelledError:
+            self.stat['cancelled'] += 1
+            raise
+        finally:
+            for req_id in ids0 + ids:
+                self._pending.pop(req_id, None)
+
+            # 接続が切れた場合など: 送信のエラーで抜けた場合も、
+            # Future のエラーを取り出しておく (取り出さないと警告になる)
+            errs = [fut.exception() for fut in futs
+                    if fut.done() and not fut.cancelled()]
+
+        if len(pending) > 0:
+            self.stat['timeout'] += 1
+            raise TimeoutError('no reply')
+
+        for e in errs:
+            if e is not None:
+                raise e
+        return [fut.result() for fut in futs][len(ids0):]
+
+    async def send_cmd(self, cmd, name=None):
+        """
+        Returns
+        -------
+        ret: dict
+            最後の返信 {'CMD':.., 'ACCEPT':.., 'MSG':..}
+            (エラーの場合も ACCEPT=False で返す。キャンセルは除く)
+        """
+        try:
+            replies = await self.request(cmd, name)
+        except ProtoError as e:
+            self._log.warning('%s', e)
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': str(e)}
+        except OSError as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            return {'CMD': cmd, 'ACCEPT': False,
+                    'MSG': '%s:%s' % (type(e).__name__, e)}
+
+        if len(replies) == 0:
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': 'empty command'}
+
+        ret = self._proto.result(cmd, replies[-1])
+        self._log.debug('ret=%s', ret)
+        return ret
+
+    async def subscribe(self, period_ms=Subscription.DEF_PERIOD_MS,
+                        fields=None):
+        """
+        テレメトリーを購読する (OttoPiClient.subscribe() と同じ)
+        """
+        self._log.debug('period_ms=%s, fields=%s', period_ms, fields)
+
+        cmd = '%s%s %d' % (OttoPiServer.CMD_PREFIX, CMD_SUBSCRIBE, period_ms)
+        if fields is not None and not self.binary:
+            cmd += ' ' + ','.join(fields)
+
+        ret = await self.send_cmd(cmd)
+        if not ret['ACCEPT']:
+            raise ProtoError('%s: %s' % (ret['CMD'], ret['MSG']))
+        return ret
+
+    async def recv_tlm(self, timeout=0):
+        """
+        受信済みのテレメトリーを読む (OttoPiClient.recv_tlm() と同じ)
+        """
+        if len(self._tlm) == 0 and timeout > 0:
+            self._tlm_event.clear()
+            try:
+                await asyncio.wait_for(self._tlm_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        if len(self._tlm) == 0 and not self.is_open():
+            raise ConnectionError('not connected')
+
+        (frames, self._tlm) = (self._tlm, [])
+        return frames
+
+
+class AsyncOttoPiClientApp:
+    def __init__(self, command, svr_host, svr_port, binary, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('command=%s', command)
+        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
+
+        self.cl = AsyncOttoPiClient(svr_host, svr_port, binary=binary,
+                                    debug=self._dbg)
+        self.command = command
+
+    async def run(self):
+        # すべてのコマンドを同時に送り、返信を順番に表示
+        t0 = time.perf_counter()
+        rets = await asyncio.gather(*[self.cl.send_cmd(cmd1)
+                                      for cmd1 in self.command])
+        msec = (time.perf_counter() - t0) * 1000
+
+        for ret in rets:
+            print(ret)
+        self._log.info('%d commands: %.2f ms', len(rets), msec)
+
+        await self.cl.close()
+
+    def main(self):
+        self._log.debug('command:\'%s\'', self.command)
+        asyncio.run(self.run())
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+OttoPiClient (asyncio): send commands concurrently
+''')
+@click.argument('command', type=str, nargs=-1)
+@click.option('--svr_host', '-s', 'svr_host', type=str,
+              default=AsyncOttoPiClient.DEF_HOST,
+              help='server hostname or IP address')
+@click.option('--svr_port', '-p', 'svr_port', type=int,
+              default=AsyncOttoPiClient.DEF_PORT,
+              help='server port number')
+@click.option('--binary', '-b', 'binary', is_flag=True, default=False,
+              help='binary encoding')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(command, svr_host, svr_port, binary, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('command=%s, svr_host=%s, svr_port=%d, binary=%s',
+               command, svr_host, svr_port, binary)
+
+    app = AsyncOttoPiClientApp(command, svr_host, svr_port, binary,
+                               debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+ロボット制御サーバ (asyncio版)
+
+OttoPiServer と同じプロトコル(OttoPiProto: 短縮文字、":cmd", ":.cmd"、binary、
+改行区切りの JSON)を、1つのイベントループで処理する。
+
+ * 接続ごとにスレッドを作らず、コルーチン(タスク)で処理する
+ * 同時接続数の上限 (max_clients) を超えた接続は、"#Busy" を返して閉じる
+ * コマンドの解釈と実行は OttoPiServer と共通 (OttoPiDispatcher)
+   OttoPiCtrl, OttoPiAuto のロックなどでループを止めないように、
+   少数のワーカースレッド(run_in_executor)で実行する
+ * ":server_stat" で、接続数とスレッド数を返す
+ * ":subscribe" の接続には、イベントループからテレメトリーを送る
+ * OttoPiServer と同じく、Unix ドメインソケット(unix_path(port))でも待ち受ける
+ * --sim で、サーボと距離センサーをシミュレーションする (OttoPiSim)
+
+-----------------------------------------------------------------
+OttoPiAsyncServer -- ロボット制御サーバ (asyncio)
+ |
+ +- OttoPiProto -- プロトコル
+ +- OttoPiDispatcher -- コマンドの解釈と実行 (ワーカースレッド)
+     |
+     +- OttoPiAuto -- ロボットの自動運転 (自動運転スレッド)
+     |   |
+     +---+- OttoPiCtrl -- コマンド制御 (動作実行スレッド)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiServer import OttoPiServer, OttoPiDispatcher, unix_path
+from OttoPiServer import remove_stale_unix
+from OttoPiLease import OttoPiLease
+from OttoPiState import state_name
+from OttoPiProto import ProtoSession, READY
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import socket
+import time
+import os
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class OttoPiAsyncServer:
+    DEF_PORT = OttoPiServer.DEF_PORT
+    DEF_MAX_CLIENTS = 16
+    DEF_WORKERS = 2
+
+    RECV_SIZE = 512
+
+    # 購読: 送信バッファがこれを超えていたら、フレームを捨てる
+    TLM_HIGH_WATER = 4096
+
+    def __init__(self, pi=None, port=DEF_PORT, max_clients=DEF_MAX_CLIENTS,
+                 workers=DEF_WORKERS, unix=True,
+                 lease_sec=OttoPiLease.DEF_LEASE_SEC,
+                 lease_mode=OttoPiLease.DEF_MODE, sim=False, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('pi=%s, port=%s, max_clients=%s, workers=%s, unix=%s',
+                        pi, port, max_clients, workers, unix)
+        self._log.debug('lease_sec=%s, lease_mode=%s, sim=%s',
+                        lease_sec, lease_mode, sim)
+
+        self._port = port
+        self._unix_path = unix_path(port) if unix else None
+        self.max_clients = max_clients
+
+        # 同じポートのサーバーが動いている場合は、ここで失敗する
+        # (状態共有メモリや Unix ドメインソケットに触る前に)
+        self._sock = socket.create_server(('', port))
+
+        try:
+            self._disp = OttoPiDispatcher(pi, lease_sec, lease_mode, sim,
+                                          state_name=state_name(port),
+                                          debug=self._dbg)
+        except BaseException:
+            self._sock.close()
+            raise
+        self._disp.stat_func = self.get_stat
+
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='dispatch')
+
+        self._conn = set()
+        self.conn_total = 0
+        self.conn_rejected = 0
+
+        self._server = None
+
+    def get_stat(self):
+        """
+        接続数とスレッド数
+        """
+        return {'server': 'asyncio',
+                'clients': len(self._conn),
+                'max_clients': self.max_clients,
+                'accepted': self.conn_total,
+                'rejected': self.conn_rejected,
+                'threads': threading.active_count()}
+
+    async def feed(self, session, net_data):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          session.feed, net_data)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self._log.debug('peer=%s', peer)
+
+        if len(self._conn) >= self.max_clients:
+            self.conn_rejected += 1
+            self._log.warning('%s: too many clients (%d)',
+                              peer, len(self._conn))
+            writer.write(b'#Busy\r\n')
+            writer.close()
+            return
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            # 短いコマンドと返信なので、Nagle を止める
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+        self._conn.add(writer)
+        self.conn_total += 1
+        try:
+            await self.session(reader, writer, peer)
+        finally:
+            self._conn.discard(writer)
+            writer.close()
+            self._log.debug('%s: done', peer)
+
+    def push(self, session, writer):
+        """
+        購読中のフレームを送る (drain しないで、詰まっていたら捨てる)
+
+        Returns
+        -------
+        ok: bool
+            False なら、接続が閉じている
+        """
+        if writer.is_closing():
+            return False
+
+        writable = (writer.transport.get_write_buffer_size() <
+                    self.TLM_HIGH_WATER)
+        out = session.tick(time.monotonic(), writable)
+        if len(out) > 0:
+            writer.write(out)
+        return True
+
+    async def session(self, reader, writer, peer):
+        writer.write(READY)
+
+        client = peer[0] if isinstance(peer, tuple) else 'unix'
+        session = ProtoSession(self._disp, client, debug=self._dbg)
+        while True:
+            # データー受信 (購読中は、次のフレームの時刻まで)
+            t_next = session.next_tick()
+            try:
+                if t_next is None:
+                    net_data = await reader.read(self.RECV_SIZE)
+                else:
+                    timeout = max(t_next - time.monotonic(), 0)
+                    net_data = await asyncio.wait_for(
+                        reader.read(self.RECV_SIZE), timeout)
+            except asyncio.TimeoutError:
+                if not self.push(session, writer):
+                    return
+                continue
+            except ConnectionResetError as e:
+                self._log.warning('%s:%s.', type(e), e)
+                return
+            except asyncio.CancelledError:
+                self._log.warning('cancelled .. stop')
+                self._disp.stop()
+                raise
+
+            (out, done) = await self.feed(session, net_data)
+            writer.write(out)
+            if done:
+                return
+
+            # 受信が続いていても、時刻が来ていればフレームを送る
+            t_next = session.next_tick()
+            if t_next is not None and t_next <= time.monotonic():
+                if not self.push(session, writer):
+                    return
+
+            try:
+                await writer.drain()
+            except ConnectionError as e:
+                self._log.debug('%s:%s', type(e).__name__, e)
+                return
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self.handle,
+                                                  sock=self._sock)
+        self._log.info('port=%s, max_clients=%s',
+                       self._port, self.max_clients)
+
+        unix_server = None
+        if self._unix_path is not None:
+            try:
+                # 前回の異常終了などで残っている場合は、削除する
+                if remove_stale_unix(self._unix_path):
+                    self._log.warning('%s: stale .. removed',
+                                      self._unix_path)
+                unix_server = await asyncio.start_unix_server(
+                    self.handle, self._unix_path)
+            except OSError as e:
+                self._log.warning('%s:%s', type(e).__name__, e)
+            else:
+                self._log.info('unix_path=%s', self._unix_path)
+
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            if unix_server is not None:
+                unix_server.close()
+                try:
+                    os.unlink(self._unix_path)
+                except FileNotFoundError:
+                    pass
+
+    def serve_forever(self):
+        self._log.debug('')
+        asyncio.run(self.serve())
+
+    def end(self):
+        self._log.debug('')
+        self._executor.shutdown(wait=True)
+        self._disp.end()
+        self._sock.close()
+        self._log.debug('done')
+
+
+class OttoPiAsyncServerApp:
+    def __init__(self, port, max_clients, workers, unix, lease_sec,
+                 lease_mode, sim, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('port=%d, max_clients=%d, workers=%d, unix=%s',
+                        port, max_clients, workers, unix)
+
+        self._svr = OttoPiAsyncServer(None, port, max_clients, workers, unix,
+                                      lease_sec, lease_mode, sim,
+                                      debug=self._dbg)
+
+    def main(self):
+        self._log.debug('start server')
+        self._svr.serve_forever()
+
+    def end(self):
+        self._log.debug('')
+        self._svr.end()
+        self._log.debug('done')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+OttoPi server (asyncio)
+''')
+@click.argument('port', type=int, default=OttoPiAsyncServer.DEF_PORT)
+@click.option('--max_clients', '-m', 'max_clients', type=int,
+              default=OttoPiAsyncServer.DEF_MAX_CLIENTS,
+              help='max number of clients')
+@click.option('--workers', '-w', 'workers', type=int,
+              default=OttoPiAsyncServer.DEF_WORKERS,
+              help='dispatch worker threads')
+@click.option('--no_unix', '-U', 'no_unix', is_flag=True, default=False,
+              help='do not listen on unix domain socket')
+@click.option('--lease_sec', '-l', 'lease_sec', type=float,
+              default=OttoPiLease.DEF_LEASE_SEC,
+              help='control lease [sec] (0: no arbitration)')
+@click.option('--lease_mode', '-M', 'lease_mode',
+              type=click.Choice(OttoPiLease.MODES),
+              default=OttoPiLease.DEF_MODE,
+              help='commands from non-holders')
+@click.option('--sim', 'sim', is_flag=True, default=False,
+              help='simulate servos and ToF sensors (no hardware)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(port, max_clients, workers, no_unix, lease_sec, lease_mode, sim,
+         debug):
+    _log = get_logger(__name__, debug)
+    _log.info('port=%d, max_clients=%d, workers=%d, no_unix=%s',
+              port, max_clients, workers, no_unix)
+    _log.info('lease_sec=%s, lease_mode=%s, sim=%s',
+              lease_sec, lease_mode, sim)
+
+    app = OttoPiAsyncServerApp(port, max_clients, workers, not no_unix,
+                               lease_sec, lease_mode, sim, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.info('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
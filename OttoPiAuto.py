@@ -12,6 +12,10 @@ send()で、自動運転のON/OFFを制御できる。
 
 ------------------------------------------------------------
 OttoPiAuto -- ロボットの自動運転 (自動運転スレッド)
+ |
+ +- ToFSampler -- 距離センサー(正面, 左, 右)の測定 (測定スレッド)
+ +- OttoPiConfig -- 設定ファイル (センサーの構成)
+ +- OttoPiMap -- 占有格子地図 (実行したコマンドと距離から作る)
  |
  +- OttoPiCtrl -- コマンド制御 (動作実行スレッド)
      |
@@ -25,10 +29,16 @@ __author__ = 'Yoichi Tanibayashi'
 __date__   = '2020'
 
 from OttoPiCtrl import OttoPiCtrl
+from OttoPiConfig import OttoPiConfig
+from LatencyStat import LatencyStat
+from ToFSampler import ToFSampler
+from ToFFilter import ToFFilter
+from OttoPiMap import OttoPiMap
 import VL53L0X as VL53L0X
 import pigpio
 import time
 import random
+import heapq
 import queue
 import threading
 
@@ -44,9 +54,18 @@ class OttoPiAuto(threading.Thread):
     CMD_ENABLE = 'enable'
     CMD_DISABLE = 'disable'
     CMD_READY = 'ready'
+    CMD_STAT  = 'stat'
     CMD_END   = 'end'
 
     DEF_RECV_TIMEOUT = 0.2  # sec
+    SAMPLE_AGE_MAX   = 1.0  # sec
+
+    # 最新のサンプルが、測定周期のこの倍数より古ければ、
+    # 今の距離としては返さない (D_STALE)
+    # (-1 は binary の返信で「距離なし」(OttoPiProto.BIN_D_NONE) なので、
+    #  それとは別の値)
+    STALE_PERIODS = 2
+    D_STALE = -2
 
     D_TOUCH       = 40
     D_TOO_NEAR    = 180
@@ -55,6 +74,9 @@ class OttoPiAuto(threading.Thread):
     D_READY_MIN   = D_TOUCH + 10
     D_READY_MAX   = 120
 
+    # 左右の距離の差がこれ以下なら、どちらでもよい
+    D_SIDE_DIFF   = 50
+
     STAT_NONE     = 'none'
     STAT_YELLOW   = 'yellow'
     STAT_TOO_NEAR = 'too_near'
@@ -65,32 +87,128 @@ class OttoPiAuto(threading.Thread):
     TOUCH_COUNT_COMMIT = 3
     READY_COUNT_COMMIT = 2
 
-    def __init__(self, robot_ctrl=None, debug=False):
+    # フィルター後の信頼度がこの値以上なら、1サンプルで確定する
+    CONF_COMMIT = 0.75
+
+    # 設定ファイルの [OttoPiAuto] セクションで変更できるパラメーター
+    # (OttoPiAutoSweep で調整する)
+    CONF_SECTION = 'OttoPiAuto'
+    PARAM = ['D_TOUCH', 'D_TOO_NEAR', 'D_NEAR', 'D_READY_MIN', 'D_READY_MAX',
+             'TOUCH_COUNT_COMMIT', 'READY_COUNT_COMMIT', 'CONF_COMMIT']
+
+    # 回避動作が効き始めるまでの時間 [sec]
+    # (歩行を「キリのいいところ」で中断するまでの時間を含む)
+    MOTION_SEC = {
+        'surprised': 1.0,
+        'backward': 1.0,
+        'slide':    1.5,
+        'turn':     2.5,
+    }
+
+    MAP_INTERVAL = 0.2  # sec
+
+    VEL_WINDOW = 10     # samples
+    V_MIN      = 20     # mm/sec: これより遅い場合は、近づいていないとみなす
+    D_GAIT_MAX = 1500   # mm: 歩行速度の推定に使う距離の上限
+    GAIT_ALPHA = 0.1
+
+    # 距離帯の深刻度 (保留中の割り込み判定に使う)
+    LEVEL_NONE     = 0
+    LEVEL_NEAR     = 1
+    LEVEL_TOO_NEAR = 2
+    LEVEL_TOUCH    = 3
+
+    def __init__(self, robot_ctrl=None, state=None, sampler=None,
+                 trace=None, clock=time.monotonic, param=None,
+                 tof_driver=None, debug=False):
+        """
+        Parameters
+        ----------
+        robot_ctrl: OttoPiCtrl
+        state: OttoPiState
+            状態共有メモリ (None: 公開しない)
+        sampler: ToFSampler
+            None: 作成して、測定を開始する
+        trace: str
+            距離のトレースファイル名 (None: 記録しない)
+        clock: function
+            時計 (再生・シミュレーション用に差し替えられる)
+        param: dict
+            しきい値など {'D_NEAR': 300, ..}
+            None: 設定ファイルの [OttoPiAuto] セクション (なければデフォルト)
+        tof_driver: str
+            sampler を作る場合の ToFSampler の driver (None: 設定ファイル)
+            'sim' では、データレディ割り込み(drdy)を使わない
+        """
         self.dbg = debug
         self._log = get_logger(__class__.__name__, self.dbg)
-        self._log.debug('')
+        self._log.debug('state=%s, sampler=%s, trace=%s, param=%s',
+                        state, sampler, trace, param)
+        self._log.debug('tof_driver=%s', tof_driver)
+
+        cnf = None
+        if param is None or sampler is None:
+            cnf = OttoPiConfig(debug=self.dbg)
+        if param is None:
+            param = cnf.get_section(self.CONF_SECTION)
+        self.set_param(param)
+
+        self.state = state
 
         self.cmd_func = {self.CMD_NULL: self.cmd_null,
                          self.CMD_ON:  self.cmd_on,
                          self.CMD_OFF: self.cmd_off,
                          self.CMD_ENABLE:  self.cmd_enable,
                          self.CMD_DISABLE: self.cmd_disable,
+                         self.CMD_STAT: self.cmd_stat,
                          self.CMD_END: self.cmd_end}
 
         self.my_robot_ctrl = False
         self.robot_ctrl = robot_ctrl
         if self.robot_ctrl is None:
             self.my_robot_ctrl = True
-            self.robot_ctrl = OttoPiCtrl(None, debug=self.dbg)
+            self.robot_ctrl = OttoPiCtrl(None, state=self.state,
+                                         debug=self.dbg)
             self.robot_ctrl.start()
 
-        self.tof = VL53L0X.VL53L0X()
-        # self.tof.start_ranging(VL53L0X.VL53L0X_BEST_ACCURACY_MODE)
-        self.tof.start_ranging(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE)
-        self.tof_timing = self.tof.get_timing()
-        self._log.info('tof_timing = %.02f ms', self.tof_timing / 1000)
+        # 距離の測定は、専用スレッドで行う
+        # (障害物が近いときは、HIGH_SPEEDモードに切り替える)
+        # (左右のセンサーがあれば、回避する向きの判断に使う)
+        self.my_sampler = False
+        self.sampler = sampler
+        if self.sampler is None:
+            self.my_sampler = True
+
+            sensors = cnf.get_tof() or ToFSampler.DEF_SENSORS
+            mux_addr = cnf.get_tof_mux() or ToFSampler.DEF_MUX_ADDR
+            drdy = cnf.get_tof_drdy()
+            driver = (tof_driver or cnf.get_tof_driver() or
+                      ToFSampler.DEF_DRIVER)
+            if driver == 'sim':
+                drdy = None
+
+            # self.sampler = ToFSampler(VL53L0X.VL53L0X_BEST_ACCURACY_MODE)
+            self.sampler = ToFSampler(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE,
+                                      adaptive=True, d_near=self.D_NEAR,
+                                      sensors=sensors, mux_addr=mux_addr,
+                                      trace=trace, drdy=drdy, driver=driver,
+                                      debug=self.dbg)
+            self.sampler.start()
+        self.tof_timing = self.sampler.tof_timing
         self.d = 0
 
+        self.filter = ToFFilter(d_far=self.D_FAR, debug=self.dbg)
+        self.conf = 0.0
+
+        self._clock = clock
+        self.sample_count = 0
+        self.sample_ts = 0.0
+
+        # 実行したコマンドから自己位置を推定し、調べた場所を覚えておく
+        self.map = OttoPiMap(clock=self._clock, debug=self.dbg)
+        self.map_ts = 0.0
+        self.robot_ctrl.cmd_cb = self.map.on_cmd
+
         self.cmdq = queue.Queue()
 
         self.active = True
@@ -105,6 +223,29 @@ class OttoPiAuto(threading.Thread):
 
         self.distance = self.D_FAR
 
+        self.level = self.LEVEL_NONE
+        self.level_t = 0.0
+
+        self.v = 0.0
+        self.gait_v = 0.0
+        self.d_too_near = self.D_TOO_NEAR
+        self.d_near = self.D_NEAR
+
+        # 自動運転中は、D_TOUCH以下が続いたら(ToFSampler.ESTOP_COUNT)、
+        # 測定スレッドから直接サーボを止める
+        # (1回だけなら、step() の LEVEL_TOUCH で後ろに下がる)
+        self.sampler.d_estop = self.D_TOUCH
+
+        self.timer = []
+        self.timer_seq = 0
+        self.hold_until = 0.0
+        self.hold_level = self.LEVEL_NONE
+        self.hold_motion = False
+
+        self.stat_cmd = LatencyStat('cmd')
+        self.stat_obstacle = LatencyStat('obstacle')
+        self.preempt_count = 0
+
         super().__init__(daemon=True)
 
     def __del__(self):
@@ -115,16 +256,43 @@ class OttoPiAuto(threading.Thread):
         self.active = False
 
         self.robot_ctrl.send(OttoPiCtrl.CMD_STOP)
+        if self.robot_ctrl.cmd_cb == self.map.on_cmd:
+            self.robot_ctrl.cmd_cb = None
 
         if self.my_robot_ctrl:
             self.robot_ctrl.end()
 
         self.join()
 
-        self.tof.stop_ranging()
+        if self.my_sampler:
+            self.sampler.end()
 
         self._log.debug('done')
 
+    def set_param(self, param):
+        """
+        クラス定数のしきい値などを、このインスタンスだけ変更する
+
+        param: {key: value} (key は大文字・小文字どちらでもよい)
+        """
+        for (key, val) in param.items():
+            key = key.upper()
+            if key not in self.PARAM:
+                self._log.warning('%s: unknown parameter .. ignored', key)
+                continue
+
+            setattr(self, key, type(getattr(self, key))(val))
+            self._log.info('%s = %s', key, getattr(self, key))
+
+    def publish(self):
+        if self.state is None:
+            return
+        self.state.update(distance=self.distance,
+                          auto_active=self.active,
+                          auto_on=self.on,
+                          auto_enable=self.enable,
+                          auto_ts=time.time())
+
     def cmd_null(self):
         """
         do nothing (to get distance)
@@ -136,14 +304,18 @@ class OttoPiAuto(threading.Thread):
         if not self.enable:
             self._log.warning('enable=%s .. ignored', self.enable)
             return
+        self.cancel()
         self.robot_ctrl.send('forward')
+        self.sampler.estop_cb = self.estop
         self.on = True
         self.touch_count = 0
         self.stat = self.STAT_NONE
 
     def cmd_off(self):
         self._log.debug('')
+        self.cancel()
         self.robot_ctrl.send('stop')
+        self.sampler.estop_cb = None
         self.on = False
         self.ready_count = 0
         self.stat = self.STAT_NONE
@@ -168,43 +340,520 @@ class OttoPiAuto(threading.Thread):
         self.cmd_off()
         self.active = False
 
+    def cmd_stat(self):
+        self._log.info('stat=%s', self.get_stat())
+
+    def get_stat(self):
+        """
+        反応時間の統計
+
+        cmd: send()されてから、コマンドを処理するまで
+        obstacle: 障害物の距離帯に入ってから、動作を送信するまで
+        """
+        return {'cmd': self.stat_cmd.summary(),
+                'obstacle': self.stat_obstacle.summary(),
+                'preempt': self.preempt_count,
+                'gait_v': round(self.gait_v),
+                'd_too_near': round(self.d_too_near),
+                'd_near': round(self.d_near),
+                'estop': self.robot_ctrl.stat_estop.summary(),
+                'map': self.map.get_stat(),
+                'tof': self.sampler.get_stat()}
+
     def is_active(self):
         self._log.debug('active=%s', self.active)
         return self.active
 
     def send(self, cmd):
+        """
+        Returns
+        -------
+        d: int
+            最新の距離 [mm] (get_distance()、古い場合は D_STALE)
+        """
         self._log.debug('cmd=\'%s\'', cmd)
-        self.cmdq.put(cmd)
-        d = self.get_distance()
-        self._log.debug('d=%smm', '{:,}'.format(d))
+        self.cmdq.put((cmd, self._clock()))
+        (d, age) = self.get_distance()
+        if age is not None:
+            self._log.debug('d=%smm, age=%.0fms', '{:,}'.format(d), age * 1000)
         return d
 
     def recv(self, timeout=DEF_RECV_TIMEOUT):
-        self._log.debug('timeout=%.1f', timeout)
+        self._log.debug('timeout=%.3f', timeout)
         try:
-            cmd = self.cmdq.get(timeout=timeout)
+            (cmd, t_send) = self.cmdq.get(timeout=timeout)
         except queue.Empty:
             cmd = ''
         else:
             self._log.debug('cmd=\'%s\'', cmd)
+            self.stat_cmd.add(self._clock() - t_send)
 
         return cmd
 
+    def filter_distance(self):
+        """
+        直近のサンプルをフィルターにかける (I2Cバスには触らない)
+
+        Returns
+        -------
+        result: ToFFilter.FilterResult
+            サンプルがない場合は None
+        """
+        (ts_list, mm_list) = self.sampler.ring.window(self.filter.window)
+        return self.filter.apply(ts_list, mm_list)
+
+    def sample_cycle(self):
+        """
+        全センサーを1回ずつ読む周期 [sec] (センサーは順番に読む)
+        """
+        period = self.sampler.period()
+        if period <= 0:
+            period = self.DEF_RECV_TIMEOUT
+        return period * len(self.sampler.sensor_name)
+
     def get_distance(self):
-        self.distance = self.tof.get_distance()
-        if self.distance == 0:
-            # ???
-            self.distance = self.D_FAR
-            self._log.warning('Crrection: distance = %smm',
-                              '{:,}'.format(self.distance))
+        """
+        最新のサンプルの距離 (フィルター後) と、サンプルの古さ
+
+        サンプルが STALE_PERIODS 周期より古い場合(センサーや測定スレッドが
+        止まっているなど)は、距離の代わりに D_STALE を返す。
+
+        Returns
+        -------
+        (d, age): (int, float)
+            age: サンプルの古さ [sec] (サンプルがない場合は None)
+        """
+        sample = self.sampler.latest()
+        if sample is None:
+            return (self.D_STALE, None)
+
+        (count, ts, mm) = sample
+        age = self._clock() - ts
+        if age > self.sample_cycle() * self.STALE_PERIODS:
+            self._log.warning('stale sample: %.0f ms', age * 1000)
+            return (self.D_STALE, age)
+
+        if count != self.sample_count:
+            # 制御ループがまだ処理していないサンプル
+            # (self.distance は制御ループのものなので、書き換えない)
+            result = self.filter_distance()
+            if result is not None:
+                return (result.d, age)
+
+        return (self.distance, age)
+
+    def side_clearance(self):
+        """
+        左右のセンサーの距離 (直近のサンプルの中央値)
+
+        Returns
+        -------
+        (left, right): tuple
+            左右のセンサーがない場合は None
+        """
+        ch_l = self.sampler.ch('left')
+        ch_r = self.sampler.ch('right')
+        if ch_l is None or ch_r is None:
+            return None
+
+        clearance = []
+        for ch in (ch_l, ch_r):
+            (ts_list, mm_list) = self.sampler.ring.window(self.filter.window,
+                                                          ch)
+            if len(mm_list) == 0:
+                return None
+
+            mm_list = sorted([mm if mm > 0 else self.D_FAR for mm in mm_list])
+            clearance.append(mm_list[len(mm_list) // 2])
+
+        return tuple(clearance)
+
+    def choose_side(self):
+        """
+        回避する向き ('left' or 'right')
+
+        空いている(遠い)方を選ぶ。
+        左右のセンサーがない場合や、差がない場合は、
+        地図上で、まだ調べていない方。それもなければ、ランダム。
+        """
+        clearance = self.side_clearance()
+        self._log.debug('clearance=%s', clearance)
+
+        if clearance is not None:
+            (left, right) = clearance
+            if abs(left - right) > self.D_SIDE_DIFF:
+                return 'left' if left > right else 'right'
+
+        a = self.map.plan()
+        self._log.debug('plan=%s', a)
+        if a is not None and a != 0:
+            return 'left' if a > 0 else 'right'
+
+        return 'right' if random.random() < 0.5 else 'left'
+
+    def update_map(self):
+        """
+        最新のサンプル(全センサー)を地図に書き込む
+
+        歩く速さに比べて測定周期が短いので、MAP_INTERVALごとに間引く。
+        """
+        sample = self.sampler.latest_vec()
+        if sample is None:
+            return
+
+        (count, ts, mm) = sample
+        if ts - self.map_ts < self.MAP_INTERVAL:
+            return
+        self.map_ts = ts
+
+        self.map.add_sample(ts, mm)
+
+    def get_level(self, d):
+        """
+        距離帯の深刻度
+
+        TOO_NEAR, NEARの境界は、接近速度に応じて広がる(update_threshold)。
+        """
+        if d <= self.D_TOUCH:
+            return self.LEVEL_TOUCH
+        if d <= self.d_too_near:
+            return self.LEVEL_TOO_NEAR
+        if d <= self.d_near:
+            return self.LEVEL_NEAR
+        return self.LEVEL_NONE
+
+    def update_velocity(self, d):
+        """
+        接近速度 [mm/sec] (正: 近づいている) と、歩行速度を更新する
+        """
+        (ts_list, mm_list) = self.sampler.ring.window(self.VEL_WINDOW)
+        v = self.filter.velocity(ts_list, mm_list)
+        if v is None:
+            self.v = 0.0
+            return self.v
+
+        self.v = -v
+
+        # 前進中に、正面の(静止した)障害物に近づく速さを歩行速度とみなす
+        if (self.on and self.stat in (self.STAT_NONE, self.STAT_FAR) and
+                self.d_near < d < self.D_GAIT_MAX and self.v > self.V_MIN):
+            self.gait_v += self.GAIT_ALPHA * (self.v - self.gait_v)
+            self.map.set_speed('forward', self.gait_v)
+
+        return self.v
+
+    def update_threshold(self):
+        """
+        接近速度(または歩行速度)に応じて、TOO_NEAR, NEAR の境界を広げる
+
+        回避動作が効き始めるまでに進む距離だけ、手前で反応する。
+        """
+        v = max(self.v, self.gait_v)
+
+        self.d_too_near = max(self.D_TOO_NEAR,
+                              self.D_TOUCH + v * self.MOTION_SEC['backward'])
+        self.d_near = max(self.D_NEAR,
+                          self.d_too_near + self.D_NEAR - self.D_TOO_NEAR,
+                          self.D_TOUCH + v * self.MOTION_SEC['slide'])
+
+        # 測定モード(HIGH_SPEED)の切り替え距離も合わせる
+        self.sampler.d_near = self.d_near
+
+    def ttc(self, d):
+        """
+        衝突までの予測時間 [sec] (time to collision)
+        """
+        if self.v < self.V_MIN:
+            return float('inf')
+        return max(d - self.D_TOUCH, 0) / self.v
+
+    def select_level(self, d, level):
+        """
+        予測衝突時間が、回避動作にかかる時間より短い場合は、
+        一段階深刻な距離帯として扱う
+        """
+        ttc = self.ttc(d)
+
+        if level == self.LEVEL_NEAR and ttc < self.MOTION_SEC['slide']:
+            self._log.debug('NEAR -> TOO_NEAR (ttc=%.2f sec)', ttc)
+            return self.LEVEL_TOO_NEAR
+
+        if level == self.LEVEL_NONE and ttc < self.MOTION_SEC['slide']:
+            self._log.debug('NONE -> NEAR (ttc=%.2f sec)', ttc)
+            return self.LEVEL_NEAR
 
-        return self.distance
+        return level
+
+    def after(self, sec, func, *args):
+        """
+        sec秒後に func(*args) を実行するタイマーを登録する
+        """
+        self._log.debug('sec=%.2f, func=%s, args=%s', sec, func.__name__, args)
+        self.timer_seq += 1
+        heapq.heappush(self.timer,
+                       (self._clock() + sec, self.timer_seq, func, args))
+
+    def run_timer(self, now):
+        while len(self.timer) > 0 and self.timer[0][0] <= now:
+            (t, seq, func, args) = heapq.heappop(self.timer)
+            self._log.debug('func=%s, args=%s', func.__name__, args)
+            func(*args)
+
+    def hold(self, sec, level=LEVEL_NONE, motion=False):
+        """
+        sec秒間、判断を保留する (sleepの代わり)
+
+        保留中も、コマンドと距離の処理は続ける。
+        自動運転中に、levelより深刻な距離帯に入った場合は、保留を取り消す。
+
+        motion: True の場合、動作が完了した時点で保留を解除する
+        """
+        self._log.debug('sec=%.2f, level=%d, motion=%s', sec, level, motion)
+        self.hold_until = self._clock() + sec
+        self.hold_level = level
+        self.hold_motion = motion
+
+    def is_holding(self, now):
+        if now >= self.hold_until:
+            return False
+
+        if self.hold_motion and self.robot_ctrl.idle.is_set():
+            self._log.debug('motion done')
+            self.hold_until = 0
+            return False
+
+        return True
+
+    def cancel(self):
+        """
+        保留とタイマーを取り消す
+        """
+        self.hold_until = 0
+        self.hold_level = self.LEVEL_NONE
+        self.hold_motion = False
+        self.timer = []
+
+    def sample_period(self):
+        """
+        測定周期ごとに起床する (測定モードによって変わる)
+        """
+        period = self.sampler.period()
+        if period <= 0:
+            return self.DEF_RECV_TIMEOUT
+        return min(period, self.DEF_RECV_TIMEOUT)
+
+    def next_timeout(self, now):
+        timeout = self.sample_period()
+        if len(self.timer) > 0:
+            timeout = min(timeout, max(self.timer[0][0] - now, 0))
+        return timeout
+
+    def action(self, cmd, now=None):
+        """
+        動作を送信する
+
+        now: 障害物に反応した場合に、反応時間を記録するために指定する
+        """
+        self._log.debug('cmd=%s', cmd)
+        self.robot_ctrl.send(cmd)
+        if now is not None and self.level > self.LEVEL_NONE:
+            self.stat_obstacle.add(self._clock() - self.level_t)
+
+    def estop(self, ts):
+        """
+        ToFSampler.estop_cb (測定スレッドから呼ばれる)
+
+        コマンドキューを通さずに、サーボを止める。
+        解除は、OttoPiCtrl.estop_clear() (サーバーの ':estop_clear')
+        """
+        self.robot_ctrl.estop(ts)
+
+    def stop_touched(self):
+        self._log.warn('STOP!')
+        self.cmd_off()
+        self.hold(3, self.LEVEL_TOUCH)
+
+    def step(self, d, now):
+        """
+        1サンプル分の判断
+        """
+        if not self.enable:
+            return
+
+        if self.on and self.robot_ctrl.is_halted():
+            self._log.warning('emergency stop .. auto off')
+            self.cancel()
+            self.sampler.estop_cb = None
+            self.on = False
+            self.ready_count = 0
+            self.stat = self.STAT_NONE
+
+        if self.on:
+            level = self.select_level(d, self.get_level(d))
+        else:
+            # 自動運転中以外は、反応時間を計測しない
+            level = self.LEVEL_NONE
+        if level != self.level:
+            self.level = level
+            self.level_t = now
+
+        if self.is_holding(now):
+            if not self.on or level <= self.hold_level:
+                return
+
+            self._log.warning('preempt: level=%d > hold_level=%d',
+                              level, self.hold_level)
+            self.preempt_count += 1
+            self.cancel()
+
+        if not self.on:
+            if self.robot_ctrl.is_halted():
+                # 非常停止の解除を待つ
+                return
+
+            if self.ready_count > 0:
+                self._log.info('ready_count=%d/%d',
+                               self.ready_count, self.READY_COUNT_COMMIT)
+
+            if self.ready_count < self.READY_COUNT_COMMIT:
+                if d >= self.D_READY_MIN and d <= self.D_READY_MAX:
+                    self._log.warn('%dmm <= %dmm <= %dmm',
+                                   self.D_READY_MIN,
+                                   d,
+                                   self.D_READY_MAX)
+                    self.ready_count += 1
+                    if self.conf >= self.CONF_COMMIT:
+                        self.ready_count = self.READY_COUNT_COMMIT
+                    self.robot_ctrl.send('happy')
+                    self.hold(1)
+                else:
+                    self.ready_count = 0
+
+            else:  # self.ready_count >= self.READY_COUNT_COMMIT
+                self.cmd_on()
+
+            return
+
+        self.prev_stat = self.stat
+
+        if level == self.LEVEL_TOUCH:
+            self._log.warn('touched(%dmm <= %dmm)', d, self.D_TOUCH)
+            self.action('surprised', now)
+
+            if self.touch_count < self.TOUCH_COUNT_COMMIT:
+                self.touch_count += 1
+                if self.conf >= self.CONF_COMMIT:
+                    self.touch_count = self.TOUCH_COUNT_COMMIT
+                self._log.info('touch_count=%d, conf=%.2f',
+                               self.touch_count, self.conf)
+                if self.touch_count >= self.TOUCH_COUNT_COMMIT:
+                    self.after(1, self.stop_touched)
+                    self.hold(1 + 3, self.LEVEL_TOUCH)
+                else:
+                    self.after(1, self.action, 'backward')
+                    self.hold(1, self.LEVEL_TOUCH)
+                return
+        else:
+            self.touch_count = 0
+
+        if level >= self.LEVEL_TOO_NEAR:
+            self._log.warn('TOO_NEAR(%dmm <= %dmm, v=%dmm/s)',
+                           d, self.d_too_near, self.v)
+            self.stat = self.STAT_NEAR
+
+            if (self.prev_stat != self.STAT_NEAR and
+                    self.ttc(d) >= self.MOTION_SEC['surprised']):
+                self.action('surprised', now)
+                self.hold(1, self.LEVEL_TOO_NEAR, motion=True)
+            else:
+                self.action('backward', now)
+                self.hold(2, self.LEVEL_TOO_NEAR)
+
+        elif level == self.LEVEL_NEAR:
+            self._log.warn('NEAR(%dmm <= %dmm, v=%dmm/s)',
+                           d, self.d_near, self.v)
+            self.stat = self.STAT_NEAR
+            if self.prev_stat != self.STAT_NEAR:
+                self.prev_rl = self.choose_side()
+                self.action('slide_' + self.prev_rl, now)
+                self.hold(1.5, self.LEVEL_NEAR)
+            else:
+                if self.prev_rl == "right":
+                    self.action('turn_right', now)
+                else:
+                    self.action('turn_left', now)
+                self.hold(1 + 1.5, self.LEVEL_NEAR)
+
+        elif d >= self.D_FAR:
+            self._log.info('FAR(%dmm >= %dmm)', d, self.D_FAR)
+            self.stat = self.STAT_FAR
+            if self.prev_stat in [self.STAT_NEAR, self.STAT_YELLOW]:
+                self.robot_ctrl.send('forward')
+
+        else:
+            if self.prev_stat == self.STAT_NEAR:
+                self.stat = self.STAT_NONE
+                if d <= self.d_near + 50:
+                    self.stat = self.STAT_YELLOW
+                    self._log.info('stat: %s', self.stat)
+                    self.robot_ctrl.send('suriashi_fwd')
+                else:
+                    self._log.info('stat: %s', self.stat)
+                    self.robot_ctrl.send('forward')
+
+        self.touch_count = 0
+        self._log.debug('stat=%s', self.stat)
+
+    def poll(self, now):
+        """
+        タイマーと、新しい距離サンプルの処理
+
+        OttoPiAutoSim は、仮想時計を進めながら、これを直接呼び出す。
+        """
+        self.run_timer(now)
+
+        sample = self.sampler.latest()
+        if sample is None:
+            return
+
+        (count, ts, mm) = sample
+        if count == self.sample_count:
+            # 新しいサンプルがない
+            return
+        self.sample_count = count
+        self.sample_ts = ts
+
+        if now - ts > self.SAMPLE_AGE_MAX:
+            self._log.warning('too old sample: %.0f ms', (now - ts) * 1000)
+            return
+
+        result = self.filter_distance()
+        d = result.d
+        self.distance = d
+        self.conf = result.conf
+        self.update_velocity(d)
+        self.update_threshold()
+        self.publish()
+        self.update_map()
+
+        # self._log.debug('d = %smm', '{:,}'.format(d))
+        if d < 0:
+            return
+
+        self.step(d, ts)
 
     def run(self):
+        """
+        イベント駆動の制御ループ
+
+        コマンド受信、タイマー、距離サンプルのいずれかで起床する。
+        sleepしないので、auto_off などのコマンドや障害物には、
+        センサーの測定周期以内に反応する。
+        """
         self._log.debug('')
 
         while self.active:
-            cmd = self.recv()
+            cmd = self.recv(self.next_timeout(self._clock()))
             if cmd != '':
                 self._log.debug('cmd=%a', cmd)
                 cmdline = cmd.split()
@@ -215,121 +864,29 @@ class OttoPiAuto(threading.Thread):
                 else:
                     self._log.error('%s: invalid command .. ignore', cmd)
 
-            d = self.get_distance()
-            # self._log.debug('d = %smm', '{:,}'.format(d))
-            if d < 0:
-                continue
+            if not self.active:
+                break
 
-            if not self.enable:
-                continue
-
-            if not self.on:
-                if self.ready_count > 0:
-                    self._log.info('ready_count=%d/%d',
-                                   self.ready_count, self.READY_COUNT_COMMIT)
-
-                if self.ready_count < self.READY_COUNT_COMMIT:
-                    if d >= self.D_READY_MIN and d <= self.D_READY_MAX:
-                        self._log.warn('%dmm <= %dmm <= %dmm',
-                                       self.D_READY_MIN,
-                                       d,
-                                       self.D_READY_MAX)
-                        self.ready_count += 1
-                        self.robot_ctrl.send('happy')
-                        time.sleep(1)
-                    else:
-                        self.ready_count = 0
-
-                else:  # self.ready_count >= self.READY_COUNT_COMMIT
-                    self.cmd_on()
-
-                continue
-
-            self.prev_stat = self.stat
-
-            if d <= self.D_TOUCH:
-                self._log.warn('touched(%dmm <= %dmm)', d, self.D_TOUCH)
-                self.robot_ctrl.send('suprised')
-                time.sleep(1)
-
-                if self.touch_count < self.TOUCH_COUNT_COMMIT:
-                    self.touch_count += 1
-                    self._log.info('touch_count=%d', self.touch_count)
-                    if self.touch_count >= self.TOUCH_COUNT_COMMIT:
-                        self._log.warn('STOP!')
-                        self.cmd_off()
-                        # self.robot_ctrl.send('suprised')
-                        time.sleep(3)
-                    else:
-                        self.robot_ctrl.send('backward')
-                    continue
-            else:
-                self.touch_count = 0
-
-            if d <= self.D_TOO_NEAR:
-                self._log.warn('TOO_NEAR(%dmm <= %dmm)', d, self.D_TOO_NEAR)
-                self.stat = self.STAT_NEAR
-
-                if self.prev_stat != self.STAT_NEAR:
-                    self.robot_ctrl.send('suprised')
-                    time.sleep(1)
-                else:
-                    self.robot_ctrl.send('backward')
-                    time.sleep(2)
-
-            elif d <= self.D_NEAR:
-                self._log.warn('NEAR(%dmm <= %dmm)', d, self.D_NEAR)
-                self.stat = self.STAT_NEAR
-                if self.prev_stat != self.STAT_NEAR:
-                    if random.random() < 0.5:
-                        self.prev_rl = "right"
-                        self.robot_ctrl.send('slide_right')
-                    else:
-                        self.prev_rl = "left"
-                        self.robot_ctrl.send('slide_left')
-                else:
-                    if self.prev_rl == "right":
-                        self.robot_ctrl.send('turn_right')
-                    else:
-                        self.robot_ctrl.send('turn_left')
-                    time.sleep(1)
-                time.sleep(1.5)
-
-            elif d >= self.D_FAR:
-                self._log.info('FAR(%dmm >= %dmm)', d, self.D_FAR)
-                self.stat = self.STAT_FAR
-                if self.prev_stat in [self.STAT_NEAR, self.STAT_YELLOW]:
-                    self.robot_ctrl.send('forward')
-
-            else:
-                if self.prev_stat == self.STAT_NEAR:
-                    self.stat = self.STAT_NONE
-                    if d <= self.D_NEAR + 50:
-                        self.stat = self.STAT_YELLOW
-                        self._log.info('stat: %s', self.stat)
-                        self.robot_ctrl.send('suriashi_fwd')
-                    else:
-                        self._log.info('stat: %s', self.stat)
-                        self.robot_ctrl.send('forward')
-
-            self.touch_count = 0
-            self._log.debug('stat=%s', self.stat)
+            self.poll(self._clock())
 
+        self.publish()
+        self._log.info('stat=%s', self.get_stat())
         self._log.info('done(active=%s)', self.active)
 
 
 class OttoPiAutoApp:
-    def __init__(self, debug=False):
+    def __init__(self, trace=None, debug=False):
         self.dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('')
+        self._log.debug('trace=%s', trace)
 
         self.pi = pigpio.pi()
 
         self.robot_ctrl = OttoPiCtrl(self.pi, debug=self.dbg)
         self.robot_ctrl.start()
 
-        self.robot_auto = OttoPiAuto(self.robot_ctrl, debug=self.dbg)
+        self.robot_auto = OttoPiAuto(self.robot_ctrl, trace=trace,
+                                     debug=self.dbg)
         self.robot_auto.start()
 
         self.active = True
@@ -364,12 +921,14 @@ class OttoPiAutoApp:
 
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--trace', '-t', 'trace', type=click.Path(), default=None,
+              help='record ToF trace file (for OttoPiAutoSim)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(debug):
+def main(trace, debug):
     logger = get_logger(__name__, debug)
 
-    app = OttoPiAutoApp(debug=debug)
+    app = OttoPiAutoApp(trace=trace, debug=debug)
     try:
         app.main()
     finally:
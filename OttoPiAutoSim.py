@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiAuto のリプレイ(シミュレーション)
+
+記録した距離のトレース(ToFTrace)を、OttoPiAutoの判断ロジックに
+そのまま入力し、送信されたコマンドの時系列と、反応時間を出力する。
+
+ * 時計は仮想時計 (トレースのタイムスタンプで進める)
+ * OttoPiCtrl の代わりに SimCtrl (コマンドを記録するだけ)
+ * ToFSampler の代わりに SimSampler (トレースの値をリングバッファに入れる)
+
+待ち時間がないので、実時間の数百倍の速さで再生できる。
+
+トレースは記録した時の動きなので、ロボットの動作は距離に反映されない
+(判断の回帰テスト、反応時間の比較用)。
+
+param で、OttoPiAuto のしきい値などを差し替えられる。
+  ex. OttoPiAutoSim('a.tof', param={'D_NEAR': 300})
+
+-----------------------------------------------------------------
+OttoPiAutoSim -- リプレイ
+ |
+ +- OttoPiAuto -- ロボットの自動運転 (判断ロジック)
+ |   |
+ |   +- SimSampler -- トレースからのサンプル
+ |   +- SimCtrl -- コマンドの記録
+ |
+ +- ToFTraceReader -- トレースファイル
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiAuto import OttoPiAuto
+from LatencyStat import LatencyStat
+from ToFSampler import ToFSampler, SampleRing
+from ToFTrace import ToFTraceReader
+import random
+import time
+
+from MyLogger import get_logger, ERROR
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class VirtualClock:
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class SimIdle:
+    """
+    OttoPiCtrl.idle の代わり
+    """
+    def __init__(self, ctrl):
+        self._ctrl = ctrl
+
+    def is_set(self):
+        return self._ctrl.is_idle()
+
+
+class SimCtrl:
+    """
+    OttoPiCtrl の代わり: 送信されたコマンドを記録する
+    """
+    CMD_STOP = 'stop'
+
+    # 繰り返しでない動作の所要時間 [sec]
+    # (繰り返しの動作は、次のコマンドまで終わらない)
+    MOTION_SEC = {
+        'happy':     2.0,
+        'surprised': 1.5,
+        'stop':      0.5,
+    }
+    LOOP_CMD = ['forward', 'backward', 'suriashi_fwd',
+                'turn_right', 'turn_left', 'slide_right', 'slide_left']
+
+    def __init__(self, clock, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+
+        self._clock = clock
+        self.log = []
+        self.busy_until = 0.0
+        self.idle = SimIdle(self)
+        self.cmd_cb = None
+
+        self.halted = False
+        self.stat_estop = LatencyStat('estop')
+
+    def send(self, cmd, doInterrupt=True):
+        now = self._clock()
+        self._log.debug('%.3f: %s', now, cmd)
+        if self.halted and cmd.split()[0] != self.CMD_STOP:
+            return
+        self.log.append((now, cmd))
+
+        if cmd.split()[0] in self.LOOP_CMD:
+            self.busy_until = float('inf')
+        else:
+            self.busy_until = now + self.MOTION_SEC.get(cmd.split()[0], 1.0)
+
+        if self.cmd_cb is not None:
+            self.cmd_cb(cmd)
+
+    def is_idle(self):
+        return self._clock() >= self.busy_until
+
+    def estop(self, t_detect=None):
+        now = self._clock()
+        self.log.append((now, 'estop'))
+        self.halted = True
+        self.busy_until = now
+        if t_detect is not None:
+            self.stat_estop.add(now - t_detect)
+
+    def estop_clear(self):
+        self.halted = False
+
+    def is_halted(self):
+        return self.halted
+
+    def end(self):
+        pass
+
+
+class SimSampler:
+    """
+    ToFSampler の代わり: トレースの値を、リングバッファに入れる
+    """
+    MODE_NAME = 'sim'
+
+    def __init__(self, names, period, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+
+        self.sensor_name = names
+        self.ring = SampleRing(SampleRing.DEF_SIZE, len(names))
+        self.tof_timing = period * 1000000
+        self.d_near = 0
+
+        self.estop_cb = None
+        self.d_estop = 0
+        self.estop_n = 0
+
+    def put(self, ts, mm):
+        self.ring.put(ts, *mm)
+
+        # ToFSampler.put() と同じ判定
+        if self.estop_cb is not None and 0 < mm[0] <= self.d_estop:
+            self.estop_n += 1
+            if self.estop_n >= ToFSampler.ESTOP_COUNT:
+                self.estop_cb(ts)
+        else:
+            self.estop_n = 0
+
+    def ch(self, name):
+        if name in self.sensor_name:
+            return self.sensor_name.index(name)
+        return None
+
+    def period(self):
+        return self.tof_timing / 1000000
+
+    def latest(self):
+        return self.ring.latest()
+
+    def latest_vec(self):
+        sample = self.ring.latest_vec()
+        if sample is None:
+            return None
+
+        (count, ts, mm_list) = sample
+        return (count, ts, dict(zip(self.sensor_name, mm_list)))
+
+    def get_stat(self):
+        return {'mode': self.MODE_NAME, 'count': self.ring.count}
+
+    def end(self):
+        pass
+
+
+class OttoPiAutoSim:
+    DEF_SEED = 0
+
+    def __init__(self, trace, param=None, seed=DEF_SEED, debug=ERROR):
+        """
+        Parameters
+        ----------
+        trace: str or ToFTraceReader
+            トレースファイル
+        param: dict
+            OttoPiAuto のパラメーター (OttoPiAuto.PARAM)
+            ex. {'D_NEAR': 300, 'TOUCH_COUNT_COMMIT': 2}
+        seed: int
+            乱数の種 (左右の選択を再現できるように)
+        debug: bool or int
+            OttoPiAuto などのログレベル (デフォルトはエラーのみ)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('trace=%s, param=%s, seed=%s', trace, param, seed)
+
+        if isinstance(trace, ToFTraceReader):
+            self.trace = trace
+        else:
+            self.trace = ToFTraceReader(trace, debug=self._dbg)
+
+        self.param = param or {}
+        for key in self.param:
+            if key not in OttoPiAuto.PARAM:
+                raise KeyError('%s: no such parameter' % key)
+
+        self.seed = seed
+
+    def period(self):
+        """
+        トレースのサンプル周期 (中央値)
+        """
+        ts = [ts for (ts, mm) in self.trace]
+        if len(ts) < 2:
+            return OttoPiAuto.DEF_RECV_TIMEOUT
+
+        dt = sorted([t2 - t1 for (t1, t2) in zip(ts[:-1], ts[1:])])
+        return dt[len(dt) // 2]
+
+    def run(self):
+        """
+        Returns
+        -------
+        result: dict
+            cmd: [(t, cmd), ..] (t: トレース開始からの秒数)
+            stat: OttoPiAuto.get_stat()
+            sim_sec: トレースの時間
+            wall_sec: 再生にかかった時間
+        """
+        self._log.debug('')
+
+        random.seed(self.seed)
+
+        records = list(self.trace)
+        t0 = records[0][0] if len(records) > 0 else 0.0
+
+        clock = VirtualClock(t0)
+        ctrl = SimCtrl(clock, debug=self._dbg)
+        sampler = SimSampler(self.trace.names, self.period(), debug=self._dbg)
+
+        auto = OttoPiAuto(ctrl, sampler=sampler, clock=clock,
+                          param=self.param, debug=self._dbg)
+
+        wall_start = time.perf_counter()
+
+        auto.cmd_enable()
+        auto.cmd_on()
+
+        for (ts, mm) in records:
+            # サンプルの間に期限が来るタイマー
+            while len(auto.timer) > 0 and auto.timer[0][0] < ts:
+                clock.t = auto.timer[0][0]
+                auto.poll(clock.t)
+
+            clock.t = ts
+            sampler.put(ts, mm)
+            auto.poll(ts)
+
+        wall_sec = time.perf_counter() - wall_start
+
+        return {'cmd': [(round(t - t0, 3), cmd) for (t, cmd) in ctrl.log],
+                'stat': auto.get_stat(),
+                'sim_sec': round(clock.t - t0, 3),
+                'wall_sec': round(wall_sec, 3)}
+
+
+class OttoPiAutoSimApp:
+    def __init__(self, trace_file, param, seed, quiet, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('trace_file=%s, param=%s, seed=%s, quiet=%s',
+                        trace_file, param, seed, quiet)
+
+        self._quiet = quiet
+        self._sim = OttoPiAutoSim(trace_file, param, seed,
+                                  debug=self._dbg or ERROR)
+
+    def main(self):
+        self._log.debug('')
+
+        result = self._sim.run()
+
+        if not self._quiet:
+            for (t, cmd) in result['cmd']:
+                print('%9.3f %s' % (t, cmd))
+
+        stat = result['stat']
+        print('obstacle[ms]: %s' % stat['obstacle'])
+        print('estop[ms]: %s' % stat['estop'])
+        print('map: %s' % stat['map'])
+
+        speed = 0.0
+        if result['wall_sec'] > 0:
+            speed = result['sim_sec'] / result['wall_sec']
+        print('%d cmds, %.1f sec in %.3f sec (x%.0f)' % (
+            len(result['cmd']), result['sim_sec'], result['wall_sec'],
+            speed))
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+replay ToF trace file through OttoPiAuto
+''')
+@click.argument('trace_file', type=click.Path(exists=True))
+@click.option('--param', '-p', 'param', type=str, multiple=True,
+              help='KEY=VALUE, ex. -p D_NEAR=300')
+@click.option('--seed', '-s', 'seed', type=int, default=OttoPiAutoSim.DEF_SEED,
+              help='random seed')
+@click.option('--quiet', '-q', 'quiet', is_flag=True, default=False,
+              help='do not print command timeline')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(trace_file, param, seed, quiet, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('trace_file=%s, param=%s, seed=%s, quiet=%s',
+               trace_file, param, seed, quiet)
+
+    param_dict = {}
+    for p in param:
+        (key, val) = p.split('=')
+        param_dict[key] = type(getattr(OttoPiAuto, key))(val)
+
+    app = OttoPiAutoSimApp(trace_file, param_dict, seed, quiet, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
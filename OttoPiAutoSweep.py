@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiAuto のしきい値の探索
+
+記録した距離のトレース(ToFTrace)を、パラメーターの組み合わせごとに
+OttoPiAutoSimで再生し、評価値の良い順に並べる。
+組み合わせは、全CPUコアで並列に評価する(ProcessPoolExecutor)。
+
+評価 (パラメーターによらない、固定の基準で):
+
+ * 衝突 (collision):
+   基準距離が EVAL_D_HIT 未満になったとき、前進中だった回数
+ * 誤停止 (false stop):
+   基準距離が EVAL_D_CLEAR より遠いのに、止まる・避ける動作をした回数
+ * 反応時間 (reaction):
+   前進中に基準距離が EVAL_D_NEAR を下回ってから、前進以外の動作までの時間
+
+ 基準距離: トレースの生の値の中央値 (前後 EVAL_MEDIAN 個)
+
+ score = W_COLLISION * collision + W_FALSE * false_stop + W_REACT * reaction
+ (小さいほど良い)
+
+最も良い組み合わせを、設定ファイルの [OttoPiAuto] セクションの形式で出力する。
+
+-----------------------------------------------------------------
+OttoPiAutoSweep -- パラメーター探索
+ |
+ +- OttoPiAutoSim -- リプレイ (プロセスごと)
+     |
+     +- OttoPiAuto -- ロボットの自動運転 (判断ロジック)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiAuto import OttoPiAuto
+from OttoPiAutoSim import OttoPiAutoSim
+from ToFTrace import ToFTraceReader
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import random
+import glob
+import os
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+# 前進中とみなすコマンド
+FORWARD_CMD = ['forward', 'suriashi_fwd']
+
+# 探索範囲のデフォルト
+DEF_SPACE = {
+    'D_TOUCH':            [30, 40, 50, 60],
+    'D_TOO_NEAR':         [150, 180, 210, 240],
+    'D_NEAR':             [220, 250, 280, 320],
+    'D_READY_MIN':        [50, 60, 70],
+    'D_READY_MAX':        [100, 120, 140],
+    'TOUCH_COUNT_COMMIT': [1, 2, 3, 4],
+    'READY_COUNT_COMMIT': [1, 2, 3],
+}
+
+
+class SweepScore:
+    EVAL_D_HIT    = 80   # mm
+    EVAL_D_NEAR   = 300  # mm
+    EVAL_D_CLEAR  = 450  # mm
+    EVAL_D_FAR    = 8000  # mm: 無効値の扱い
+    EVAL_MEDIAN   = 5    # samples
+    EVAL_REACT_MAX = 3.0  # sec: これ以上反応しなければ、この値とする
+
+    W_COLLISION = 10.0
+    W_FALSE     = 3.0
+    W_REACT     = 1.0  # /sec
+
+    def __init__(self, trace):
+        """
+        trace: ToFTraceReader
+        """
+        records = list(trace)
+        self.ts = [ts - records[0][0] for (ts, mm) in records]
+
+        # 正面のセンサーの基準距離
+        mm = [m[0] if m[0] > 0 else self.EVAL_D_FAR for (ts, m) in records]
+        h = self.EVAL_MEDIAN // 2
+        self.ref = []
+        for i in range(len(mm)):
+            w = sorted(mm[max(i - h, 0):i + h + 1])
+            self.ref.append(w[len(w) // 2])
+
+    def evaluate(self, cmd_log):
+        """
+        Parameters
+        ----------
+        cmd_log: [(t, cmd), ..]
+            OttoPiAutoSim.run() の 'cmd'
+
+        Returns
+        -------
+        score: dict
+        """
+        collision = 0
+        false_stop = 0
+        react = []
+
+        cmd_i = 0
+        cur_cmd = ''
+        hit = False
+        near_t = None
+
+        for (t, ref) in zip(self.ts, self.ref):
+            # t までに送信されたコマンド
+            while cmd_i < len(cmd_log) and cmd_log[cmd_i][0] <= t:
+                (cmd_t, cur_cmd) = cmd_log[cmd_i]
+                cmd_i += 1
+
+                if cur_cmd not in FORWARD_CMD:
+                    if ref > self.EVAL_D_CLEAR and cur_cmd != 'happy':
+                        false_stop += 1
+                    if near_t is not None:
+                        react.append(cmd_t - near_t)
+                        near_t = None
+
+            forward = cur_cmd in FORWARD_CMD
+
+            if ref < self.EVAL_D_HIT:
+                if not hit and forward:
+                    collision += 1
+                hit = True
+            else:
+                hit = False
+
+            if near_t is None and forward and ref < self.EVAL_D_NEAR:
+                near_t = t
+            elif near_t is not None and ref >= self.EVAL_D_NEAR:
+                # 反応する前に離れた
+                near_t = None
+
+            if near_t is not None and t - near_t >= self.EVAL_REACT_MAX:
+                react.append(self.EVAL_REACT_MAX)
+                near_t = None
+
+        reaction = sum(react) / len(react) if len(react) > 0 else 0.0
+        score = (self.W_COLLISION * collision + self.W_FALSE * false_stop +
+                 self.W_REACT * reaction)
+
+        return {'score': score, 'collision': collision,
+                'false_stop': false_stop, 'reaction': reaction}
+
+
+# 各プロセスで、トレースを一度だけ読み込む
+_trace = []
+
+
+def _init_worker(trace_files):
+    global _trace
+    _trace = [ToFTraceReader(f) for f in trace_files]
+    _trace = [(t, SweepScore(t)) for t in _trace if len(t) > 0]
+
+
+def _evaluate(param):
+    """
+    1組のパラメーターを、全トレースで評価する
+    """
+    total = {'score': 0.0, 'collision': 0, 'false_stop': 0, 'reaction': 0.0}
+    for (trace, scorer) in _trace:
+        result = OttoPiAutoSim(trace, param).run()
+        score = scorer.evaluate(result['cmd'])
+        for key in total:
+            total[key] += score[key]
+
+    total['reaction'] /= max(len(_trace), 1)
+    return (param, total)
+
+
+class OttoPiAutoSweep:
+    def __init__(self, trace_files, space=DEF_SPACE, n=0, seed=0,
+                 workers=None, debug=False):
+        """
+        Parameters
+        ----------
+        trace_files: list of str
+        space: {param: [value, ..]}
+        n: int
+            0: 全組み合わせ(グリッド), >0: ランダムにn組
+        workers: int
+            プロセス数 (None: CPUコア数)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('trace_files=%s, space=%s, n=%s, seed=%s, workers=%s',
+                        trace_files, space, n, seed, workers)
+
+        self.trace_files = trace_files
+        self.space = space
+        self.n = n
+        self.seed = seed
+        self.workers = workers or os.cpu_count()
+
+    @staticmethod
+    def is_valid(param):
+        """
+        距離の大小関係が成り立たない組み合わせは除く
+        """
+        p = {key: param.get(key, getattr(OttoPiAuto, key))
+             for key in OttoPiAuto.PARAM}
+        return (p['D_TOUCH'] < p['D_READY_MIN'] < p['D_READY_MAX'] <
+                p['D_TOO_NEAR'] < p['D_NEAR'])
+
+    def candidates(self):
+        keys = sorted(self.space.keys())
+
+        if self.n == 0:
+            param_list = [dict(zip(keys, v)) for v in
+                          itertools.product(*[self.space[k] for k in keys])]
+        else:
+            rnd = random.Random(self.seed)
+            param_list = [{k: rnd.choice(self.space[k]) for k in keys}
+                          for i in range(self.n)]
+
+        # 重複を除く
+        param_list = [dict(t) for t in
+                      sorted(set([tuple(sorted(p.items()))
+                                  for p in param_list]))]
+
+        return [p for p in param_list if self.is_valid(p)]
+
+    def run(self):
+        """
+        Returns
+        -------
+        result: [(param, score), ..]
+            score の良い順
+        """
+        param_list = self.candidates()
+
+        # 現在の値も比較のために入れる
+        param_list.insert(0, {})
+
+        self._log.info('%d sets x %d traces, %d workers',
+                       len(param_list), len(self.trace_files), self.workers)
+
+        chunksize = max(len(param_list) // (self.workers * 4), 1)
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                 initargs=(self.trace_files,)) as ex:
+            result = list(ex.map(_evaluate, param_list, chunksize=chunksize))
+
+        result.sort(key=lambda r: (r[1]['score'], r[1]['reaction']))
+        return result
+
+    @staticmethod
+    def conf_section(param):
+        """
+        設定ファイルの形式
+        """
+        lines = ['[%s]' % OttoPiAuto.CONF_SECTION]
+        for key in OttoPiAuto.PARAM:
+            lines.append('%s = %s' % (key.lower(),
+                                      param.get(key, getattr(OttoPiAuto, key))))
+        return '\n'.join(lines)
+
+
+class OttoPiAutoSweepApp:
+    def __init__(self, trace_files, space, n, seed, workers, top,
+                 debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('trace_files=%s, space=%s', trace_files, space)
+        self._log.debug('n=%s, seed=%s, workers=%s, top=%s',
+                        n, seed, workers, top)
+
+        self._top = top
+        self._sweep = OttoPiAutoSweep(trace_files, space, n, seed, workers,
+                                      debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        result = self._sweep.run()
+
+        keys = OttoPiAuto.PARAM
+        print('%4s %8s %4s %4s %6s  %s' % (
+            'rank', 'score', 'coll', 'fals', 'react',
+            ' '.join([k.lower() for k in keys])))
+        for (i, (param, score)) in enumerate(result[:self._top]):
+            print('%4d %8.2f %4d %4d %6.3f  %s%s' % (
+                i + 1, score['score'], score['collision'],
+                score['false_stop'], score['reaction'],
+                ' '.join([str(param.get(k, getattr(OttoPiAuto, k)))
+                          for k in keys]),
+                '' if len(param) > 0 else '  (current)'))
+
+        print()
+        print(self._sweep.conf_section(result[0][0]))
+
+    def end(self):
+        self._log.debug('')
+
+
+def parse_space(spec):
+    """
+    'KEY=v1,v2,..' or 'KEY=start:stop:step' (stop を含む)
+    """
+    (key, val) = spec.split('=')
+    key = key.upper()
+    conv = type(getattr(OttoPiAuto, key))
+
+    if ':' in val:
+        (start, stop, step) = [conv(v) for v in val.split(':')]
+        v_list = []
+        v = start
+        while v <= stop:
+            v_list.append(v)
+            v += step
+        return (key, v_list)
+
+    return (key, [conv(v) for v in val.split(',')])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+sweep OttoPiAuto thresholds over ToF trace files
+''')
+@click.argument('trace', type=click.Path(exists=True), nargs=-1,
+                required=True)
+@click.option('--param', '-p', 'param', type=str, multiple=True,
+              help='KEY=v1,v2,.. or KEY=start:stop:step')
+@click.option('--random', '-n', 'n', type=int, default=0,
+              help='random search N sets (0: grid)')
+@click.option('--seed', '-s', 'seed', type=int, default=0,
+              help='random seed')
+@click.option('--workers', '-w', 'workers', type=int, default=None,
+              help='worker processes (default: CPU count)')
+@click.option('--top', '-t', 'top', type=int, default=20,
+              help='print top N')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(trace, param, n, seed, workers, top, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('trace=%s, param=%s, n=%s, seed=%s, workers=%s, top=%s',
+               trace, param, n, seed, workers, top)
+
+    # ディレクトリの場合は、その中の *.tof
+    trace_files = []
+    for t in trace:
+        if os.path.isdir(t):
+            trace_files += sorted(glob.glob(os.path.join(t, '*.tof')))
+        else:
+            trace_files.append(t)
+
+    if len(trace_files) == 0:
+        _log.error('%s: no trace file', trace)
+        return
+
+    space = DEF_SPACE
+    if len(param) > 0:
+        space = dict([parse_space(p) for p in param])
+
+    app = OttoPiAutoSweepApp(trace_files, space, n, seed, workers, top,
+                             debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
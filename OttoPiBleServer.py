@@ -7,6 +7,9 @@
 
 BLEでコマンドを受信し、OttoPiServerにコマンドを中継する
 
+書き込まれたデータが OttoPiProto の binary の場合は、binary で中継し、
+返信も binary (固定長 11 bytes) で通知する。
+
 -----------------------------------------------------------------
 OttoPiBleServer -- ロボットBLEサーバー
  |
@@ -29,7 +32,10 @@ OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレ
 __author__ = 'Yoichi Tanibayashi'
 __data__   = '2020'
 
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiClient, OttoPiClientPool
+from OttoPiState import OttoPiState, state_name
+from OttoPiProto import ProtoError, is_binary, bin_request_size
+from OttoPiProto import decode_bin_request, encode_bin_reply
 from BlePeripheral import BlePeripheral, BleService, BleCharacteristic
 from BlePeripheral import BlePeripheralApp
 import json
@@ -83,6 +89,7 @@ class OttoPiService(BleService):
 
 class CmdCharacteristic(BleCharacteristic):
     UUID = '70e45870-79ec-44c6-859d-0897aa7134b6'
+    CLIENT_NAME = 'ble'
 
     _log = get_logger(__name__, False)
 
@@ -98,6 +105,12 @@ class CmdCharacteristic(BleCharacteristic):
         self._robot_port = robot_port
         self._chara_resp = chara_resp
 
+        # 書き込みごとに接続しないで、使い回す (text と binary は別の接続)
+        self._pool = OttoPiClientPool(self._robot_host, self._robot_port,
+                                      size=1, debug=False)
+        self._pool_bin = OttoPiClientPool(self._robot_host, self._robot_port,
+                                          size=1, binary=True, debug=False)
+
         super().__init__(uuid, ['write', 'read', 'notify'], debug=debug)
 
     def onWriteRequest(self, data, offset, withoutRespoinse, callback):
@@ -105,16 +118,18 @@ class CmdCharacteristic(BleCharacteristic):
 
         super().onWriteRequest(data, offset, withoutRespoinse, callback)
 
+        if is_binary(bytes(data)):
+            self._chara_resp._value = bytearray(self.relay_bin(bytes(data)))
+            self._log.debug('_chara_resp._value=%s', self._chara_resp._value)
+            OttoPiBleServer.notify(self._chara_resp)
+            return
+
         cmd = data.decode('utf-8')
         self._log.debug('cmd=%a', cmd)
 
-        robot_client = OttoPiClient(self._robot_host, self._robot_port,
-                                    debug=False)
-        ret = robot_client.send_cmd(cmd)
+        ret = self._pool.send_cmd(cmd, name=self.CLIENT_NAME)
         self._log.debug('ret=%s', ret)
 
-        robot_client.close()
-
         self._chara_resp._value = bytearray(json.dumps(ret).encode('utf-8'))
         self._log.debug('_chara_resp._value=%s', self._chara_resp._value)
 
@@ -123,6 +138,41 @@ class CmdCharacteristic(BleCharacteristic):
         self._log.debug('done')
 
 
+    def relay_bin(self, data):
+        """
+        binary のリクエスト(複数可)を中継し、返信を binary で返す
+
+        サーバーへは、binary の ":client" で CLIENT_NAME を名乗る
+        """
+        try:
+            robot_client = self._pool_bin.get()
+        except OSError as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            return encode_bin_reply(0, 0, False, str(e))
+
+        out = b''
+        try:
+            robot_client.name = self.CLIENT_NAME
+            i = 0
+            while True:
+                size = bin_request_size(data, i)
+                if size is None:
+                    break
+                (req_id, op, cmd) = decode_bin_request(data[i:i + size])
+                i += size
+
+                ret = robot_client.send_cmd(cmd)
+                self._log.debug('ret=%s', ret)
+                out += encode_bin_reply(req_id, op, ret['ACCEPT'], ret['MSG'])
+        except ProtoError as e:
+            self._log.warning('%s', e)
+            out += encode_bin_reply(0, 0, False, str(e))
+        finally:
+            self._pool_bin.put(robot_client)
+
+        return out
+
+
 class RespCharacteristic(BleCharacteristic):
     UUID = '79394316-6874-4506-9c20-1245751c6c20'
 
@@ -147,6 +197,15 @@ class RespCharacteristic(BleCharacteristic):
 
 
 class OttoPiBleServerApp(BlePeripheralApp):
+    LOCAL_HOST = OttoPiClient.LOCAL_HOST
+    POLL_CMD = ':.auto_null'
+    SUB_PERIOD_MS = 1000
+    SUB_FIELDS = ['d']
+
+    # 共有メモリの更新(auto_ts, ctrl_ts)がこれより古ければ、
+    # OttoPiServer が止まったか、再起動してブロックが作り直された
+    STATE_AGE_MAX = 3.0  # sec
+
     def __init__(self, robot_svr, robot_port, debug=False):
         self._dbg = debug
         self._log = get_logger(__class__.__name__, self._dbg)
@@ -158,8 +217,99 @@ class OttoPiBleServerApp(BlePeripheralApp):
         self._ble = OttoPiBleServer(self._robot_svr, self._robot_port,
                                     debug=self._dbg)
 
+        self._state = None
+
+        self._sub = None
+        self._tlm = None
+
         self._active = False
 
+    def get_state(self):
+        """
+        ローカルのOttoPiServerが公開している状態共有メモリに接続する
+        """
+        if self._state is not None:
+            return self._state
+
+        if self._robot_svr not in self.LOCAL_HOST:
+            return None
+
+        try:
+            self._state = OttoPiState(state_name(self._robot_port),
+                                      create=False, debug=self._dbg)
+        except (FileNotFoundError, ValueError) as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+            self._state = None
+
+        return self._state
+
+    def read_state(self):
+        """
+        共有メモリの状態を読む
+
+        更新が止まっていたら、接続し直す (それでも古ければ None)
+        """
+        for retry in (True, False):
+            state = self.get_state()
+            if state is None:
+                return None
+
+            st = state.read()
+            if st is None:
+                return None
+
+            age = time.time() - max(st['auto_ts'], st['ctrl_ts'])
+            if age < self.STATE_AGE_MAX:
+                return st
+
+            self._log.warning('stale state: %.1f sec .. reattach', age)
+            state.close()
+            self._state = None
+
+        return None
+
+    def get_tlm(self):
+        """
+        OttoPiServer のテレメトリーを購読し、最新の値を返す
+        (変化がない間は、前回の値)
+        """
+        if self._sub is None:
+            # 購読中の接続はテレメトリーが届くので、プールには入れない
+            self._sub = OttoPiClient(self._robot_svr, self._robot_port,
+                                     debug=False)
+            self._sub.subscribe(self.SUB_PERIOD_MS, self.SUB_FIELDS)
+
+        try:
+            frames = self._sub.recv_tlm()
+        except Exception:
+            # 次回、接続し直す
+            self._sub.close()
+            self._sub = None
+            raise
+
+        if len(frames) > 0:
+            self._tlm = frames[-1]['TLM']
+        return self._tlm
+
+    def poll(self):
+        """
+        距離などの状態を取得する
+
+        共有メモリが使える(更新されている)場合は共有メモリ、
+        それ以外は購読で、
+        OttoPiServerにコマンドを送らない。
+        返り値は、':.auto_null' の応答と同じ形式 (まだ値がなければ None)。
+        """
+        st = self.read_state()
+        if st is not None:
+            return {'CMD': self.POLL_CMD, 'ACCEPT': True,
+                    'MSG': {'d': st['distance']}}
+
+        tlm = self.get_tlm()
+        if tlm is None:
+            return None
+        return {'CMD': self.POLL_CMD, 'ACCEPT': True, 'MSG': {'d': tlm['d']}}
+
     def main(self):
         self._log.debug('')
 
@@ -170,10 +320,10 @@ class OttoPiBleServerApp(BlePeripheralApp):
         self._active =True
         while self._active:
             try:
-                robot_cl = OttoPiClient(self._robot_svr, self._robot_port,
-                                        debug=False)
-                ret = robot_cl.send_cmd(':.auto_null')
-                robot_cl.close()
+                ret = self.poll()
+                if ret is None:
+                    time.sleep(1)
+                    continue
 
                 chara_resp._value = bytearray(json.dumps(ret).encode('utf-8'))
                 self._log.debug('chara_resp._value=%a', chara_resp._value)
@@ -193,6 +343,10 @@ class OttoPiBleServerApp(BlePeripheralApp):
         self._log.debug('')
         self._active = False
         self._ble.end()
+        if self._state is not None:
+            self._state.close()
+        if self._sub is not None:
+            self._sub.close()
         self._log.debug('done')
 
 
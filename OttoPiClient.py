@@ -7,10 +7,20 @@
 
 OttoPiServerにコマンドを送信する
 
+プロトコルは OttoPiProto の framed (または binary)。
+返信はリクエストの id で待つので、待ち時間は返信が届くまでだけ
+(timeout まで)。短縮文字列は、1文字ずつのリクエストをまとめて送る。
+
+サーバーがローカル(LOCAL_HOST)で、Unix ドメインソケットがあれば、
+TCP の代わりにそちらを使う。
+
+ブリッジなど、コマンドごとに接続していたものは、OttoPiClientPool で
+接続を使い回す。
+
 -----------------------------------------------------------------
 OttoPiClient -- ロボット制御クライアント
 |
-|(TCP/IP)
+|(TCP/IP, Unix domain socket)
 |
 OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレッド)
  |
@@ -27,10 +37,13 @@ OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレ
 __author__ = 'Yoichi Tanibayashi'
 __date__   = '2019'
 
-from OttoPiServer import OttoPiServer
-import telnetlib
+from OttoPiServer import OttoPiServer, OttoPiDispatcher, unix_path
+from OttoPiProto import ProtoError, ClientSession, Subscription, reply_dict
+from OttoPiProto import CMD_SUBSCRIBE
+import threading
+import socket
 import time
-import json
+import os
 
 from MyLogger import get_logger
 import click
@@ -40,121 +53,491 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 class OttoPiClient:
     DEF_HOST = 'localhost'
     DEF_PORT = 12345
-
-    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, debug=False):
+    LOCAL_HOST = ('localhost', '127.0.0.1', '::1')
+
+    DEF_TIMEOUT = 5.0  # sec
+    RECV_SIZE = 4096
+
+    def __init__(self, svr_host=DEF_HOST, svr_port=DEF_PORT, binary=False,
+                 unix=True, name=None, timeout=DEF_TIMEOUT, debug=False):
+        """
+        Parameters
+        ----------
+        binary: bool
+            True なら OttoPiProto の binary、False なら framed で送る
+            (binary では、opcode のないコマンドは送れない)
+        unix: bool
+            True なら、ローカルのサーバーには Unix ドメインソケットを使う
+        name: str
+            クライアント名 (サーバーのリースの調停用)。
+            最初のコマンド(変更した場合は次のコマンド)と一緒に送る
+        timeout: float
+            接続と返信を待つ時間 [sec]
+        """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
+        self._log.debug('svr_host=%s, svr_port=%d, binary=%s, unix=%s',
+                        svr_host, svr_port, binary, unix)
+        self._log.debug('name=%s, timeout=%s', name, timeout)
 
         self.svr_host = svr_host
         self.svr_port = svr_port
+        self.binary = binary
+        self.unix = unix
+        self.name = name
+        self.timeout = timeout
+        self.transport = None
+
+        self.sock = None
+        self._proto = None
+        self._tlm = []
 
-        self.tn = self.open(self.svr_host, self.svr_port)
+        self.open()
 
     def __del__(self):
         self._log.debug('')
         self.close()
 
-    def open(self, svr_host=DEF_HOST, svr_port=DEF_PORT):
-        self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
-        return telnetlib.Telnet(self.svr_host, self.svr_port)
+    def connect(self):
+        path = unix_path(self.svr_port)
+        if (self.unix and self.svr_host in self.LOCAL_HOST and
+                os.path.exists(path)):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(path)
+            except OSError as e:
+                self._log.debug('%s:%s .. use TCP', type(e).__name__, e)
+                sock.close()
+            else:
+                self.transport = 'unix'
+                return sock
+
+        sock = socket.create_connection((self.svr_host, self.svr_port),
+                                        self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self.transport = 'tcp'
+        return sock
+
+    def open(self):
+        self._log.debug('svr_host=%s, svr_port=%d',
+                        self.svr_host, self.svr_port)
+
+        self.sock = self.connect()
+        self._proto = ClientSession(self.binary, OttoPiDispatcher.CMD_KEY,
+                                    debug=self._dbg)
+        self._tlm = []
 
     def close(self):
         self._log.debug('')
-        self.tn.close()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def recv_replies(self, ids):
+        """
+        ids の返信がそろうまで受信する (途中のテレメトリーはためておく)
+        """
+        replies = {}
+        deadline = time.monotonic() + self.timeout
+
+        while not all([i in replies for i in ids]):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError('no reply')
+            self.sock.settimeout(timeout)
+
+            in_data = self.sock.recv(self.RECV_SIZE)
+            if len(in_data) == 0:
+                raise ConnectionError('disconnected')
 
-    def recv_reply(self):
-        self._log.debug('')
+            (reps, frames) = self._proto.feed(in_data)
+            self._tlm += frames
+            for rep in reps:
+                replies[rep['id']] = rep
 
-        buf = b''
+        return [replies[i] for i in ids]
 
-        while True:
-            time.sleep(0.1)
-            try:
-                in_data = self.tn.read_eager()
-            except Exception as e:
-                self._log.debug('%s:%s', type(e), e)
-                in_data = b''
+    def request(self, cmd):
+        """
+        コマンドを送り、返信を待つ
 
-            if len(in_data) == 0:
-                break
+        短縮文字列は 1文字ずつのリクエストを、まとめて送る。
 
-            self._log.debug('in_data:%a', in_data)
-            buf += in_data
+        Returns
+        -------
+        replies: list of dict
+            リクエストごとの返信 (順番どおり)
+            cmd が空なら [] (送らない)
+        """
+        self._log.debug('cmd=%s', cmd)
 
-        self._log.debug('buf=%a', buf)
+        if len(cmd) == 0:
+            return []
 
-        try:
-            ret_str = buf.decode('utf-8')
-        except UnicodeDecodeError:
-            if buf == b'':
-                ret_str = ''
-            else:
-                ret_str = str(buf)
+        if self.sock is None:
+            self.open()
 
-        self._log.debug('ret_str=%a', ret_str)
+        for retry in (True, False):
+            (ids0, data0) = self._proto.name_requests(self.name)
+            (ids, data) = self._proto.requests(cmd)
+            try:
+                self.sock.settimeout(self.timeout)
+                self.sock.sendall(data0 + data)
+                break
+            except OSError as e:
+                if not retry:
+                    raise
+                # サーバーが切断していた場合など: 接続し直して、1回だけ再送
+                self._log.warning('Retry:%s:%s:%s.',
+                                  cmd, type(e).__name__, e)
+                self.close()
+                self.open()
 
-        try:
-            ret = json.loads(ret_str)
-        except json.decoder.JSONDecodeError:
-            ret = {'CMD': '', 'ACCEPT': '', 'MSG': ret_str}
+        return self.recv_replies(ids0 + ids)[len(ids0):]
+
+    def send_cmd(self, cmd):
+        """
+        Returns
+        -------
+        ret: dict
+            最後の返信 {'CMD':.., 'ACCEPT':.., 'MSG':..}
+        """
+        self._log.debug('cmd=%s', cmd)
 
+        try:
+            replies = self.request(cmd)
+        except ProtoError as e:
+            self._log.warning('%s', e)
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': str(e)}
+        except OSError as e:
+            # タイムアウトなど: 途中の返信が残っているかもしれないので、切断
+            self._log.warning('%s:%s', type(e).__name__, e)
+            self.close()
+            return {'CMD': cmd, 'ACCEPT': False,
+                    'MSG': '%s:%s' % (type(e).__name__, e)}
+
+        if len(replies) == 0:
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': 'empty command'}
+
+        ret = self._proto.result(cmd, replies[-1])
         self._log.debug('ret=%s', ret)
+        return ret
 
+    def subscribe(self, period_ms=Subscription.DEF_PERIOD_MS, fields=None):
+        """
+        テレメトリーを購読する
+
+        フレームは recv_tlm() で読む。購読中も send_cmd() は使える。
+
+        Parameters
+        ----------
+        period_ms: int
+            サーバーが状態を見る周期 (変化がなければ送られてこない)
+        fields: list of str
+            OttoPiProto.TLM_FIELDS の一部 (None: すべて、binary では無視)
+
+        Returns
+        -------
+        ret: dict
+            ":subscribe" の返信
+        """
+        self._log.debug('period_ms=%s, fields=%s', period_ms, fields)
+
+        cmd = '%s%s %d' % (OttoPiServer.CMD_PREFIX, CMD_SUBSCRIBE, period_ms)
+        if fields is not None and not self.binary:
+            cmd += ' ' + ','.join(fields)
+
+        ret = self.send_cmd(cmd)
+        if not ret['ACCEPT']:
+            raise ProtoError('%s: %s' % (ret['CMD'], ret['MSG']))
         return ret
 
-    def send_cmd1(self, cmd):
-        self._log.debug('cmd=%s', cmd)
+    def recv_tlm(self, timeout=0):
+        """
+        受信済みのテレメトリーを読む
 
-        try:
-            self.tn.write(cmd.encode('utf-8'))
-        except Exception as e:
-            self._log.warning('Retry:%s:%s:%s.', cmd, type(e), e)
-            self.tn = self.open(self.svr_host, self.svr_port)
-            self.tn.write(cmd.encode('utf-8'))
+        Parameters
+        ----------
+        timeout: float
+            何も受信していない場合に待つ時間 [sec]
 
-        ret = self.recv_reply()
-        self._log.debug('ret=%s', ret)
+        Returns
+        -------
+        frames: list of dict
+            [{'seq':.., 'TLM': {..}, ..}, ..] 古い順 (最新は frames[-1])
+        """
+        if self.sock is None:
+            raise ConnectionError('not connected')
 
-        return ret
+        self.sock.settimeout(timeout if len(self._tlm) == 0 else 0)
+        while True:
+            try:
+                in_data = self.sock.recv(self.RECV_SIZE)
+            except (BlockingIOError, socket.timeout):
+                break
+            if len(in_data) == 0:
+                raise ConnectionError('disconnected')
+
+            (reps, frames) = self._proto.feed(in_data)
+            self._tlm += frames
+
+            # 続けて届いている分も読む
+            self.sock.settimeout(0)
+
+        (frames, self._tlm) = (self._tlm, [])
+        self._log.debug('frames=%s', frames)
+        return frames
+
+
+class OttoPiClientPool:
+    """
+    OttoPiClient の接続プール (スレッドセーフ)
+
+    ブリッジ(HTTP, WebSocket, BLE, ボタン)が、コマンドごとに接続・切断
+    しないように、接続を使い回す。
+
+     * keep-alive: 使い終わった接続は、idle_sec まで残す (SO_KEEPALIVE)
+     * ヘルスチェック: 貸し出す前に、サーバーが切断していないか見る
+       (MSG_PEEK, 往復なし)
+     * 再接続: 接続に失敗したら、backoff (BACKOFF_MIN から倍々、
+       BACKOFF_MAX まで) の間は接続しないで、すぐにエラーを返す
+     * 同時に使う接続は size まで。それ以上は、空くまで待つ (timeout まで)
+
+    Usage:
+    --
+    pool = OttoPiClientPool.shared('localhost', 12345)
+    ret = pool.send_cmd(':.happy', name='http:192.168.0.10')
+    --
+    """
+    DEF_SIZE = 4
+    DEF_IDLE_SEC = 60.0
+    BACKOFF_MIN = 0.1
+    BACKOFF_MAX = 5.0
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, svr_host=OttoPiClient.DEF_HOST,
+               svr_port=OttoPiClient.DEF_PORT, binary=False, **kw):
+        """
+        プロセス内で共有するプール (host, port, binary ごとに 1つ)
+        """
+        key = (svr_host, svr_port, binary)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(svr_host, svr_port, binary=binary, **kw)
+            return cls._shared[key]
+
+    def __init__(self, svr_host=OttoPiClient.DEF_HOST,
+                 svr_port=OttoPiClient.DEF_PORT, size=DEF_SIZE,
+                 idle_sec=DEF_IDLE_SEC, binary=False, unix=True,
+                 timeout=OttoPiClient.DEF_TIMEOUT, debug=False):
+        """
+        Parameters
+        ----------
+        size: int
+            最大接続数
+        idle_sec: float
+            使っていない接続を閉じるまでの時間 [sec]
+        binary, unix, timeout:
+            OttoPiClient と同じ
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('svr_host=%s, svr_port=%s, size=%s, idle_sec=%s',
+                        svr_host, svr_port, size, idle_sec)
 
-    def send_cmd(self, cmd):
-        self._log.debug('cmd=%s', cmd)
+        self.svr_host = svr_host
+        self.svr_port = svr_port
+        self.size = size
+        self.idle_sec = idle_sec
+        self.binary = binary
+        self.unix = unix
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(size)
+        self._idle = []  # [(client, t_put), ..] 最後が最新
+        self._n_open = 0
+
+        self._fail = 0
+        self._retry_at = 0.0
+
+        self.stat = {'created': 0, 'reused': 0, 'closed_idle': 0,
+                     'health_fail': 0, 'broken': 0, 'connect_fail': 0,
+                     'backoff_reject': 0, 'wait_timeout': 0, 'cmd': 0}
+
+    def get_stat(self):
+        with self._lock:
+            stat = dict(self.stat)
+            stat.update({'open': self._n_open,
+                         'idle': len(self._idle),
+                         'in_use': self._n_open - len(self._idle),
+                         'backoff': round(max(self._retry_at -
+                                              time.monotonic(), 0), 2)})
+        return stat
+
+    def is_healthy(self, client):
+        """
+        サーバーが切断していないか
+
+        何も受信していなければ OK。切断(b'')や、待っていないデータ
+        (前のコマンドの遅れた返信など)があれば、使わない。
+        """
+        if client.sock is None:
+            return False
+        try:
+            client.sock.settimeout(0)
+            client.sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, socket.timeout):
+            return True
+        except OSError:
+            pass
+        return False
+
+    def connect(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._retry_at:
+                self.stat['backoff_reject'] += 1
+                raise ConnectionError('backoff %.2f sec' % (
+                    self._retry_at - now))
 
-        self.recv_reply()
+        try:
+            client = OttoPiClient(self.svr_host, self.svr_port,
+                                  binary=self.binary, unix=self.unix,
+                                  timeout=self.timeout, debug=self._dbg)
+        except OSError as e:
+            with self._lock:
+                self.stat['connect_fail'] += 1
+                backoff = min(self.BACKOFF_MIN * 2 ** self._fail,
+                              self.BACKOFF_MAX)
+                self._fail += 1
+                self._retry_at = time.monotonic() + backoff
+            self._log.warning('%s:%s .. backoff %.2f sec',
+                              type(e).__name__, e, backoff)
+            raise
+
+        client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
+        with self._lock:
+            self._fail = 0
+            self._retry_at = 0.0
+            self._n_open += 1
+            self.stat['created'] += 1
+        return client
+
+    def get(self):
+        """
+        接続を借りる (使い終わったら put() で返す)
+        """
+        if not self._sem.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stat['wait_timeout'] += 1
+            raise TimeoutError('no free connection')
 
-        if cmd[0] == OttoPiServer.CMD_PREFIX:
-            ret = self.send_cmd1(cmd)
+        try:
+            while True:
+                with self._lock:
+                    if len(self._idle) == 0:
+                        break
+                    (client, t_put) = self._idle.pop()
+
+                if (time.monotonic() - t_put < self.idle_sec and
+                        self.is_healthy(client)):
+                    with self._lock:
+                        self.stat['reused'] += 1
+                    return client
+
+                self.discard(client, 'health_fail')
+
+            return self.connect()
+
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def put(self, client):
+        """
+        接続を返す (切断されていたら捨てる)
+        """
+        if client.sock is None:
+            self.discard(client, 'broken')
         else:
-            for ch in cmd:
-                self._log.debug('ch=%a(0x%02x)', ch, ord(ch))
-                ret = self.send_cmd1(ch)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                self._idle.append((client, now))
+
+                # 長く使っていない接続を閉じる
+                while (len(self._idle) > 0 and
+                       now - self._idle[0][1] >= self.idle_sec):
+                    expired.append(self._idle.pop(0)[0])
+            for c in expired:
+                self.discard(c, 'closed_idle')
+
+        self._sem.release()
+
+    def discard(self, client, reason):
+        self._log.debug('reason=%s', reason)
+        client.close()
+        with self._lock:
+            self._n_open -= 1
+            self.stat[reason] += 1
+
+    def send_cmd(self, cmd, name=None):
+        """
+        OttoPiClient.send_cmd() と同じ
+
+        Parameters
+        ----------
+        name: str
+            クライアント名 (接続ごとではなく、コマンドごと)
+        """
+        with self._lock:
+            self.stat['cmd'] += 1
 
-        return ret
+        try:
+            client = self.get()
+        except OSError as e:
+            self._log.warning('%s:%s', type(e).__name__, e)
+            return {'CMD': cmd, 'ACCEPT': False,
+                    'MSG': '%s:%s' % (type(e).__name__, e)}
+
+        try:
+            client.name = name
+            return client.send_cmd(cmd)
+        finally:
+            self.put(client)
+
+    def close(self):
+        self._log.debug('')
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for (client, _) in idle:
+            self.discard(client, 'closed_idle')
 
 
 class OttoPiClientApp:
-    def __init__(self, command, svr_host, svr_port, debug=False):
+    def __init__(self, command, svr_host, svr_port, binary, debug=False):
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
         self._log.debug('command=%s', command)
         self._log.debug('svr_host=%s, svr_port=%d', svr_host, svr_port)
 
-        self.cl = OttoPiClient(svr_host, svr_port, debug=self._dbg)
+        self.cl = OttoPiClient(svr_host, svr_port, binary=binary,
+                               debug=self._dbg)
         self.command = command
 
     def main(self):
         self._log.debug('command:\'%s\'', self.command)
 
         for cmd1 in self.command:
-            if cmd1[0] == OttoPiServer.CMD_PREFIX:
-                ret = self.cl.send_cmd(cmd1)
+            # 短縮文字列は、まとめて送って、1文字ずつの返信を表示
+            for rep in self.cl.request(cmd1):
+                ret = reply_dict(rep)
                 print(ret)
-            else:
-                for ch in cmd1:
-                    self._log.debug('ch=%a', ch)
-                    ret = self.cl.send_cmd(ch)
-                    print(ret)
 
     def end(self):
         self._log.debug('')
@@ -170,14 +553,16 @@ class OttoPiClientApp:
 @click.option('--svr_port', '-p', 'svr_port', type=int,
               default=OttoPiClient.DEF_PORT,
               help='server port number')
+@click.option('--binary', '-b', 'binary', is_flag=True, default=False,
+              help='binary encoding')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(command, svr_host, svr_port, debug):
+def main(command, svr_host, svr_port, binary, debug):
     _log = get_logger(__name__, debug)
-    _log.debug('command=%s, svr_host=%s, svr_port=%d',
-              command, svr_host, svr_port)
+    _log.debug('command=%s, svr_host=%s, svr_port=%d, binary=%s',
+              command, svr_host, svr_port, binary)
 
-    obj = OttoPiClientApp(command, svr_host, svr_port, debug=debug)
+    obj = OttoPiClientApp(command, svr_host, svr_port, binary, debug=debug)
     try:
         obj.main()
     finally:
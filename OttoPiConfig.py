@@ -11,12 +11,27 @@ from MyLogger import get_logger
 #####
 DEF_CONF_FILE = 'OttoPi.conf'
 DEF_CONF_PATH = ['.', os.environ['HOME'], '/etc']
+SAMPLE_CONF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'OttoPi.conf-sample')
 DEF_SECTION   = 'OttoPi'
 KEY_PIN       = 'pin'
 KEY_HOME      = 'home'
+KEY_TOF       = 'tof'      # ex. "center:0 left:1 right:2"
+KEY_TOF_MUX   = 'tof_mux'  # ex. "0x70"
+KEY_TOF_DRDY  = 'tof_drdy'  # ex. "5 6 13" (GPIO1 of each sensor)
+KEY_TOF_DRIVER = 'tof_driver'  # "st", "py" or "sim"
 
 #####
 class OttoPiConfig:
+    # 設定ファイルが見つからない場合に使うファイル (None: 使わない)
+    # シミュレーション(OttoPiServer --sim)では、use_sample() で
+    # OttoPi.conf-sample にする (save() では上書きしない)
+    fallback = None
+
+    @classmethod
+    def use_sample(cls):
+        cls.fallback = SAMPLE_CONF_FILE
+
     def __init__(self, conf_file=DEF_CONF_FILE, debug=False):
         self.debug = debug
         self.logger = get_logger(__class__.__name__, debug)
@@ -44,6 +59,10 @@ class OttoPiConfig:
             conf_file = self.conf_path_name
             self.logger.debug('conf_file=%s', conf_file)
 
+        if conf_file == self.fallback:
+            self.logger.warning('%s: fallback .. not saved', conf_file)
+            return
+
         f = open(conf_file, mode='w')
         self.config.write(f)
         f.close()
@@ -57,6 +76,11 @@ class OttoPiConfig:
                 self.logger.debug('path_name=%s', path_name)
                 return path_name
 
+        if self.fallback is not None:
+            self.logger.warning('\'%s\' is not found .. use %s',
+                                conf_file, self.fallback)
+            return self.fallback
+
         self.logger.warning('\'%s\' is not found', conf_file)
         return None
         
@@ -80,6 +104,62 @@ class OttoPiConfig:
         self.logger.debug('')
         return self.get_intlist(KEY_HOME)
 
+    def get_section(self, section):
+        """
+        セクションの内容 {key: str}
+        セクションがない場合は {}
+        """
+        self.logger.debug('section=%s', section)
+        if not self.config.has_section(section):
+            return {}
+        return dict(self.config[section])
+
+    def get_tof(self, section=DEF_SECTION):
+        """
+        距離センサーのリスト [(name, TCA9548A channel), ..]
+        設定がない場合は None
+        """
+        self.logger.debug('')
+        if not self.config.has_option(section, KEY_TOF):
+            return None
+
+        tof = []
+        for s in self.config[section][KEY_TOF].split():
+            (name, ch) = s.split(':')
+            tof.append((name, int(ch)))
+        self.logger.debug('tof=%s', tof)
+        return tof
+
+    def get_tof_mux(self, section=DEF_SECTION):
+        """
+        マルチプレクサー(TCA9548A)のI2Cアドレス
+        設定がない場合は None
+        """
+        self.logger.debug('')
+        if not self.config.has_option(section, KEY_TOF_MUX):
+            return None
+        return int(self.config[section][KEY_TOF_MUX], 0)
+
+    def get_tof_drdy(self, section=DEF_SECTION):
+        """
+        距離センサーのデータレディ(GPIO1)のピン [pin, ..]
+        設定がない場合は None
+        """
+        self.logger.debug('')
+        if not self.config.has_option(section, KEY_TOF_DRDY):
+            return None
+        return self.get_intlist(KEY_TOF_DRDY, section)
+
+    def get_tof_driver(self, section=DEF_SECTION):
+        """
+        距離センサーのドライバー ('st' or 'py')
+        設定がない場合は None
+        """
+        self.logger.debug('')
+        if not self.config.has_option(section, KEY_TOF_DRIVER):
+            return None
+        return self.config[section][KEY_TOF_DRIVER].strip()
+
     def set_pin(self, v_list):
         self.logger.debug('v_list=%s', v_list)
         self.set_intlist(KEY_PIN, v_list)
@@ -22,6 +22,7 @@ __author__ = 'Yoichi Tanibayashi'
 __date__   = '2019'
 
 from OttoPiMotion import OttoPiMotion
+from LatencyStat import LatencyStat
 
 import pigpio
 import time
@@ -40,12 +41,27 @@ class OttoPiCtrl(threading.Thread):
     CMD_HELP   = 'help'
     CMD_END    = 'end'
 
-    def __init__(self, pi=None, debug=False):
+    # 非常停止 (キューを通さずに、estop(), estop_clear()を直接呼ぶ)
+    CMD_ESTOP       = 'estop'
+    CMD_ESTOP_CLEAR = 'estop_clear'
+
+    # 非常停止中でも実行するコマンド
+    CMD_HALT_OK = [CMD_STOP, CMD_RESUME, CMD_HELP]
+
+    def __init__(self, pi=None, state=None, debug=False):
+        """
+        Parameters
+        ----------
+        pi: pigpio.pi
+            OttoPiSim.SimPi も可 (None: 新たに接続する)
+        state: OttoPiState
+            状態共有メモリ (None: 公開しない)
+        """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('pi=%s', str(pi))
+        self._log.debug('pi=%s, state=%s', str(pi), state)
 
-        if type(pi) == pigpio.pi:
+        if pi is not None:
             self.pi   = pi
             self.mypi = False
         else:
@@ -56,6 +72,14 @@ class OttoPiCtrl(threading.Thread):
         # self.opm = OttoPiMotion(self.pi, debug=logger.propagate and debug)
         self.opm = OttoPiMotion(self.pi, debug=self._dbg)
 
+        self.state = state
+        if self.state is not None:
+            self.opm.servo.pulse_cb = self.publish_pulse
+
+        # コマンドの実行開始・終了の通知 (ex. OttoPiMap.on_cmd)
+        #   cmd_cb(cmd): 終了時は cmd=''
+        self.cmd_cb = None
+
         # コマンド名とモーション関数の対応づけ
         self.cmd_func = {
             # モーション
@@ -111,6 +135,14 @@ class OttoPiCtrl(threading.Thread):
         self.cmdq = queue.Queue()
         self.active = False
 
+        # 動作完了イベント: キューが空で、動作を実行していないときにセット
+        self.idle = threading.Event()
+        self.idle.set()
+        self._idle_lock = threading.Lock()
+
+        # 非常停止: 検知してから、サーボを止めるまでの時間
+        self.stat_estop = LatencyStat('estop')
+
         super().__init__(daemon=True)
 
     def end(self):
@@ -127,6 +159,19 @@ class OttoPiCtrl(threading.Thread):
 
         self._log.debug('done')
 
+    def publish_pulse(self, pulse):
+        self.state.update(pulse=pulse, ctrl_ts=time.time())
+
+    def publish(self, cmd=''):
+        if self.cmd_cb is not None:
+            self.cmd_cb(cmd)
+
+        if self.state is None:
+            return
+        self.state.update(cmd=cmd, ctrl_active=self.active,
+                          pulse=self.opm.servo.cur_pulse,
+                          ctrl_ts=time.time())
+
     def clear_cmdq(self):
         self._log.debug('')
         while not self.cmdq.empty():
@@ -144,6 +189,39 @@ class OttoPiCtrl(threading.Thread):
         self._log.warn('')
         self.opm.stop()
 
+    def estop(self, t_detect=None):
+        """
+        非常停止
+
+        他のスレッド(ToFSamplerなど)から、直接呼び出す。
+        サーボのパルス幅を、その場で固定し、estop_clear()まで動かさない。
+
+        Parameters
+        ----------
+        t_detect: float
+            検知した時刻 (time.monotonic()) 反応時間の記録用
+        """
+        self.opm.servo.halt()
+        if t_detect is not None:
+            self.stat_estop.add(time.monotonic() - t_detect)
+
+        self._log.warning('t_detect=%s', t_detect)
+
+        # 実行中の動作を抜けさせ、待っているコマンドを捨てる
+        with self._idle_lock:
+            self.opm.stop()
+            self.clear_cmdq()
+
+        self.publish(self.CMD_ESTOP)
+
+    def estop_clear(self):
+        self._log.info('')
+        self.opm.servo.clear_halt()
+        self.publish()
+
+    def is_halted(self):
+        return self.opm.servo.halted
+
     def send(self, cmd, doInterrupt=True):
         """
         cmd: "<cmd_name> <cmd_n>"
@@ -153,12 +231,26 @@ class OttoPiCtrl(threading.Thread):
         cmdline = cmd.split()
         self._log.info('cmdline=%s', cmdline)
 
-        if doInterrupt:
-            self.interrupt_loop()
-            self.clear_cmdq()
+        with self._idle_lock:
+            self.idle.clear()
+
+            if doInterrupt:
+                self.interrupt_loop()
+                self.clear_cmdq()
 
-        self.cmdq.put(self.CMD_RESUME)
-        self.cmdq.put(cmd)
+            self.cmdq.put(self.CMD_RESUME)
+            self.cmdq.put(cmd)
+
+    def wait_idle(self, timeout=None):
+        """
+        動作の完了を待つ
+
+        Returns
+        -------
+        result: bool
+            False: タイムアウト
+        """
+        return self.idle.wait(timeout)
 
     def recv(self):
         self._log.debug('')
@@ -192,6 +284,10 @@ class OttoPiCtrl(threading.Thread):
             self._log.debug('finish')
             return False
 
+        if self.is_halted() and cmd_name not in self.CMD_HALT_OK:
+            self._log.warning('\'%s\': emergency stop .. ignore', cmd_name)
+            return True
+
         # cmd_n -> n: 実行回数(0=連続実行)
         n = 1
         if cmd_n.isnumeric():
@@ -201,7 +297,9 @@ class OttoPiCtrl(threading.Thread):
         self._log.debug('n=%d', n)
 
         # コマンド実行
+        self.publish(cmd)
         self.cmd_func[cmd_name]['func'](n)
+        self.publish()
         return True
 
     def help(self, n=1):
@@ -217,6 +315,7 @@ class OttoPiCtrl(threading.Thread):
         self._log.debug('')
 
         self.active = True
+        self.publish()
         while self.active:
             # コマンドライン受信
             cmd = self.recv()
@@ -225,7 +324,12 @@ class OttoPiCtrl(threading.Thread):
             self.active = self.exec_cmd(cmd)
             self._log.debug('active=%s', self.active)
 
+            with self._idle_lock:
+                if self.cmdq.empty():
+                    self.idle.set()
+
         # スレッド終了処理
+        self.publish()
         self._log.info('done(active=%s)', self.active)
 
 
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+複数のロボットへの同時送信 (フリート)
+
+複数の OttoPiServer に、同じコマンドを同時に送る(broadcast)か、
+ロボットごとに別のコマンドを同時に送る(scatter)。
+
+ * 返信は、ロボットごとに、往復時間[ms]とエラーと一緒に返す
+ * 遅い・止まっているロボットは、timeout で打ち切る
+   (他のロボットの返信は待たせない)
+ * 接続は、ロボットごとに 1つ (AsyncOttoPiClient) を使い回す
+ * ロボットごとの往復時間の統計は、get_stat() で返す
+
+Usage:
+--
+fleet = OttoPiFleet(['robot1:12345', 'robot2:12345', 'localhost:12346'])
+result = asyncio.run(fleet.broadcast(':.happy'))
+for (robot, r) in result.items():
+    print(robot, r['ACCEPT'], r['ms'], r['ERR'])
+--
+
+-----------------------------------------------------------------
+OttoPiFleet -- 複数のロボットへの同時送信
+ |
+ +- AsyncOttoPiClient -- ロボット制御クライアント (asyncio) x ロボットの数
+     |
+     |(TCP/IP, Unix domain socket)
+     |
+OttoPiServer -- ロボット制御サーバ x ロボットの数
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiAsyncClient import AsyncOttoPiClient
+from OttoPiProto import ProtoError, reply_dict
+from LatencyStat import LatencyStat
+import asyncio
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+def parse_robot(robot, def_port=AsyncOttoPiClient.DEF_PORT):
+    """
+    'host[:port]' -> (host, port)
+    """
+    (host, sep, port) = robot.rpartition(':')
+    if sep == '':
+        return (robot, def_port)
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise ValueError('%s: invalid port' % robot)
+
+
+class OttoPiFleet:
+    DEF_ROBOT = 'localhost:%d' % AsyncOttoPiClient.DEF_PORT
+    DEF_NAME = 'fleet'
+    DEF_TIMEOUT = 2.0  # sec
+
+    def __init__(self, robots=[DEF_ROBOT], name=DEF_NAME,
+                 timeout=DEF_TIMEOUT, debug=False):
+        """
+        Parameters
+        ----------
+        robots: list of str
+            ['host[:port]', ..]
+        name: str
+            クライアント名 (サーバーのリースの調停用)
+        timeout: float
+            1回のコマンドで、1台のロボットを待つ時間 [sec] (接続を含む)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('robots=%s, name=%s, timeout=%s',
+                        robots, name, timeout)
+
+        if len(robots) == 0:
+            raise ValueError('no robot')
+
+        self.robots = list(robots)
+        self.timeout = timeout
+
+        self._client = {}
+        self._stat = {}
+        for robot in self.robots:
+            (host, port) = parse_robot(robot)
+            self._client[robot] = AsyncOttoPiClient(host, port, name=name,
+                                                    timeout=timeout,
+                                                    debug=False)
+            self._stat[robot] = {'latency': LatencyStat(robot),
+                                 'error': 0, 'timeout': 0}
+
+    async def send1(self, robot, cmd):
+        """
+        1台のロボットにコマンドを送る (エラーでも例外にしない)
+
+        Returns
+        -------
+        result: dict
+            {'CMD':.., 'ACCEPT':.., 'MSG':.., 'ms':.., 'ERR':..}
+            ERR は、接続できない・返信がないなどの場合のメッセージ
+            (返信があれば None)
+        """
+        stat = self._stat[robot]
+
+        t0 = time.perf_counter()
+        try:
+            replies = await asyncio.wait_for(
+                self._client[robot].request(cmd), self.timeout)
+        except asyncio.TimeoutError:
+            stat['timeout'] += 1
+            err = 'timeout (%s sec)' % self.timeout
+        except (OSError, ProtoError) as e:
+            stat['error'] += 1
+            err = '%s:%s' % (type(e).__name__, e)
+        else:
+            err = None
+        msec = (time.perf_counter() - t0) * 1000
+
+        if err is not None:
+            self._log.warning('%s: %s: %s', robot, cmd, err)
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': '',
+                    'ms': round(msec, 2), 'ERR': err}
+
+        if len(replies) == 0:
+            # 空のコマンド (送っていない)
+            return {'CMD': cmd, 'ACCEPT': False, 'MSG': 'empty command',
+                    'ms': round(msec, 2), 'ERR': None}
+
+        stat['latency'].add(msec / 1000)
+        result = reply_dict(replies[-1])
+        result.update({'ms': round(msec, 2), 'ERR': None})
+        self._log.debug('%s: %s', robot, result)
+        return result
+
+    async def scatter(self, cmds):
+        """
+        ロボットごとのコマンドを、同時に送る
+
+        Parameters
+        ----------
+        cmds: dict or list
+            {robot: cmd, ..} または、robots と同じ順番の [cmd, ..]
+            (None のロボットには送らない)
+
+        Returns
+        -------
+        result: {robot: send1() の結果, ..}
+        """
+        if not isinstance(cmds, dict):
+            cmds = dict(zip(self.robots, cmds))
+
+        robots = [r for r in self.robots if cmds.get(r) is not None]
+        results = await asyncio.gather(*[self.send1(r, cmds[r])
+                                         for r in robots])
+        return dict(zip(robots, results))
+
+    async def broadcast(self, cmd):
+        """
+        すべてのロボットに、同じコマンドを同時に送る
+
+        Returns
+        -------
+        result: {robot: send1() の結果, ..}
+        """
+        return await self.scatter({r: cmd for r in self.robots})
+
+    def get_stat(self):
+        """
+        Returns
+        -------
+        stat: {robot: {'latency': LatencyStat.summary(), 'error':..,
+                       'timeout':..}, ..}
+        """
+        return {r: {'latency': st['latency'].summary(),
+                    'error': st['error'],
+                    'timeout': st['timeout']}
+                for (r, st) in self._stat.items()}
+
+    async def close(self):
+        self._log.debug('')
+        await asyncio.gather(*[cl.close() for cl in self._client.values()])
+
+
+class OttoPiFleetApp:
+    def __init__(self, command, robots, scatter, name, timeout, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('command=%s, robots=%s, scatter=%s',
+                        command, robots, scatter)
+
+        self.command = command
+        self.scatter = scatter
+        self._fleet = OttoPiFleet(robots, name, timeout, debug=self._dbg)
+
+    def print_result(self, result):
+        for (robot, r) in result.items():
+            if r['ERR'] is not None:
+                print('%-22s %8.2f ms  ERR %s' % (robot, r['ms'], r['ERR']))
+            else:
+                print('%-22s %8.2f ms  %-5s %s %s' % (
+                    robot, r['ms'], r['ACCEPT'], r['CMD'], r['MSG']))
+
+    async def run(self):
+        try:
+            if self.scatter:
+                # i番目のコマンドを、i番目のロボットに
+                self.print_result(await self._fleet.scatter(self.command))
+            else:
+                for cmd in self.command:
+                    self.print_result(await self._fleet.broadcast(cmd))
+        finally:
+            await self._fleet.close()
+
+        print()
+        print('%-22s %6s %8s %8s %8s %5s %7s' % (
+            '', 'n', 'p50', 'p95', 'max', 'error', 'timeout'))
+        for (robot, st) in self._fleet.get_stat().items():
+            lat = st['latency']
+            print('%-22s %6d %8.2f %8.2f %8.2f %5d %7d' % (
+                robot, lat['n'], lat['p50'], lat['p95'], lat['max'],
+                st['error'], st['timeout']))
+
+    def main(self):
+        self._log.debug('')
+        asyncio.run(self.run())
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+send commands to several robots concurrently
+''')
+@click.argument('command', type=str, nargs=-1)
+@click.option('--robot', '-r', 'robots', type=str, multiple=True,
+              default=[OttoPiFleet.DEF_ROBOT],
+              help='robot server "host[:port]" (repeatable)')
+@click.option('--scatter', '-S', 'scatter', is_flag=True, default=False,
+              help='send i-th command to i-th robot (default: broadcast)')
+@click.option('--name', '-n', 'name', type=str, default=OttoPiFleet.DEF_NAME,
+              help='client name')
+@click.option('--timeout', '-t', 'timeout', type=float,
+              default=OttoPiFleet.DEF_TIMEOUT,
+              help='timeout per robot [sec]')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(command, robots, scatter, name, timeout, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('command=%s, robots=%s, scatter=%s, name=%s, timeout=%s',
+               command, robots, scatter, name, timeout)
+
+    app = OttoPiFleetApp(command, robots, scatter, name, timeout,
+                         debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,7 @@ __author__ = 'Yoichi Tanibayashi'
 __date__   = '2019'
 
 from flask import Flask, render_template, request
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiClientPool
 from SpeakClient import SpeakClient
 
 import netifaces
@@ -99,9 +99,9 @@ def action():
     cmd = str(request.form['cmd'])
     print(MyName + ': cmd = \'' + cmd + '\'')
 
-    rc = OttoPiClient(RobotHost, RobotPort)
-    ret = rc.send_cmd(cmd)
-    rc.close()
+    # リクエストごとに接続しないで、プールの接続を使い回す
+    pool = OttoPiClientPool.shared(RobotHost, RobotPort)
+    ret = pool.send_cmd(cmd, name='http:%s' % request.remote_addr)
 
     return ''
     
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+動作の権利 (リース) の調停
+
+複数のクライアント(Web, BLE, ボタンなど)が、お互いの動作を
+割り込みで中断し合わないように、動作コマンドを送れるクライアントを
+1つ(holder)に限る。
+
+ * 動作コマンドを送ると、リースが空いて(期限切れを含む)いれば取得し、
+   自分が holder なら期限を延ばす
+ * holder 以外の動作コマンドは、mode により
+   - reject: 受け付けない (読み取り専用)
+   - queue:  割り込みなしで、キューに入れる (実行中の動作を止めない)
+ * 停止・緊急停止・自動運転の停止は、いつでも誰でも送れる
+   (OttoPiDispatcher.CMD_ALWAYS)
+ * lease_sec = 0 なら、調停しない
+
+クライアントごとに、コマンド数、拒否・キューに回した数、
+割り込みで他のクライアントの動作を止めた数(preempt)、
+止められた数(preempted)を数える。
+
+-----------------------------------------------------------------
+OttoPiDispatcher -- コマンドの解釈と実行
+ |
+ +- OttoPiLease -- 動作の権利の調停
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+import time
+
+from MyLogger import get_logger
+
+
+class OttoPiLease:
+    DEF_LEASE_SEC = 10.0
+
+    MODE_REJECT = 'reject'
+    MODE_QUEUE = 'queue'
+    MODES = (MODE_REJECT, MODE_QUEUE)
+    DEF_MODE = MODE_REJECT
+
+    # check() の結果
+    OK = 'ok'
+    QUEUE = 'queue'
+    DENY = 'deny'
+
+    STAT_KEYS = ('cmd', 'denied', 'queued', 'preempt', 'preempted')
+
+    def __init__(self, lease_sec=DEF_LEASE_SEC, mode=DEF_MODE,
+                 clock=time.monotonic, debug=False):
+        """
+        Parameters
+        ----------
+        lease_sec: float
+            リースの期間 [sec] (動作コマンドごとに延長)。0 なら調停しない
+        mode: str
+            holder 以外の動作コマンドの扱い (MODES)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('lease_sec=%s, mode=%s', lease_sec, mode)
+
+        if mode not in self.MODES:
+            raise ValueError('%s: invalid mode' % mode)
+
+        self.lease_sec = lease_sec
+        self.mode = mode
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self.holder = None
+        self.expire = 0.0
+
+        self.stat = {}
+
+    def _count(self, client, key):
+        if client not in self.stat:
+            self.stat[client] = {k: 0 for k in self.STAT_KEYS}
+        self.stat[client][key] += 1
+
+    def _acquire(self, client, now):
+        if self.holder not in (None, client) and now < self.expire:
+            return False
+
+        if self.holder != client:
+            self._log.info('holder: %s -> %s', self.holder, client)
+        self.holder = client
+        self.expire = now + self.lease_sec
+        return True
+
+    def remain(self):
+        """
+        Returns
+        -------
+        sec: float
+            リースの残り時間 (holder がいなければ 0)
+        """
+        with self._lock:
+            if self.holder is None:
+                return 0.0
+            return max(self.expire - self._clock(), 0.0)
+
+    def acquire(self, client):
+        """
+        リースを取得・延長する (":lease")
+
+        Returns
+        -------
+        ok: bool
+        """
+        with self._lock:
+            return self._acquire(client, self._clock())
+
+    def release(self, client):
+        """
+        リースを手放す (":release")
+
+        Returns
+        -------
+        ok: bool
+            holder でなければ False
+        """
+        with self._lock:
+            if self.holder != client:
+                return False
+            self.holder = None
+            self.expire = 0.0
+            return True
+
+    def check(self, client):
+        """
+        動作コマンドを送ってよいか (コマンド数も数える)
+
+        Returns
+        -------
+        result: str
+            OK, QUEUE, DENY
+        """
+        with self._lock:
+            self._count(client, 'cmd')
+
+            if self.lease_sec <= 0:
+                return self.OK
+            if self._acquire(client, self._clock()):
+                return self.OK
+
+            if self.mode == self.MODE_QUEUE:
+                self._count(client, 'queued')
+                return self.QUEUE
+
+            self._count(client, 'denied')
+            return self.DENY
+
+    def count_cmd(self, client):
+        """
+        調停しないコマンド (緊急停止など) を数える
+        """
+        with self._lock:
+            self._count(client, 'cmd')
+
+    def preempt(self, client, victim):
+        """
+        client の割り込みで、victim の動作が中断された
+        """
+        self._log.debug('%s -> %s', client, victim)
+        with self._lock:
+            self._count(client, 'preempt')
+            self._count(victim, 'preempted')
+
+    def get_stat(self):
+        with self._lock:
+            return {'lease_sec': self.lease_sec,
+                    'mode': self.mode,
+                    'holder': self.holder,
+                    'remain': round(max(self.expire - self._clock(), 0.0)
+                                    if self.holder is not None else 0.0, 1),
+                    'clients': {c: dict(st) for (c, st) in self.stat.items()}}
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiServer までの往復時間の比較 (TCP と Unix ドメインソケット)
+
+同じPi上で、ロボットを動かさないコマンド(":server_stat")を送り、
+返信までの時間を測る。
+
+ * persist: 1つの接続で、続けて送る
+ * connect: コマンドごとに接続する (従来のブリッジの使い方)
+            接続、READY の受信を含む
+
+-----------------------------------------------------------------
+OttoPiLinkBench -- 往復時間の比較
+ |
+ |(TCP/IP, Unix domain socket)
+ |
+OttoPiServer -- ロボット制御サーバ
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiServer import OttoPiServer, unix_path
+from OttoPiProto import READY, encode_request
+from LatencyStat import LatencyStat
+import socket
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class OttoPiLinkBench:
+    DEF_HOST = 'localhost'
+    DEF_PORT = OttoPiServer.DEF_PORT
+    DEF_N = 1000
+
+    CMD = ':server_stat'
+    TRANSPORT = ('tcp', 'unix')
+    PATTERN = ('persist', 'connect')
+
+    RECV_SIZE = 4096
+
+    def __init__(self, host=DEF_HOST, port=DEF_PORT, n=DEF_N, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('host=%s, port=%s, n=%s', host, port, n)
+
+        self.host = host
+        self.port = port
+        self.n = n
+
+    def connect(self, transport):
+        """
+        接続して、READY を読む
+        """
+        if transport == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(unix_path(self.port))
+        else:
+            sock = socket.create_connection((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+        buf = b''
+        while not buf.endswith(READY):
+            in_data = sock.recv(self.RECV_SIZE)
+            if len(in_data) == 0:
+                raise ConnectionError('disconnected')
+            buf += in_data
+        return sock
+
+    def request(self, sock, req_id):
+        sock.sendall(encode_request(req_id, self.CMD))
+
+        buf = b''
+        while not buf.endswith(b'\n'):
+            in_data = sock.recv(self.RECV_SIZE)
+            if len(in_data) == 0:
+                raise ConnectionError('disconnected')
+            buf += in_data
+
+    def run1(self, transport, pattern):
+        stat = LatencyStat('%s/%s' % (transport, pattern), self.n)
+
+        sock = None
+        if pattern == 'persist':
+            sock = self.connect(transport)
+
+        for i in range(self.n):
+            t0 = time.perf_counter()
+            if pattern == 'connect':
+                sock = self.connect(transport)
+
+            self.request(sock, i)
+
+            if pattern == 'connect':
+                sock.close()
+            stat.add(time.perf_counter() - t0)
+
+        if pattern == 'persist':
+            sock.close()
+
+        return stat.summary()
+
+    def run(self):
+        """
+        Returns
+        -------
+        result: {(transport, pattern): LatencyStat.summary(), ..}
+            Unix ドメインソケットがない場合は、tcp だけ
+        """
+        result = {}
+        for transport in self.TRANSPORT:
+            for pattern in self.PATTERN:
+                try:
+                    result[(transport, pattern)] = self.run1(transport,
+                                                             pattern)
+                except OSError as e:
+                    self._log.warning('%s/%s: %s:%s', transport, pattern,
+                                      type(e).__name__, e)
+                    break
+        return result
+
+
+class OttoPiLinkBenchApp:
+    def __init__(self, host, port, n, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('host=%s, port=%s, n=%s', host, port, n)
+
+        self._bench = OttoPiLinkBench(host, port, n, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        result = self._bench.run()
+
+        print('%-14s %8s %8s %8s %8s  [ms]' % (
+            '', 'mean', 'p50', 'p95', 'p99'))
+        for ((transport, pattern), st) in result.items():
+            print('%-14s %8.3f %8.3f %8.3f %8.3f' % (
+                '%s/%s' % (transport, pattern),
+                st['mean'], st['p50'], st['p95'], st['p99']))
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+compare round trip time to OttoPiServer: TCP vs unix domain socket
+''')
+@click.option('--svr_host', '-s', 'host', type=str,
+              default=OttoPiLinkBench.DEF_HOST,
+              help='server hostname (TCP)')
+@click.option('--svr_port', '-p', 'port', type=int,
+              default=OttoPiLinkBench.DEF_PORT,
+              help='server port number')
+@click.option('--count', '-n', 'n', type=int, default=OttoPiLinkBench.DEF_N,
+              help='requests per case')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(host, port, n, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('host=%s, port=%s, n=%s', host, port, n)
+
+    app = OttoPiLinkBenchApp(host, port, n, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
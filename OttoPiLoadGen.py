@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiServer の負荷試験
+
+N本の接続を同時に開き、コマンドの組み合わせ(mix)を、目標のレートで
+送り続ける。スループットと、返信までの時間(p50/p95/p99)を表示する。
+ファームウェアを更新する前の、性能の回帰チェックに使う。
+
+ * mix: 種類=重み をカンマで区切る (ex. 'poll=6,key=2,cmd=2')
+   - key:  短縮文字 1文字 (OttoPiDispatcher.CMD_KEY からランダム)
+   - cmd:  ":動作" (OttoPiDispatcher.CMD_KEY の動作からランダム)
+   - poll: ":.auto_null" (距離の読み出し)
+   - それ以外は、そのままコマンドとして送る (ex. ':server_stat=1')
+ * rate: 全接続の合計 [req/s]。0 なら、各接続で返信が来たらすぐに次を送る
+   (接続ごとに、待っている返信は 1つだけ)
+ * 接続ごとに別のクライアント名(name0, name1, ..)を使うので、
+   動作コマンドはリースの調停を受ける (拒否された数は rejected)
+ * --sim thread|async: シミュレーション(OttoPiSim)のサーバーを起動して、
+   それに対して試験する (Raspberry Pi のない Linux でも動く)
+
+クライアント側も 1つのイベントループなので、接続数が多い場合は、
+クライアント側の遅れも時間に含まれる。
+
+-----------------------------------------------------------------
+OttoPiLoadGen -- 負荷試験
+ |
+ +- AsyncOttoPiClient -- ロボット制御クライアント (asyncio) x 接続数
+     |
+     |(TCP/IP, Unix domain socket)
+     |
+OttoPiServer or OttoPiAsyncServer (--sim)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from OttoPiAsyncClient import AsyncOttoPiClient
+from OttoPiServer import OttoPiDispatcher
+from OttoPiCtrl import OttoPiCtrl
+from OttoPiProto import ProtoError, READY
+from LatencyStat import LatencyStat
+import subprocess
+import asyncio
+import socket
+import random
+import signal
+import time
+import sys
+import os
+
+from MyLogger import get_logger, ERROR
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+def parse_mix(mix):
+    """
+    'poll=6,key=2,cmd=2' -> [('poll', 6.0), ('key', 2.0), ('cmd', 2.0)]
+    """
+    result = []
+    for item in mix.split(','):
+        (kind, sep, weight) = item.rpartition('=')
+        if sep == '' or kind == '':
+            raise ValueError('%s: need "kind=weight"' % item)
+        result.append((kind, float(weight)))
+    return result
+
+
+class OttoPiLoadGen:
+    DEF_HOST = AsyncOttoPiClient.DEF_HOST
+    DEF_PORT = AsyncOttoPiClient.DEF_PORT
+    DEF_CONNS = 5
+    DEF_RATE = 50.0     # req/s (全接続の合計)
+    DEF_SEC = 10.0
+    DEF_MIX = 'poll=6,key=2,cmd=2'
+    DEF_NAME = 'load'
+    DEF_TIMEOUT = 2.0   # sec
+
+    KIND_KEY = 'key'
+    KIND_CMD = 'cmd'
+    KIND_POLL = 'poll'
+    CMD_POLL = ':.auto_null'
+
+    # 制御スレッドの終了(CMD_END)は送らない
+    KEYS = sorted([k for (k, v) in OttoPiDispatcher.CMD_KEY.items()
+                   if v != OttoPiCtrl.CMD_END])
+    WORDS = sorted(set([v for v in OttoPiDispatcher.CMD_KEY.values()
+                        if v != OttoPiCtrl.CMD_END]))
+
+    # 1種類あたりに保持する時間の数 (パーセンタイル用)
+    STAT_SIZE = 1000000
+
+    def __init__(self, host=DEF_HOST, port=DEF_PORT, conns=DEF_CONNS,
+                 rate=DEF_RATE, sec=DEF_SEC, mix=DEF_MIX, name=DEF_NAME,
+                 binary=False, timeout=DEF_TIMEOUT, seed=None, debug=False):
+        """
+        Parameters
+        ----------
+        conns: int
+            接続数
+        rate: float
+            目標のリクエスト数 [req/s] (全接続の合計、0: 待たずに送る)
+        sec: float
+            試験時間 [sec]
+        mix: str
+            コマンドの組み合わせ (parse_mix())
+        name: str
+            クライアント名の接頭辞 (接続ごとに name0, name1, ..)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('host=%s, port=%s, conns=%s, rate=%s, sec=%s',
+                        host, port, conns, rate, sec)
+        self._log.debug('mix=%s, name=%s, binary=%s, timeout=%s, seed=%s',
+                        mix, name, binary, timeout, seed)
+
+        self.host = host
+        self.port = port
+        self.conns = conns
+        self.rate = rate
+        self.sec = sec
+        self.name = name
+        self.binary = binary
+        self.timeout = timeout
+
+        self.mix = parse_mix(mix)
+        self._kinds = [k for (k, w) in self.mix]
+        self._weights = [w for (k, w) in self.mix]
+        self._rand = random.Random(seed)
+
+        self.stat = {}
+        for kind in self._kinds + ['total']:
+            self.stat[kind] = {'latency': LatencyStat(kind, self.STAT_SIZE),
+                               'sent': 0, 'ok': 0, 'rejected': 0,
+                               'error': 0, 'timeout': 0}
+        self.elapsed = 0.0
+        self.server_stat = None
+
+    def pick(self):
+        """
+        Returns
+        -------
+        (kind, cmd): (str, str)
+        """
+        kind = self._rand.choices(self._kinds, self._weights)[0]
+        if kind == self.KIND_KEY:
+            return (kind, self._rand.choice(self.KEYS))
+        if kind == self.KIND_CMD:
+            return (kind, ':' + self._rand.choice(self.WORDS))
+        if kind == self.KIND_POLL:
+            return (kind, self.CMD_POLL)
+        return (kind, kind)
+
+    def count(self, kind, key, sec=None):
+        for k in (kind, 'total'):
+            self.stat[k][key] += 1
+            if sec is not None:
+                self.stat[k]['latency'].add(sec)
+
+    async def send1(self, cl, kind, cmd):
+        self.count(kind, 'sent')
+
+        t0 = time.perf_counter()
+        try:
+            replies = await asyncio.wait_for(cl.request(cmd), self.timeout)
+        except asyncio.TimeoutError:
+            self.count(kind, 'timeout')
+            return
+        except (OSError, ProtoError) as e:
+            self._log.debug('%s: %s:%s', cmd, type(e).__name__, e)
+            self.count(kind, 'error')
+            # 接続できない場合に、空回りしないように
+            await asyncio.sleep(0.1)
+            return
+        sec = time.perf_counter() - t0
+
+        if replies[-1].get('ACCEPT', False):
+            self.count(kind, 'ok', sec)
+        else:
+            self.count(kind, 'rejected', sec)
+
+    async def worker(self, i, t_start, t_end):
+        # 切断などは数えるので、1つずつの警告は出さない
+        cl = AsyncOttoPiClient(self.host, self.port, binary=self.binary,
+                               name='%s%d' % (self.name, i),
+                               timeout=self.timeout,
+                               debug=self._dbg or ERROR)
+
+        interval = self.conns / self.rate if self.rate > 0 else 0
+        # 接続ごとに、送る時刻をずらす
+        t_next = t_start + interval * i / self.conns
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= t_end:
+                    break
+                if interval > 0:
+                    if t_next > now:
+                        await asyncio.sleep(t_next - now)
+                    # 遅れた分は、まとめて送らない
+                    t_next = max(t_next + interval, time.monotonic())
+
+                (kind, cmd) = self.pick()
+                await self.send1(cl, kind, cmd)
+        finally:
+            await cl.close()
+
+    async def get_server_stat(self, delay):
+        """
+        試験の途中(delay 秒後)の、サーバーの接続数など
+        """
+        await asyncio.sleep(delay)
+
+        cl = AsyncOttoPiClient(self.host, self.port, timeout=self.timeout,
+                               debug=self._dbg or ERROR)
+        try:
+            ret = await cl.send_cmd(':server_stat')
+        finally:
+            await cl.close()
+        self.server_stat = ret['MSG'] if ret['ACCEPT'] else None
+
+    async def run_async(self):
+        t_start = time.monotonic()
+        t_end = t_start + self.sec
+        await asyncio.gather(self.get_server_stat(self.sec / 2),
+                             *[self.worker(i, t_start, t_end)
+                               for i in range(self.conns)])
+        self.elapsed = time.monotonic() - t_start
+
+    def run(self):
+        """
+        Returns
+        -------
+        result: dict
+            {'elapsed':.., 'throughput':.., 'target':..,
+             'kind': {kind: {'sent':.., 'ok':.., 'rejected':.., 'error':..,
+                             'timeout':.., 'latency': LatencyStat.summary()}},
+             'server': ":server_stat" の返信}
+        """
+        asyncio.run(self.run_async())
+
+        replied = self.stat['total']['ok'] + self.stat['total']['rejected']
+        kind = {}
+        for (k, st) in self.stat.items():
+            kind[k] = dict(st)
+            kind[k]['latency'] = st['latency'].summary()
+
+        return {'elapsed': round(self.elapsed, 2),
+                'throughput': round(replied / self.elapsed, 1),
+                'target': self.rate,
+                'kind': kind,
+                'server': self.server_stat}
+
+
+class SimServer:
+    """
+    シミュレーションのサーバー (OttoPiServer --sim) を、別プロセスで起動する
+
+    設定ファイル(OttoPi.conf)がなければ、サーバーが OttoPi.conf-sample を
+    使う (OttoPiDispatcher(sim=True))。
+    """
+    SCRIPT = {'thread': 'OttoPiServer.py', 'async': 'OttoPiAsyncServer.py'}
+    START_SEC = 15.0
+
+    def __init__(self, kind, port, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('kind=%s, port=%s', kind, port)
+
+        self.kind = kind
+        self.port = port
+        self._proc = None
+
+    def start(self):
+        mydir = os.path.dirname(os.path.abspath(__file__))
+
+        cmdline = [sys.executable, os.path.join(mydir, self.SCRIPT[self.kind]),
+                   '--sim', str(self.port)]
+        self._log.info('%s', ' '.join(cmdline))
+        out = None if self._dbg else subprocess.DEVNULL
+        self._proc = subprocess.Popen(cmdline, stdout=out, stderr=out)
+
+        # READY が返るまで待つ
+        # (TCP は先に bind するので、接続できても、まだ準備中のことがある)
+        t_end = time.monotonic() + self.START_SEC
+        while time.monotonic() < t_end:
+            if self._proc.poll() is not None:
+                raise RuntimeError('%s: exit %s' % (
+                    self.SCRIPT[self.kind], self._proc.returncode))
+            try:
+                with socket.create_connection(('localhost', self.port),
+                                              1) as sock:
+                    sock.settimeout(max(t_end - time.monotonic(), 0.1))
+                    if sock.recv(len(READY)) == READY:
+                        return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise TimeoutError('%s: not ready' % self.SCRIPT[self.kind])
+
+    def stop(self):
+        self._log.debug('')
+        if self._proc is not None:
+            # Ctrl-C と同じく、end() で後始末させる
+            self._proc.send_signal(signal.SIGINT)
+            try:
+                self._proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self._log.warning('kill')
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+
+
+class OttoPiLoadGenApp:
+    def __init__(self, host, port, conns, rate, sec, mix, name, binary,
+                 timeout, seed, sim, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('host=%s, port=%s, conns=%s, rate=%s, sec=%s',
+                        host, port, conns, rate, sec)
+        self._log.debug('mix=%s, name=%s, binary=%s, timeout=%s, seed=%s',
+                        mix, name, binary, timeout, seed)
+        self._log.debug('sim=%s', sim)
+
+        self._sim = None
+        if sim is not None:
+            host = 'localhost'
+            self._sim = SimServer(sim, port, debug=self._dbg)
+
+        self._gen = OttoPiLoadGen(host, port, conns, rate, sec, mix, name,
+                                  binary, timeout, seed, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        if self._sim is not None:
+            self._sim.start()
+
+        result = self._gen.run()
+
+        print('%-14s %7s %7s %8s %6s %7s %8s %8s %8s %8s  [ms]' % (
+            '', 'sent', 'ok', 'rejected', 'error', 'timeout',
+            'p50', 'p95', 'p99', 'max'))
+        for (kind, r) in result['kind'].items():
+            lat = r['latency']
+            print('%-14s %7d %7d %8d %6d %7d %8.2f %8.2f %8.2f %8.2f' % (
+                kind, r['sent'], r['ok'], r['rejected'], r['error'],
+                r['timeout'], lat['p50'], lat['p95'], lat['p99'],
+                lat['max']))
+        print()
+        print('throughput: %.1f req/s (target: %s, %d conns, %.1f sec)' % (
+            result['throughput'],
+            result['target'] if result['target'] > 0 else 'max',
+            self._gen.conns, result['elapsed']))
+        print('server: %s' % result['server'])
+
+    def end(self):
+        self._log.debug('')
+        if self._sim is not None:
+            self._sim.stop()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+load generator for OttoPiServer
+''')
+@click.option('--svr_host', '-s', 'host', type=str,
+              default=OttoPiLoadGen.DEF_HOST,
+              help='server hostname')
+@click.option('--svr_port', '-p', 'port', type=int,
+              default=OttoPiLoadGen.DEF_PORT,
+              help='server port number')
+@click.option('--conns', '-c', 'conns', type=int,
+              default=OttoPiLoadGen.DEF_CONNS,
+              help='concurrent connections')
+@click.option('--rate', '-r', 'rate', type=float,
+              default=OttoPiLoadGen.DEF_RATE,
+              help='target requests/sec in total (0: as fast as possible)')
+@click.option('--sec', '-t', 'sec', type=float, default=OttoPiLoadGen.DEF_SEC,
+              help='duration [sec]')
+@click.option('--mix', '-m', 'mix', type=str, default=OttoPiLoadGen.DEF_MIX,
+              help='command mix "kind=weight,.." (kind: key, cmd, poll, '
+              'or a literal command)')
+@click.option('--name', '-n', 'name', type=str,
+              default=OttoPiLoadGen.DEF_NAME,
+              help='client name prefix')
+@click.option('--binary', '-b', 'binary', is_flag=True, default=False,
+              help='binary encoding')
+@click.option('--timeout', '-T', 'timeout', type=float,
+              default=OttoPiLoadGen.DEF_TIMEOUT,
+              help='reply timeout [sec]')
+@click.option('--seed', 'seed', type=int, default=None,
+              help='random seed of command mix')
+@click.option('--sim', 'sim', type=click.Choice(list(SimServer.SCRIPT)),
+              default=None,
+              help='start a simulated server (no hardware) on svr_port')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(host, port, conns, rate, sec, mix, name, binary, timeout, seed, sim,
+         debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('host=%s, port=%s, conns=%s, rate=%s, sec=%s',
+               host, port, conns, rate, sec)
+    _log.debug('mix=%s, name=%s, binary=%s, timeout=%s, seed=%s, sim=%s',
+               mix, name, binary, timeout, seed, sim)
+
+    app = OttoPiLoadGenApp(host, port, conns, rate, sec, mix, name, binary,
+                           timeout, seed, sim, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
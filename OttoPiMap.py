@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+自動運転用の簡易地図 (占有格子地図)
+
+OttoPiCtrlが実行したコマンドから、自己位置(x, y, 向き)を推定し(デッドレコニング)、
+距離センサーの値を、格子地図(NumPy配列)に書き込む。
+
+ * 格子の値は対数オッズ (正: 障害物, 負: 空き, 0: 未知)
+ * センサーからの光線上のセルは「空き」、測定点は「障害物」
+ * 訪問回数も記録する
+
+plan()で、障害物がなく、まだ調べていない(未知のセルが多い)方向を選ぶ。
+
+get_stat()の 'area_per_min' (調べた面積 [m^2/min]) で、探索の効率を評価できる。
+
+記録したトレース(テキスト)を再生して、地図を作ることもできる。
+
+  <ts> cmd <cmd>
+  <ts> d <mm> [<mm_left> <mm_right>]
+
+-----------------------------------------------------------------
+OttoPiAuto -- ロボットの自動運転
+ |
+ +- OttoPiMap -- 占有格子地図
+ |   |
+ |   +- DeadReckoning -- コマンドからの自己位置推定
+ |   +- OccupancyGrid -- 格子地図
+ |
+ +- OttoPiCtrl -- コマンド制御 (cmd_cb で OttoPiMap に通知)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import math
+import threading
+import time
+import numpy as np
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class DeadReckoning:
+    """
+    実行中のコマンドと経過時間から、自己位置を積算する
+
+    x, y [mm], th [rad] (0: 開始時の正面, 反時計回りが正)
+    """
+    # コマンド: (前進 [mm/sec], 左 [mm/sec], 回転 [rad/sec])
+    MOTION = {
+        'forward':        (40, 0, 0),
+        'backward':       (-30, 0, 0),
+        'right_forward':  (35, 0, -math.radians(5)),
+        'left_forward':   (35, 0, math.radians(5)),
+        'right_backward': (-25, 0, math.radians(5)),
+        'left_backward':  (-25, 0, -math.radians(5)),
+        'suriashi_fwd':   (20, 0, 0),
+        'turn_right':     (0, 0, -math.radians(20)),
+        'turn_left':      (0, 0, math.radians(20)),
+        'slide_right':    (0, -25, 0),
+        'slide_left':     (0, 25, 0),
+    }
+
+    def __init__(self, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+
+        self.motion = dict(self.MOTION)
+
+        self.x = 0.0
+        self.y = 0.0
+        self.th = 0.0
+
+        self.cmd = ''
+        self.ts = None
+
+    def set_speed(self, cmd, v):
+        """
+        前進速度を、実測値で補正する
+        """
+        (v0, s0, w0) = self.motion[cmd]
+        self.motion[cmd] = (math.copysign(v, v0), s0, w0)
+
+    def advance(self, ts):
+        """
+        ts までの移動を積算する
+        """
+        if self.ts is None:
+            self.ts = ts
+            return
+
+        dt = ts - self.ts
+        self.ts = ts
+        if dt <= 0 or self.cmd not in self.motion:
+            return
+
+        (v, s, w) = self.motion[self.cmd]
+
+        # 回転の中間の向きで、移動量を計算する
+        th = self.th + w * dt / 2
+        self.x += (v * math.cos(th) - s * math.sin(th)) * dt
+        self.y += (v * math.sin(th) + s * math.cos(th)) * dt
+        self.th = math.atan2(math.sin(self.th + w * dt),
+                             math.cos(self.th + w * dt))
+
+    def set_cmd(self, cmd, ts):
+        """
+        cmd: 実行を開始したコマンド ('': 停止)
+        """
+        self.advance(ts)
+        self.cmd = cmd.split()[0] if len(cmd.split()) > 0 else ''
+
+    def pose(self):
+        return (self.x, self.y, self.th)
+
+
+class OccupancyGrid:
+    """
+    対数オッズの格子地図
+
+    原点(0, 0)が中央のセル
+    """
+    DEF_SIZE = 6000   # mm (一辺)
+    DEF_CELL = 50     # mm
+
+    L_OCC  = 0.9
+    L_FREE = -0.4
+    L_MIN  = -4.0
+    L_MAX  = 4.0
+
+    # これ以上(以下)なら、障害物(空き)とみなす
+    L_OCC_TH  = 0.5
+    L_FREE_TH = -0.2
+
+    def __init__(self, size=DEF_SIZE, cell=DEF_CELL, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('size=%s, cell=%s', size, cell)
+
+        self.cell = cell
+        self.n = int(size // cell)
+        self.logodds = np.zeros((self.n, self.n), dtype=np.float32)
+        self.visit = np.zeros((self.n, self.n), dtype=np.uint16)
+
+    def index(self, x, y):
+        """
+        座標 [mm] (配列可) を、セルの添字に変換する
+        """
+        ix = np.floor(np.asarray(x) / self.cell).astype(int) + self.n // 2
+        iy = np.floor(np.asarray(y) / self.cell).astype(int) + self.n // 2
+        return (ix, iy)
+
+    def inside(self, ix, iy):
+        return (ix >= 0) & (ix < self.n) & (iy >= 0) & (iy < self.n)
+
+    def ray(self, x, y, th, d):
+        """
+        (x, y)から th の向きに d [mm] までのセル (重複なし, 近い順)
+        """
+        r = np.arange(0, d, self.cell / 2)
+        (ix, iy) = self.index(x + r * math.cos(th), y + r * math.sin(th))
+        ok = self.inside(ix, iy)
+        (ix, iy) = (ix[ok], iy[ok])
+        if len(ix) == 0:
+            return (ix, iy)
+
+        # 連続する重複を除く (順序は保つ)
+        keep = np.ones(len(ix), dtype=bool)
+        keep[1:] = (ix[1:] != ix[:-1]) | (iy[1:] != iy[:-1])
+        return (ix[keep], iy[keep])
+
+    def update(self, x, y, th, d, d_max):
+        """
+        1本の測定値を書き込む
+
+        d >= d_max の場合は、d_max まで空きとする
+        """
+        if d <= 0:
+            return
+
+        # 測定点のセルは、空きにしない
+        hit = d < d_max
+        (ix, iy) = self.ray(x, y, th, d - self.cell if hit else d_max)
+        self.logodds[ix, iy] = np.maximum(self.logodds[ix, iy] + self.L_FREE,
+                                          self.L_MIN)
+
+        if hit:
+            (hx, hy) = self.index(x + d * math.cos(th), y + d * math.sin(th))
+            if self.inside(hx, hy):
+                self.logodds[hx, hy] = min(self.logodds[hx, hy] + self.L_OCC,
+                                           self.L_MAX)
+
+    def add_visit(self, x, y):
+        (ix, iy) = self.index(x, y)
+        if self.inside(ix, iy) and self.visit[ix, iy] < 0xffff:
+            self.visit[ix, iy] += 1
+
+    def known_area(self):
+        """
+        調べたセルの面積 [m^2]
+        """
+        known = np.count_nonzero(
+            (self.logodds >= self.L_OCC_TH) | (self.logodds <= self.L_FREE_TH))
+        return float(known * (self.cell / 1000) ** 2)
+
+    def to_str(self, pose=None):
+        """
+        テキスト表示 ('#': 障害物, '.': 空き, ' ': 未知, '@': 自分)
+        上が +x (開始時の正面)
+        """
+        ch = np.full(self.logodds.shape, ' ')
+        ch[self.logodds <= self.L_FREE_TH] = '.'
+        ch[self.logodds >= self.L_OCC_TH] = '#'
+        if pose is not None:
+            (ix, iy) = self.index(pose[0], pose[1])
+            if self.inside(ix, iy):
+                ch[ix, iy] = '@'
+
+        # 行: x (大きい方が上), 列: y (大きい方が左)
+        rows = [''.join(ch[ix, ::-1]) for ix in range(self.n - 1, -1, -1)]
+        return '\n'.join([r.rstrip() for r in rows])
+
+
+class OttoPiMap:
+    """
+    自己位置推定 + 格子地図 + 進む方向の選択
+    """
+    # センサーの向き [rad] (正面からの角度, 左が正)
+    SENSOR_ANGLE = {
+        'center': 0.0,
+        'left':   math.radians(45),
+        'right':  -math.radians(45),
+    }
+
+    DEF_D_MAX = 1500   # mm: これより遠い値は、ここまで空きとする
+
+    # plan()で調べる方向と距離
+    PLAN_DIR_N  = 12
+    PLAN_D_LOOK = 1000  # mm
+    PLAN_D_CLEAR = 300  # mm: この距離以内に障害物がある方向は選ばない
+
+    def __init__(self, size=OccupancyGrid.DEF_SIZE,
+                 cell=OccupancyGrid.DEF_CELL, d_max=DEF_D_MAX,
+                 clock=time.monotonic, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('size=%s, cell=%s, d_max=%s', size, cell, d_max)
+
+        self._clock = clock
+        self.d_max = d_max
+
+        self.dr = DeadReckoning(debug=self._dbg)
+        self.grid = OccupancyGrid(size, cell, debug=self._dbg)
+
+        # コマンドは OttoPiCtrl のスレッドから通知される
+        self._lock = threading.Lock()
+
+        self.ts_start = None
+        self.ts_last = None
+        self.sample_count = 0
+
+    def on_cmd(self, cmd, ts=None):
+        """
+        OttoPiCtrl.cmd_cb
+
+        cmd: 実行を開始したコマンド ('': 終了)
+        """
+        if ts is None:
+            ts = self._clock()
+
+        with self._lock:
+            self.dr.set_cmd(cmd, ts)
+
+    def set_speed(self, cmd, v):
+        with self._lock:
+            self.dr.set_speed(cmd, v)
+
+    def add_sample(self, ts, mm):
+        """
+        Parameters
+        ----------
+        ts: float
+            タイムスタンプ
+        mm: dict
+            {sensor name: distance [mm]}
+        """
+        with self._lock:
+            self.dr.advance(ts)
+            (x, y, th) = self.dr.pose()
+
+            for (name, d) in mm.items():
+                if name not in self.SENSOR_ANGLE:
+                    continue
+                self.grid.update(x, y, th + self.SENSOR_ANGLE[name], d,
+                                 self.d_max)
+            self.grid.add_visit(x, y)
+
+            if self.ts_start is None:
+                self.ts_start = ts
+            self.ts_last = ts
+            self.sample_count += 1
+
+    def pose(self):
+        with self._lock:
+            return self.dr.pose()
+
+    def plan(self):
+        """
+        障害物がなく、未知のセルが多く、訪問が少ない方向を選ぶ
+
+        Returns
+        -------
+        angle: float
+            正面からの角度 [rad] (左が正)
+            進める方向がない場合は None
+        """
+        with self._lock:
+            (x, y, th) = self.dr.pose()
+
+            best = None
+            best_score = None
+            for i in range(self.PLAN_DIR_N):
+                a = math.pi * 2 * i / self.PLAN_DIR_N
+                if a > math.pi:
+                    a -= math.pi * 2
+
+                (ix, iy) = self.grid.ray(x, y, th + a, self.PLAN_D_LOOK)
+                if len(ix) == 0:
+                    continue
+
+                lo = self.grid.logodds[ix, iy]
+                occ = np.nonzero(lo >= self.grid.L_OCC_TH)[0]
+                if len(occ) > 0 and \
+                   occ[0] * self.grid.cell < self.PLAN_D_CLEAR:
+                    continue
+
+                unknown = np.count_nonzero(
+                    (lo > self.grid.L_FREE_TH) & (lo < self.grid.L_OCC_TH))
+                visit = int(np.sum(self.grid.visit[ix, iy]))
+
+                # 同点なら、回転が少ない方
+                score = (unknown - visit * 0.1, -abs(a))
+                if best_score is None or score > best_score:
+                    (best, best_score) = (a, score)
+
+        self._log.debug('best=%s, score=%s', best, best_score)
+        return best
+
+    def get_stat(self):
+        with self._lock:
+            area = self.grid.known_area()
+            (x, y, th) = self.dr.pose()
+
+            area_per_min = 0.0
+            if self.ts_start is not None and self.ts_last > self.ts_start:
+                area_per_min = area / ((self.ts_last - self.ts_start) / 60)
+
+        return {'area': round(area, 3),
+                'area_per_min': round(area_per_min, 3),
+                'pose': (round(x), round(y), round(math.degrees(th))),
+                'samples': self.sample_count}
+
+    def replay(self, lines):
+        """
+        トレース(テキスト)を再生する
+
+          <ts> cmd <cmd>
+          <ts> d <mm> [<mm_left> <mm_right>]
+        """
+        for line in lines:
+            f = line.split()
+            if len(f) < 2 or f[0].startswith('#'):
+                continue
+
+            ts = float(f[0])
+            if f[1] == 'cmd':
+                self.on_cmd(' '.join(f[2:]), ts)
+            elif f[1] == 'd':
+                names = ['center', 'left', 'right']
+                self.add_sample(ts, dict(zip(names, [int(v) for v in f[2:]])))
+
+
+class OttoPiMapApp:
+    def __init__(self, trace_file, show, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('trace_file=%s, show=%s', trace_file, show)
+
+        self._trace_file = trace_file
+        self._show = show
+        self._map = OttoPiMap(debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        with open(self._trace_file) as f:
+            self._map.replay(f)
+
+        if self._show:
+            print(self._map.grid.to_str(self._map.pose()))
+
+        print(self._map.get_stat())
+
+        a = self._map.plan()
+        if a is not None:
+            print('plan: %d deg' % round(math.degrees(a)))
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+build occupancy grid from trace file
+''')
+@click.argument('trace_file', type=click.Path(exists=True))
+@click.option('--show', '-s', 'show', is_flag=True, default=False,
+              help='print map')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(trace_file, show, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('trace_file=%s, show=%s', trace_file, show)
+
+    app = OttoPiMapApp(trace_file, show, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -50,7 +50,7 @@ class OttoPiMotion:
         self.logger.debug('pulse_min  = %s', pulse_min)
         self.logger.debug('pulse_max  = %s', pulse_max)
 
-        if type(pi) == pigpio.pi:
+        if pi is not None:
             self.pi   = pi
             self.mypi = False
         else:
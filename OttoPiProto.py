@@ -0,0 +1,902 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiServer のプロトコル
+
+2つのモードがあり、接続ごとに、最初に受信したデータで決まる。
+
+ * legacy (従来の telnet 風):
+   受信したデータを、そのまま 1つのコマンドとして扱う。
+   返信は区切りのない JSON ({"CMD":.., "ACCEPT":.., "MSG":..})。
+
+ * framed (改行区切りの JSON, NDJSON):
+   最初のデータが '{' で始まる場合。1行が 1つのリクエストで、
+   クライアントが付けた id が返信に入るので、返信を待たずに
+   続けて送ってもよい (パイプライン)。返信はリクエストの順。
+
+     request: {"v": 1, "id": 5, "cmd": ":.happy"}
+     reply:   {"v": 1, "id": 5, "CMD": ":.happy", "ACCEPT": true, "MSG": ""}
+
+   cmd は legacy と同じ (短縮文字列、":cmd", ":.cmd")。
+   短縮文字列が複数文字の場合、返信は 1つにまとめる(merge_replies)。
+
+ * binary (BLE や弱い Wi-Fi 向けの固定長レコード):
+   最初のバイトが BIN_MAGIC (0xB1) の場合。
+   リクエストは opcode と引数の固定長構造体 (BIN_REQ, 7 bytes)、
+   返信は固定長の状態レコード (BIN_REP, 11 bytes)。
+   数値にできない MSG (auto_stat など) だけ、返信の後ろに JSON を付ける。
+
+     request: magic(B) id(H) op(B) flags(B) arg(H)
+     reply:   magic(B) id(H) op(B) status(B) d(i) msg_len(H) [msg(JSON)]
+
+   op は OPCODES の番号 (1〜)。追加するときは末尾に足す。
+   短縮文字は 1文字ずつ、別のリクエストにする (encode_bin_cmd)。
+   ":client name" だけは可変長で、arg が名前の長さ、その後ろに
+   名前(UTF-8, BIN_NAME_MAX bytes まで)が付く (bin_request_size)。
+
+購読 (":subscribe [period_ms [field,..]]", どのモードでも):
+   接続を、テレメトリー(距離、自動運転の状態、実行中のコマンド、
+   サーボのパルス幅)のプッシュ配信にする。period_ms ごとに状態を見て、
+   変化があったときだけ送る (HEARTBEAT_SEC 変化がなくても 1回は送る)。
+   送信が詰まっている間のフレームは捨て (drop)、次は最新の状態を送る。
+   購読中もコマンドは使える。":unsubscribe" で止める。
+
+     frame: {"v": 1, "id": 5, "seq": 3, "drop": 0,
+             "TLM": {"d": 350, "auto_on": true, .., "pulse": [..]}}
+
+   binary では arg が period_ms で、フレームは固定長 (BIN_TLM, 17 bytes)。
+
+クライアント名 (":client name", どのモードでも):
+   動作の権利(リース)は、クライアント名ごと。デフォルトは接続元のホスト
+   (Unix ドメインソケットは "unix")。ブリッジは、中継元ごとの名前を付ける。
+
+接続直後にサーバーは READY を送る。framed のクライアントは '#' で
+始まる行を読み飛ばす。binary のクライアントは READY を読み捨ててから送る。
+
+-----------------------------------------------------------------
+OttoPiProto -- プロトコル (エンコード・デコード)
+ ^    ^
+ |    +- OttoPiServer, OttoPiAsyncServer -- ProtoSession
+ +------ OttoPiClient -- ClientSession
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import struct
+import json
+
+from MyLogger import get_logger
+
+
+VERSION = 1
+READY = b'#Ready\r\n'
+NEWLINE = b'\n'
+
+# 1行の最大長 (これを超えたら接続を切る)
+MAX_LINE = 64 * 1024
+
+
+# binary
+BIN_MAGIC = 0xB1
+BIN_REQ = struct.Struct('<BHBBH')    # magic, id, op, flags, arg
+BIN_REP = struct.Struct('<BHBBiH')   # magic, id, op, status, d, msg_len
+
+BIN_FLAG_NO_INTERRUPT = 0x01         # ":." と同じ
+BIN_STAT_ACCEPT = 0x01
+BIN_STAT_MSG = 0x02                  # 後ろに JSON の MSG が付いている
+BIN_D_NONE = -1
+BIN_NAME_MAX = 64                    # ":client name" の名前 [bytes]
+
+# opcode: OPCODES[op - 1] (番号を変えないように、末尾に追加すること)
+OPCODES = (
+    'forward', 'left_forward', 'right_forward',
+    'backward', 'left_backward', 'right_backward', 'suriashi_fwd',
+    'turn_left', 'turn_right', 'slide_left', 'slide_right',
+    'happy', 'hi_right', 'hi_left', 'bye_right', 'bye_left',
+    'surprised', 'ojigi', 'ojigi2',
+    'home', 'stop', 'resume',
+    'move_up0', 'move_down0', 'move_up1', 'move_down1',
+    'move_up2', 'move_down2', 'move_up3', 'move_down3',
+    'home_up0', 'home_down0', 'home_up1', 'home_down1',
+    'home_up2', 'home_down2', 'home_up3', 'home_down3',
+    'estop', 'estop_clear',
+    'auto_on', 'auto_off', 'auto_enable', 'auto_disable',
+    'auto_ready', 'auto_null', 'auto_stat',
+    'server_stat',
+    'subscribe', 'unsubscribe',
+    'lease', 'release', 'lease_stat',
+    'client',
+)
+OPCODE = {name: i + 1 for (i, name) in enumerate(OPCODES)}
+
+# telemetry frame (binary)
+BIN_TLM_MAGIC = 0xB2
+BIN_TLM = struct.Struct('<BHiBB4H')  # magic, seq, d, auto, op(cmd), pulse
+BIN_TLM_AUTO_ON = 0x01
+BIN_TLM_AUTO_ENABLE = 0x02
+
+# telemetry
+CMD_SUBSCRIBE = 'subscribe'
+CMD_UNSUBSCRIBE = 'unsubscribe'
+
+# クライアント名 (リースの調停用)
+CMD_CLIENT = 'client'
+TLM_FIELDS = ('d', 'auto_on', 'auto_enable', 'cmd', 'pulse')
+
+
+class ProtoError(Exception):
+    pass
+
+
+def clean(decoded_data):
+    """
+    文字列抽出(コントロールキャラクター削除)
+    """
+    return ''.join([ch for ch in decoded_data if ord(ch) >= 0x20])
+
+
+def encode_legacy(cmd, accept=True, msg=''):
+    return json.dumps({
+        'CMD': cmd,
+        'ACCEPT': accept,
+        'MSG': msg
+    }).encode('utf-8')
+
+
+def is_framed(net_data):
+    return net_data.lstrip()[:1] == b'{'
+
+
+def encode_request(req_id, cmd):
+    return json.dumps({'v': VERSION, 'id': req_id, 'cmd': cmd},
+                      separators=(',', ':')).encode('utf-8') + NEWLINE
+
+
+def decode_request(line):
+    """
+    Returns
+    -------
+    (req_id, cmd)
+    """
+    try:
+        req = json.loads(line)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtoError('bad frame: %s' % e)
+
+    if not isinstance(req, dict):
+        raise ProtoError('bad frame: not an object')
+    if req.get('v', VERSION) != VERSION:
+        raise ProtoError('unsupported version: %s' % req.get('v'))
+    if not isinstance(req.get('cmd'), str):
+        raise ProtoError('no cmd')
+
+    return (req.get('id'), req['cmd'])
+
+
+def encode_reply(req_id, cmd, accept=True, msg=''):
+    return json.dumps({'v': VERSION, 'id': req_id,
+                       'CMD': cmd, 'ACCEPT': accept, 'MSG': msg},
+                      separators=(',', ':')).encode('utf-8') + NEWLINE
+
+
+def decode_reply(line):
+    """
+    Returns
+    -------
+    reply: dict
+        {'v':.., 'id':.., 'CMD':.., 'ACCEPT':.., 'MSG':..}
+    """
+    try:
+        rep = json.loads(line)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtoError('bad frame: %s' % e)
+
+    if not isinstance(rep, dict):
+        raise ProtoError('bad frame: not an object')
+    return rep
+
+
+def merge_replies(replies):
+    """
+    短縮文字列の返信 [(cmd, accept, msg), ..] を 1つにまとめる
+    """
+    if len(replies) == 1:
+        return replies[0]
+
+    return (' '.join([r[0] for r in replies]),
+            all([r[1] for r in replies]),
+            [r[2] for r in replies])
+
+
+def is_binary(net_data):
+    return net_data[:1] == bytes([BIN_MAGIC])
+
+
+def encode_bin_request(req_id, cmd):
+    """
+    word command (":cmd", ":.cmd n") を 1つのリクエストにする
+
+    Parameters
+    ----------
+    req_id: int
+        0〜0xFFFF (はみ出した分は切り捨て)
+    cmd: str
+        ex. ":.forward 2", ":auto_on", "happy"
+    """
+    flags = 0
+    if cmd.startswith(':'):
+        cmd = cmd[1:]
+        if cmd.startswith('.'):
+            cmd = cmd[1:]
+            flags |= BIN_FLAG_NO_INTERRUPT
+
+    words = cmd.split()
+    if len(words) == 0:
+        raise ProtoError('no command')
+    if words[0] not in OPCODE:
+        raise ProtoError('%s: no opcode' % words[0])
+
+    if words[0] == CMD_CLIENT:
+        # 名前は、固定長部分の後ろに付ける
+        name = words[1].encode('utf-8') if len(words) > 1 else b''
+        if len(name) > BIN_NAME_MAX:
+            raise ProtoError('%s: name too long' % words[1])
+        return BIN_REQ.pack(BIN_MAGIC, req_id & 0xFFFF, OPCODE[CMD_CLIENT],
+                            0, len(name)) + name
+
+    arg = 0
+    if len(words) > 1:
+        try:
+            arg = int(words[1])
+        except ValueError:
+            raise ProtoError('%s: bad arg' % words[1])
+        if not 0 <= arg <= 0xFFFF:
+            raise ProtoError('%s: arg out of range' % words[1])
+
+    return BIN_REQ.pack(BIN_MAGIC, req_id & 0xFFFF, OPCODE[words[0]],
+                        flags, arg)
+
+
+def encode_bin_cmd(req_id, cmd, key_table):
+    """
+    短縮文字列にも対応する (1文字ごとに 1リクエスト)
+
+    Parameters
+    ----------
+    key_table: dict
+        短縮文字 -> コマンド名 (OttoPiDispatcher.CMD_KEY)
+
+    Returns
+    -------
+    reqs: list of bytes
+    """
+    if cmd.startswith(':'):
+        return [encode_bin_request(req_id, cmd)]
+
+    reqs = []
+    for (i, ch) in enumerate(cmd):
+        if ch not in key_table or key_table[ch] not in OPCODE:
+            raise ProtoError('%a: no opcode' % ch)
+        reqs.append(encode_bin_request(req_id + i, key_table[ch]))
+    return reqs
+
+
+def bin_request_size(buf, offset=0):
+    """
+    buf[offset:] の先頭のリクエストの長さ
+    (":client name" 以外は BIN_REQ.size)
+
+    Returns
+    -------
+    size: int
+        データが足りなければ None
+    """
+    if len(buf) - offset < BIN_REQ.size:
+        return None
+
+    (magic, req_id, op, flags, arg) = BIN_REQ.unpack_from(buf, offset)
+    size = BIN_REQ.size
+    if magic == BIN_MAGIC and op == OPCODE[CMD_CLIENT]:
+        if arg > BIN_NAME_MAX:
+            raise ProtoError('%d: name too long' % arg)
+        size += arg
+
+    if len(buf) - offset < size:
+        return None
+    return size
+
+
+def decode_bin_request(rec):
+    """
+    Parameters
+    ----------
+    rec: bytes
+        1つのリクエスト (bin_request_size() の長さ)
+
+    Returns
+    -------
+    (req_id, op, cmd)
+        cmd: OttoPiDispatcher に渡す word command (ex. ":.forward 2")
+    """
+    (magic, req_id, op, flags, arg) = BIN_REQ.unpack_from(rec)
+    if magic != BIN_MAGIC:
+        raise ProtoError('bad magic: 0x%02x' % magic)
+    if not 1 <= op <= len(OPCODES):
+        raise ProtoError('bad opcode: %d' % op)
+
+    if op == OPCODE[CMD_CLIENT]:
+        try:
+            name = rec[BIN_REQ.size:BIN_REQ.size + arg].decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise ProtoError('bad name: %s' % e)
+        return (req_id, op, (':%s %s' % (CMD_CLIENT, name)).rstrip())
+
+    cmd = ':'
+    if flags & BIN_FLAG_NO_INTERRUPT:
+        cmd += '.'
+    cmd += OPCODES[op - 1]
+    if arg > 0:
+        cmd += ' %d' % arg
+    return (req_id, op, cmd)
+
+
+def encode_bin_reply(req_id, op, accept=True, msg=''):
+    """
+    msg が '' か {'d': mm} なら、固定長 (BIN_REP.size) だけ
+    """
+    status = BIN_STAT_ACCEPT if accept else 0
+    d = BIN_D_NONE
+    tail = b''
+
+    if isinstance(msg, dict) and list(msg.keys()) == ['d']:
+        d = int(msg['d'])
+    elif msg != '':
+        tail = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+        status |= BIN_STAT_MSG
+
+    return BIN_REP.pack(BIN_MAGIC, req_id & 0xFFFF, op, status, d,
+                        len(tail)) + tail
+
+
+def decode_bin_reply(data):
+    """
+    Returns
+    -------
+    (reply, size)
+        reply: {'id':.., 'CMD':.., 'ACCEPT':.., 'MSG':..} (legacy と同じキー)
+            データが足りない場合は None
+        size: 使ったバイト数
+    """
+    if len(data) < BIN_REP.size:
+        return (None, 0)
+
+    (magic, req_id, op, status, d, msg_len) = BIN_REP.unpack_from(data)
+    if magic != BIN_MAGIC:
+        raise ProtoError('bad magic: 0x%02x' % magic)
+
+    size = BIN_REP.size + msg_len
+    if len(data) < size:
+        return (None, 0)
+
+    msg = ''
+    if status & BIN_STAT_MSG:
+        try:
+            msg = json.loads(data[BIN_REP.size:size])
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ProtoError('bad msg: %s' % e)
+    elif d != BIN_D_NONE:
+        msg = {'d': d}
+
+    cmd = OPCODES[op - 1] if 1 <= op <= len(OPCODES) else ''
+    return ({'id': req_id, 'CMD': cmd,
+             'ACCEPT': bool(status & BIN_STAT_ACCEPT), 'MSG': msg}, size)
+
+
+def encode_tlm(req_id, seq, drop, tlm):
+    return json.dumps({'v': VERSION, 'id': req_id, 'seq': seq,
+                       'drop': drop, 'TLM': tlm},
+                      separators=(',', ':')).encode('utf-8') + NEWLINE
+
+
+def encode_bin_tlm(seq, tlm):
+    """
+    tlm は TLM_FIELDS がすべてそろっていること
+    """
+    auto = ((BIN_TLM_AUTO_ON if tlm['auto_on'] else 0) |
+            (BIN_TLM_AUTO_ENABLE if tlm['auto_enable'] else 0))
+    cmd = tlm['cmd'].split()
+    op = OPCODE.get(cmd[0], 0) if len(cmd) > 0 else 0
+    return BIN_TLM.pack(BIN_TLM_MAGIC, seq & 0xFFFF, tlm['d'], auto, op,
+                        *tlm['pulse'])
+
+
+def decode_bin_tlm(rec):
+    """
+    Returns
+    -------
+    (seq, tlm)
+    """
+    (magic, seq, d, auto, op, *pulse) = BIN_TLM.unpack(rec)
+    if magic != BIN_TLM_MAGIC:
+        raise ProtoError('bad magic: 0x%02x' % magic)
+
+    return (seq, {'d': d,
+                  'auto_on': bool(auto & BIN_TLM_AUTO_ON),
+                  'auto_enable': bool(auto & BIN_TLM_AUTO_ENABLE),
+                  'cmd': OPCODES[op - 1] if 1 <= op <= len(OPCODES) else '',
+                  'pulse': pulse})
+
+
+class Subscription:
+    """
+    1接続分の購読 (どのフィールドを、どの周期で)
+    """
+    DEF_PERIOD_MS = 200
+    MIN_PERIOD_MS = 20
+    MAX_PERIOD_MS = 60000
+
+    HEARTBEAT_SEC = 5.0
+
+    def __init__(self, req_id, period_ms=DEF_PERIOD_MS, fields=TLM_FIELDS):
+        self.req_id = req_id
+        self.period = min(max(period_ms, self.MIN_PERIOD_MS),
+                          self.MAX_PERIOD_MS) / 1000
+        self.fields = fields
+
+        self.t_next = 0.0
+        self.t_sent = 0.0
+        self.last = None
+
+        self.seq = 0
+        self.drop = 0
+
+    def get_stat(self):
+        return {'period_ms': round(self.period * 1000),
+                'fields': list(self.fields),
+                'seq': self.seq, 'drop': self.drop}
+
+    def poll(self, now, telemetry, writable=True):
+        """
+        Parameters
+        ----------
+        now: float
+            time.monotonic()
+        telemetry: function
+            状態のスナップショット(dict)を返す関数 (OttoPiDispatcher)
+        writable: bool
+            False なら、送信が詰まっている (このフレームは捨てる)
+
+        Returns
+        -------
+        (seq, tlm): 送るものがない場合は None
+        """
+        if now < self.t_next:
+            return None
+
+        # 遅れた分を取り戻そうとしない (まとめて送らない)
+        self.t_next = max(self.t_next + self.period, now)
+
+        tlm = telemetry()
+        if tlm is None:
+            return None
+        tlm = {k: tlm[k] for k in self.fields}
+
+        if tlm == self.last and now - self.t_sent < self.HEARTBEAT_SEC:
+            return None
+
+        if not writable:
+            self.drop += 1
+            return None
+
+        self.last = tlm
+        self.t_sent = now
+        self.seq += 1
+        return (self.seq, tlm)
+
+
+class LineBuffer:
+    """
+    受信データを行に分ける (途中の行は次の受信まで保持)
+    """
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self._buf = b''
+
+    def feed(self, data):
+        """
+        Returns
+        -------
+        lines: list of bytes (改行なし)
+        """
+        self._buf += data
+        lines = self._buf.split(NEWLINE)
+        self._buf = lines.pop()
+
+        if len(self._buf) > self.max_line:
+            raise ProtoError('line too long')
+        return lines
+
+
+class ProtoSession:
+    """
+    1接続分のプロトコル処理 (ネットワークには触らない)
+
+    受信データを feed() に渡し、返ってきたデータを送信する。
+    コマンドの実行は dispatcher (OttoPiDispatcher) に任せる。
+    """
+    MODE_NONE   = 'none'
+    MODE_LEGACY = 'legacy'
+    MODE_FRAMED = 'framed'
+    MODE_BINARY = 'binary'
+
+    def __init__(self, dispatcher, client=None, debug=False):
+        """
+        Parameters
+        ----------
+        client: str
+            クライアント名のデフォルト (接続元のホストなど)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('client=%s', client)
+
+        self._disp = dispatcher
+        self.client = client
+        self.mode = self.MODE_NONE
+        self._lines = LineBuffer()
+        self._bin_buf = b''
+
+        self.sub = None
+
+    def feed(self, net_data):
+        """
+        Returns
+        -------
+        (out, done): (bytes, bool)
+            out: 送信するデータ
+            done: True なら接続を閉じる
+        """
+        if self.mode == self.MODE_NONE and len(net_data.strip()) > 0:
+            if is_binary(net_data):
+                self.mode = self.MODE_BINARY
+            elif is_framed(net_data):
+                self.mode = self.MODE_FRAMED
+            else:
+                self.mode = self.MODE_LEGACY
+            self._log.debug('mode=%s', self.mode)
+
+        if self.mode == self.MODE_FRAMED:
+            return self.feed_framed(net_data)
+        if self.mode == self.MODE_BINARY:
+            return self.feed_binary(net_data)
+        return self.feed_legacy(net_data)
+
+    def feed_legacy(self, net_data):
+        # デコード(UTF-8)
+        try:
+            decoded_data = net_data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            self._log.warning('%s:%s .. ignored', type(e), e)
+            return (b'', False)
+
+        out = b'\r\n'
+
+        data = clean(decoded_data)
+        self._log.debug('data=%a', data)
+
+        # 文字数が0の場合、コネクションが切断されたと判断し終了
+        if len(data) == 0:
+            msg = 'No data .. disconnect'
+            self._log.debug(msg)
+            return (out + (msg + '\r\n').encode('utf-8'), True)
+
+        for (cmd, accept, msg) in self.exec(None, data):
+            out += encode_legacy(cmd, accept, msg)
+        return (out, False)
+
+    def feed_framed(self, net_data):
+        if len(net_data) == 0:
+            # 切断
+            return (b'', True)
+
+        try:
+            lines = self._lines.feed(net_data)
+        except ProtoError as e:
+            self._log.warning('%s', e)
+            return (encode_reply(None, '', False, str(e)), True)
+
+        out = b''
+        for line in lines:
+            if len(line.strip()) == 0:
+                continue
+            out += self.request(line)
+        return (out, False)
+
+    def request(self, line):
+        try:
+            (req_id, cmd) = decode_request(line)
+        except ProtoError as e:
+            self._log.warning('%s: %a', e, line[:80])
+            return encode_reply(None, '', False, str(e))
+
+        data = clean(cmd)
+        if len(data) == 0:
+            return encode_reply(req_id, cmd, False, 'no command')
+
+        (cmd, accept, msg) = merge_replies(self.exec(req_id, data))
+        return encode_reply(req_id, cmd, accept, msg)
+
+    def feed_binary(self, net_data):
+        if len(net_data) == 0:
+            # 切断
+            return (b'', True)
+
+        buf = self._bin_buf + net_data
+
+        out = b''
+        i = 0
+        while True:
+            try:
+                size = bin_request_size(buf, i)
+                if size is None:
+                    break
+                (req_id, op, cmd) = decode_bin_request(buf[i:i + size])
+            except ProtoError as e:
+                # 区切りがわからなくなるので、切断
+                self._log.warning('%s', e)
+                self._bin_buf = b''
+                return (out + encode_bin_reply(0, 0, False, str(e)), True)
+            i += size
+
+            (cmd, accept, msg) = merge_replies(self.exec(req_id, cmd))
+            out += encode_bin_reply(req_id, op, accept, msg)
+
+        self._bin_buf = buf[i:]
+        return (out, False)
+
+    def exec(self, req_id, data):
+        """
+        購読のコマンドはここで処理し、それ以外は dispatcher に渡す
+
+        Returns
+        -------
+        replies: [(cmd, accept, msg), ..]
+        """
+        words = data.split()
+        if data[0] != ':' or len(words) == 0:
+            return self._disp.dispatch(data, self.client)
+
+        cmd_name = words[0].lstrip(':.')
+        if cmd_name == CMD_SUBSCRIBE:
+            return [self.subscribe(req_id, data, words[1:])]
+        if cmd_name == CMD_UNSUBSCRIBE:
+            return [self.unsubscribe(data)]
+        if cmd_name == CMD_CLIENT:
+            if len(words) < 2:
+                return [(data, True, self.client)]
+            self.client = words[1]
+            self._log.debug('client=%s', self.client)
+            return [(data, True, self.client)]
+        return self._disp.dispatch(data, self.client)
+
+    def subscribe(self, req_id, data, args):
+        """
+        ":subscribe [period_ms [field,..]]"
+        """
+        try:
+            period_ms = int(args[0]) if len(args) > 0 else None
+        except ValueError:
+            return (data, False, '%s: bad period' % args[0])
+        if period_ms is None:
+            period_ms = Subscription.DEF_PERIOD_MS
+
+        fields = TLM_FIELDS
+        if len(args) > 1 and self.mode != self.MODE_BINARY:
+            fields = tuple(args[1].split(','))
+            for f in fields:
+                if f not in TLM_FIELDS:
+                    return (data, False, '%s: no such field' % f)
+
+        self.sub = Subscription(req_id, period_ms, fields)
+        self._log.debug('sub=%s', self.sub.get_stat())
+        return (data, True, self.sub.get_stat())
+
+    def unsubscribe(self, data):
+        if self.sub is None:
+            return (data, False, 'not subscribed')
+
+        stat = self.sub.get_stat()
+        self.sub = None
+        return (data, True, stat)
+
+    def next_tick(self):
+        """
+        Returns
+        -------
+        t: float
+            次に tick() を呼ぶ時刻 (time.monotonic())、購読していなければ None
+        """
+        if self.sub is None:
+            return None
+        return self.sub.t_next
+
+    def tick(self, now, writable=True):
+        """
+        購読中なら、送るべきフレームを返す
+
+        Returns
+        -------
+        out: bytes
+            送るものがない場合は b''
+        """
+        if self.sub is None:
+            return b''
+
+        frame = self.sub.poll(now, self._disp.telemetry, writable)
+        if frame is None:
+            return b''
+
+        (seq, tlm) = frame
+        if self.mode == self.MODE_BINARY:
+            return encode_bin_tlm(seq, tlm)
+        return encode_tlm(self.sub.req_id, seq, self.sub.drop, tlm)
+
+
+def reply_dict(rep):
+    """
+    返信を、従来(legacy)の形式 {'CMD':.., 'ACCEPT':.., 'MSG':..} にする
+    """
+    return {'CMD': rep.get('CMD', ''), 'ACCEPT': rep.get('ACCEPT', False),
+            'MSG': rep.get('MSG', '')}
+
+
+class ClientSession:
+    """
+    クライアント側のプロトコル処理 (ネットワークには触らない)
+
+    framed (デフォルト) か binary で、リクエストを作り、
+    受信データを返信とテレメトリーに分ける。
+    同期版(OttoPiClient)と asyncio版で共有する。
+    """
+    def __init__(self, binary=False, key_table=None, debug=False):
+        """
+        Parameters
+        ----------
+        binary: bool
+            True なら binary、False なら framed
+        key_table: dict
+            短縮文字 -> コマンド名 (binary で短縮文字を送る場合)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('binary=%s', binary)
+
+        self.binary = binary
+        self._key_table = key_table or {}
+
+        self._req_id = 0
+        self._sent_name = None
+        self._lines = LineBuffer()
+        self._bin_buf = b''
+        self._bin_ready = False
+
+    def next_id(self):
+        req_id = self._req_id
+        self._req_id = (self._req_id + 1) & 0xFFFF
+        return req_id
+
+    def requests(self, cmd):
+        """
+        短縮文字列は、1文字ずつのリクエストにする (続けて送ってよい)
+
+        Returns
+        -------
+        (ids, data): (list of int, bytes)
+        """
+        if self.binary:
+            req_id = self._req_id
+            reqs = encode_bin_cmd(req_id, cmd, self._key_table)
+            ids = [(req_id + i) & 0xFFFF for i in range(len(reqs))]
+            self._req_id = (req_id + len(reqs)) & 0xFFFF
+            return (ids, b''.join(reqs))
+
+        if cmd.startswith(':'):
+            words = [cmd]
+        else:
+            words = list(cmd)
+
+        ids = []
+        data = b''
+        for w in words:
+            ids.append(self.next_id())
+            data += encode_request(ids[-1], w)
+        return (ids, data)
+
+    def name_requests(self, name):
+        """
+        クライアント名が変わっていたら、":client name" のリクエスト
+        (コマンドのリクエストの前に、続けて送る)
+
+        Returns
+        -------
+        (ids, data): (list of int, bytes)
+            送る必要がなければ ([], b'')
+        """
+        if name is None or name == self._sent_name:
+            return ([], b'')
+
+        self._sent_name = name
+        return self.requests(':%s %s' % (CMD_CLIENT, name))
+
+    def result(self, cmd, rep):
+        """
+        最後の返信を、送ったコマンドに対する結果 (reply_dict) にする
+
+        binary の返信の CMD は opcode の名前なので、送ったコマンドに直す。
+        """
+        ret = reply_dict(rep)
+        if self.binary:
+            if cmd.startswith(':'):
+                ret['CMD'] = cmd
+            else:
+                ret['CMD'] = '%s(%s)' % (cmd[-1], ret['CMD'])
+        return ret
+
+    def feed(self, net_data):
+        """
+        Returns
+        -------
+        (replies, frames)
+            replies: [{'id':.., 'CMD':.., 'ACCEPT':.., 'MSG':..}, ..]
+            frames: テレメトリー [{'seq':.., 'TLM': {..}}, ..]
+        """
+        if self.binary:
+            return self.feed_binary(net_data)
+
+        replies = []
+        frames = []
+        for line in self._lines.feed(net_data):
+            if line.startswith(b'#') or len(line.strip()) == 0:
+                continue
+
+            rep = decode_reply(line)
+            if 'TLM' in rep:
+                frames.append(rep)
+                continue
+            if rep.get('id') is None:
+                # サーバーがリクエストを解釈できなかった
+                raise ProtoError(rep.get('MSG', 'no id'))
+            replies.append(rep)
+        return (replies, frames)
+
+    def feed_binary(self, net_data):
+        self._bin_buf += net_data
+
+        if not self._bin_ready:
+            # READY を読み捨てる
+            i = self._bin_buf.find(READY)
+            if i < 0:
+                return ([], [])
+            self._bin_buf = self._bin_buf[i + len(READY):]
+            self._bin_ready = True
+
+        replies = []
+        frames = []
+        while len(self._bin_buf) > 0:
+            if self._bin_buf[0] == BIN_TLM_MAGIC:
+                if len(self._bin_buf) < BIN_TLM.size:
+                    break
+                (seq, tlm) = decode_bin_tlm(self._bin_buf[:BIN_TLM.size])
+                self._bin_buf = self._bin_buf[BIN_TLM.size:]
+                frames.append({'seq': seq, 'TLM': tlm})
+                continue
+
+            (rep, size) = decode_bin_reply(self._bin_buf)
+            if rep is None:
+                break
+            self._bin_buf = self._bin_buf[size:]
+            replies.append(rep)
+        return (replies, frames)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiProto のベンチマーク (legacy, framed JSON, binary)
+
+典型的なコマンドと返信について、
+
+ * 1コマンドあたりのバイト数 (リクエスト + 返信)
+ * エンコード・デコードの時間 (リクエストと返信、1往復分)
+
+を比べる。ネットワークやロボットには触らない。
+
+-----------------------------------------------------------------
+OttoPiProtoBench -- ベンチマーク
+ |
+ +- OttoPiProto -- プロトコル (エンコード・デコード)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import OttoPiProto as proto
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+# (コマンド, 返信の MSG)
+DEF_CASES = [
+    (':.forward 2', ''),
+    (':happy', ''),
+    (':stop', ''),
+    (':.auto_null', {'d': 1234}),
+    (':auto_on', {'d': 567}),
+    (':estop', ''),
+]
+
+
+class OttoPiProtoBench:
+    DEF_N = 20000
+
+    ENCODING = ('legacy', 'framed', 'binary')
+
+    def __init__(self, cases=DEF_CASES, n=DEF_N, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cases=%s, n=%s', cases, n)
+
+        self.cases = cases
+        self.n = n
+
+    def wire(self, enc, req_id, cmd, msg):
+        """
+        Returns
+        -------
+        (req, rep): (bytes, bytes)
+        """
+        if enc == 'legacy':
+            return (cmd.encode('utf-8'),
+                    b'\r\n' + proto.encode_legacy(cmd, True, msg))
+        if enc == 'framed':
+            return (proto.encode_request(req_id, cmd),
+                    proto.encode_reply(req_id, cmd, True, msg))
+
+        req = proto.encode_bin_request(req_id, cmd)
+        op = proto.BIN_REQ.unpack(req)[2]
+        return (req, proto.encode_bin_reply(req_id, op, True, msg))
+
+    def parse(self, enc, req, rep):
+        """
+        サーバーとクライアントの、1往復分のデコード
+        """
+        if enc == 'legacy':
+            proto.clean(req.decode('utf-8'))
+            proto.decode_reply(rep[2:])
+        elif enc == 'framed':
+            proto.decode_request(req)
+            proto.decode_reply(rep)
+        else:
+            proto.decode_bin_request(req)
+            proto.decode_bin_reply(rep)
+
+    def usec(self, func, *args):
+        t0 = time.perf_counter()
+        for _ in range(self.n):
+            func(*args)
+        return (time.perf_counter() - t0) / self.n * 1000000
+
+    def run(self):
+        """
+        Returns
+        -------
+        result: {enc: {'bytes':.., 'encode_us':.., 'parse_us':..}}
+            1コマンドあたりの平均
+        """
+        result = {}
+        for enc in self.ENCODING:
+            nbytes = 0
+            encode_us = 0.0
+            parse_us = 0.0
+
+            for (i, (cmd, msg)) in enumerate(self.cases):
+                (req, rep) = self.wire(enc, i, cmd, msg)
+                nbytes += len(req) + len(rep)
+                encode_us += self.usec(self.wire, enc, i, cmd, msg)
+                parse_us += self.usec(self.parse, enc, req, rep)
+
+            n = len(self.cases)
+            result[enc] = {'bytes': round(nbytes / n, 1),
+                           'encode_us': round(encode_us / n, 2),
+                           'parse_us': round(parse_us / n, 2)}
+            self._log.debug('%s: %s', enc, result[enc])
+
+        return result
+
+
+class OttoPiProtoBenchApp:
+    def __init__(self, n, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('n=%s', n)
+
+        self._bench = OttoPiProtoBench(n=n, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        for (cmd, msg) in self._bench.cases:
+            print('%-14s %s' % (cmd, ' '.join(
+                ['%s=%d' % (enc, sum([len(b) for b in
+                                      self._bench.wire(enc, 0, cmd, msg)]))
+                 for enc in OttoPiProtoBench.ENCODING])))
+        print()
+
+        result = self._bench.run()
+        print('%-8s %8s %10s %10s' % ('', 'bytes', 'encode[us]', 'parse[us]'))
+        for enc in OttoPiProtoBench.ENCODING:
+            r = result[enc]
+            print('%-8s %8.1f %10.2f %10.2f' % (
+                enc, r['bytes'], r['encode_us'], r['parse_us']))
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+compare bytes/command and parse time: legacy, framed JSON, binary
+''')
+@click.option('--count', '-n', 'n', type=int, default=OttoPiProtoBench.DEF_N,
+              help='iterations per case')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(n, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('n=%s', n)
+
+    app = OttoPiProtoBenchApp(n, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
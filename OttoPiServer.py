@@ -12,9 +12,19 @@ __date__   = '2020'
 
 自動運転のON/OFF、マニュアル操作が行える。
 
+プロトコルは OttoPiProto (従来の telnet 風、改行区切りの JSON、binary)。
+
+TCP のほかに、同じPi上のブリッジ用に Unix ドメインソケット
+(unix_path(port)) でも待ち受ける。OttoPiClient は、ホストがローカルなら
+こちらを使う。
+
+--sim で、サーボと距離センサーをシミュレーションする (OttoPiSim)。
+Raspberry Pi のない Linux でも動くので、負荷試験(OttoPiLoadGen)に使う。
+
 -----------------------------------------------------------------
 OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレッド)
  |
+ +- OttoPiProto -- プロトコル
  +- OttoPiAuto -- ロボットの自動運転 (自動運転スレッド)
  |   |
  +---+- OttoPiCtrl -- コマンド制御 (動作実行スレッド)
@@ -28,78 +38,470 @@ OttoPiServer -- ロボット制御サーバ (ネットワーク送受信スレ
 
 from OttoPiCtrl import OttoPiCtrl
 from OttoPiAuto import OttoPiAuto
+from OttoPiState import OttoPiState, state_name
+from OttoPiLease import OttoPiLease
+from OttoPiProto import ProtoSession, READY
+from OttoPiSim import SimPi
+from OttoPiConfig import OttoPiConfig
 
 import pigpio
 import socketserver
+import threading
+import select
+import socket
+import errno
+import os
 import time
-import json
 
 from MyLogger import get_logger
 import click
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+UNIX_PATH_FMT = '/tmp/OttoPiServer-%d.sock'
+
+
+def unix_path(port):
+    """
+    TCP のポート番号に対応する Unix ドメインソケットのパス
+    """
+    return UNIX_PATH_FMT % port
+
+
+def remove_stale_unix(path):
+    """
+    前回の異常終了などで残っている Unix ドメインソケットを削除する
+
+    接続できる(待ち受けているサーバーがある)場合は、削除しないで
+    OSError(EADDRINUSE) にする
+
+    Returns
+    -------
+    removed: bool
+    """
+    if not os.path.exists(path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(path)
+    except OSError:
+        os.unlink(path)
+        return True
+    finally:
+        sock.close()
+
+    raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE), path)
+
+
+class OttoPiDispatcher:
+    """
+    受信した文字列の解釈と実行
+
+    OttoPiServer(スレッド)と OttoPiAsyncServer(asyncio)で共有する。
+    OttoPiCtrl, OttoPiAuto を起動して持ち、止まっていた場合は再起動する。
+
+    dispatch() は返信のリスト [(cmd, accept, msg), ..] を返すだけで、
+    ネットワークには触らない。
+
+    動作コマンドは、クライアントごとのリース(OttoPiLease)で調停する。
+    """
+    CMD_PREFIX = ':'           # word command
+    CMD_PREFIX2 = '.'          # interupt off
+    CMD_AUTO_PREFIX = 'auto_'  # auto command
+    CMD_SERVER_STAT = 'server_stat'
+
+    CMD_LEASE = 'lease'
+    CMD_RELEASE = 'release'
+    CMD_LEASE_STAT = 'lease_stat'
+
+    # リースがなくても送れるコマンド
+    # (止める方向のコマンドは、誰でも送れる。自動運転も止められるように、
+    #  auto_off, auto_disable を含む)
+    #
+    # estop_clear は、動作を再開できるようにするので、リースが必要
+    # (holder がいなくなっても、期限が切れれば誰でも解除できる)
+    CMD_ALWAYS = (OttoPiCtrl.CMD_ESTOP, OttoPiCtrl.CMD_STOP,
+                  OttoPiCtrl.CMD_HELP,
+                  CMD_AUTO_PREFIX + OttoPiAuto.CMD_OFF,
+                  CMD_AUTO_PREFIX + OttoPiAuto.CMD_DISABLE)
+    CMD_AUTO_READ = (OttoPiAuto.CMD_NULL, OttoPiAuto.CMD_STAT)
+
+    CMD_KEY = {
+        # auto switch commands
+        '@': 'auto_on',
+        ' ': 'auto_off',
+
+        # robot control commands
+        'w': 'forward',
+        'q': 'left_forward',
+        'e': 'right_forward',
+        'x': 'backward',
+        'W': 'suriashi_fwd',
+        'a': 'turn_left',
+        'd': 'turn_right',
+        'A': 'slide_left',
+        'D': 'slide_right',
+        '1': 'happy',
+        '2': 'hi_right',
+        '3': 'hi_left',
+        '4': 'bye_right',
+        '5': 'bye_left',
+        '6': 'surprised',
+        '8': 'ojigi',
+        '9': 'ojigi2',
+        '0': 'home',
+
+        'h': 'move_up0',
+        'H': 'move_down0',
+        'j': 'move_up1',
+        'J': 'move_down1',
+        'k': 'move_up2',
+        'K': 'move_down2',
+        'l': 'move_up3',
+        'L': 'move_down3',
+
+        'u': 'home_up0',
+        'U': 'home_down0',
+        'i': 'home_up1',
+        'I': 'home_down1',
+        'o': 'home_up2',
+        'O': 'home_down2',
+        'p': 'home_up3',
+        'P': 'home_down3',
+
+        's': OttoPiCtrl.CMD_STOP,
+        'S': OttoPiCtrl.CMD_STOP,
+        '' : OttoPiCtrl.CMD_END}
+
+    def __init__(self, pi=None, lease_sec=OttoPiLease.DEF_LEASE_SEC,
+                 lease_mode=OttoPiLease.DEF_MODE, sim=False,
+                 state_name=OttoPiState.DEF_NAME, debug=False):
+        """
+        Parameters
+        ----------
+        pi: pigpio.pi
+            OttoPiSim.SimPi も可 (None: 新たに接続する)
+        lease_sec: float
+            動作の権利の期間 [sec] (0: 調停しない)
+        lease_mode: str
+            権利のないクライアントの動作コマンドの扱い (OttoPiLease.MODES)
+        sim: bool
+            True なら、サーボと距離センサーをシミュレーションする (OttoPiSim)
+            設定ファイル(OttoPi.conf)がなければ、OttoPi.conf-sample を使う
+        state_name: str
+            状態共有メモリ(OttoPiState)の名前 (サーバーのポートごと)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('pi=%s, lease_sec=%s, lease_mode=%s, sim=%s',
+                        pi, lease_sec, lease_mode, sim)
+        self._log.debug('state_name=%s', state_name)
+
+        self._tof_driver = None
+        if sim:
+            self._tof_driver = 'sim'
+            if pi is None:
+                pi = SimPi(debug=self._dbg)
+            OttoPiConfig.use_sample()
+
+        if pi is not None:
+            self._pi   = pi
+            self._mypi = False
+        else:
+            self._pi   = pigpio.pi()
+            self._mypi = True
+        self._log.debug('mypi = %s', self._mypi)
+
+        self._state = OttoPiState(state_name, create=True, debug=self._dbg)
+
+        self._ctrl = None
+        try:
+            self._ctrl = OttoPiCtrl(self._pi, state=self._state,
+                                    debug=self._dbg)
+            self._ctrl.start()
+
+            self._auto = OttoPiAuto(self._ctrl, state=self._state,
+                                    tof_driver=self._tof_driver,
+                                    debug=self._dbg)
+            self._auto.start()
+        except BaseException:
+            # 共有メモリのブロックや、スレッドを残さないように
+            if self._ctrl is not None and self._ctrl.is_alive():
+                self._ctrl.end()
+            self._state.close()
+            if self._mypi:
+                self._pi.stop()
+            raise
+
+        self._lease = OttoPiLease(lease_sec, lease_mode, debug=self._dbg)
+        self._motion_client = None
+
+        # サーバーの状態 (接続数など) を返す関数
+        self.stat_func = dict
+
+        time.sleep(1)
+
+    def end(self):
+        self._log.debug('')
+
+        if self._auto.is_active():
+            self._auto.end()
+            self._log.debug('_auto thread: done')
+
+        if self._ctrl.is_active():
+            self._ctrl.end()
+            self._log.debug('_ctrl thread: done')
+
+        self._state.close()
+
+        if self._mypi:
+            self._log.debug('clean up pigpio')
+            self._pi.stop()
+            self._mypi = False
+
+        self._log.debug('done')
+
+    def check_threads(self):
+        # 制御スレッドが動いていない場合は(異常終了など?)、再起動
+        if not self._ctrl.is_active():
+            self._log.warning('robot control thread is dead !? .. restart')
+            self._ctrl = OttoPiCtrl(self._pi, state=self._state,
+                                    debug=self._dbg)
+            self._ctrl.start()
+
+        # 自動運転スレッドが動いていない場合は(異常終了など?)、再起動
+        if not self._auto.is_active():
+            self._log.warning('auto control thread is dead !? .. restart')
+            self._auto = OttoPiAuto(self._ctrl, state=self._state,
+                                    tof_driver=self._tof_driver,
+                                    debug=self._dbg)
+            self._auto.start()
+
+    def stop(self):
+        self._ctrl.send(OttoPiCtrl.CMD_STOP)
+
+    def telemetry(self):
+        """
+        購読(":subscribe")用の状態のスナップショット (OttoPiState から)
+
+        Returns
+        -------
+        tlm: dict
+            {'d':.., 'auto_on':.., 'auto_enable':.., 'cmd':.., 'pulse':..}
+            読めなかった場合は None
+        """
+        st = self._state.read()
+        if st is None:
+            return None
+
+        return {'d': st['distance'],
+                'auto_on': st['auto_on'],
+                'auto_enable': st['auto_enable'],
+                'cmd': st['cmd'],
+                'pulse': st['pulse']}
+
+    def dispatch(self, data, client=None):
+        """
+        Parameters
+        ----------
+        data: str
+            コントロールキャラクターを除いた受信文字列
+        client: str
+            クライアント名 (リースの調停用)
+
+        Returns
+        -------
+        replies: [(cmd, accept, msg), ..]
+        """
+        self._log.debug('data=%a, client=%s', data, client)
+
+        self.check_threads()
+
+        if data[0] == self.CMD_PREFIX:
+            return [self.exec_word(data, client)]
+
+        return [self.exec_key(ch, client) for ch in data]
+
+    def gate(self, client, cmd_name, interrupt_flag=True):
+        """
+        動作コマンドの調停
+
+        Returns
+        -------
+        (ok, interrupt_flag, msg)
+            ok: False なら送らない (msg が理由)
+            interrupt_flag: キューに回す場合は False
+        """
+        if cmd_name in self.CMD_ALWAYS:
+            self._lease.count_cmd(client)
+            return (True, interrupt_flag, '')
+
+        result = self._lease.check(client)
+        if result == OttoPiLease.DENY:
+            msg = 'lease: held by %s (%.1f sec)' % (self._lease.holder,
+                                                    self._lease.remain())
+            self._log.debug('%s: %s: %s', client, cmd_name, msg)
+            return (False, interrupt_flag, msg)
+
+        if result == OttoPiLease.QUEUE:
+            interrupt_flag = False
+
+        # 他のクライアントの動作を、割り込みで止める
+        if (interrupt_flag and not self._ctrl.idle.is_set() and
+                self._motion_client not in (None, client)):
+            self._lease.preempt(client, self._motion_client)
+
+        self._motion_client = client
+        return (True, interrupt_flag, '')
+
+    def exec_lease(self, data, client, cmd_name):
+        """
+        lease command
+        """
+        if cmd_name == self.CMD_LEASE:
+            ok = self._lease.acquire(client)
+            return (data, ok, {'holder': self._lease.holder,
+                               'remain': round(self._lease.remain(), 1)})
+
+        if cmd_name == self.CMD_RELEASE:
+            return (data, self._lease.release(client), '')
+
+        return (data, True, self._lease.get_stat())
+
+    def exec_word(self, data, client=None):
+        """
+        word command
+
+          ex. ":.forward 2", ":happy 1", ":auto_off"
+        """
+        cmd = data[1:]
+        interrupt_flag = True
+
+        if data[1:2] == self.CMD_PREFIX2:
+            cmd = data[2:]
+            interrupt_flag = False
+
+        if len(cmd.split()) == 0:
+            return (data, False, 'no command')
+        cmd_name = cmd.split()[0]
+
+        self._log.debug('cmd=%s, cmd_name=%s, interrupt_flag=%s',
+                        cmd, cmd_name, interrupt_flag)
+
+        if cmd.startswith(self.CMD_AUTO_PREFIX):
+            """
+            auto command
+
+            注意
+            ----
+            auto commandは、回数パラメータがないため、
+            cmd_nameだけをsendする。
+
+            """
+            cmd_name = cmd_name.replace(self.CMD_AUTO_PREFIX, '')
+
+            if cmd_name == OttoPiAuto.CMD_STAT:
+                return (data, True, self._auto.get_stat())
+
+            if cmd_name in self._auto.cmd_func.keys():
+                if cmd_name not in self.CMD_AUTO_READ:
+                    (ok, _, msg) = self.gate(client,
+                                             self.CMD_AUTO_PREFIX + cmd_name)
+                    if not ok:
+                        return (data, False, msg)
+
+                d = self._auto.send(cmd_name)
+                self._log.debug('d=%smm', '{:,}'.format(d))
+                return (data, True, {'d': d})
+
+            self._log.warning('%s: invalid auto command', cmd)
+            return (data, False, 'invalid auto command')
+
+        if cmd_name == OttoPiCtrl.CMD_ESTOP:
+            """
+            emergency stop: キューを通さずに、直接止める (リース不要)
+            """
+            self._lease.count_cmd(client)
+            self._ctrl.estop(time.monotonic())
+            return (data, True, '')
+
+        if cmd_name == OttoPiCtrl.CMD_ESTOP_CLEAR:
+            (ok, _, msg) = self.gate(client, cmd_name)
+            if not ok:
+                return (data, False, msg)
+
+            self._ctrl.estop_clear()
+            return (data, True, self._ctrl.stat_estop.summary())
+
+        if cmd_name == self.CMD_SERVER_STAT:
+            return (data, True, self.stat_func())
+
+        if cmd_name in (self.CMD_LEASE, self.CMD_RELEASE,
+                        self.CMD_LEASE_STAT):
+            return self.exec_lease(data, client, cmd_name)
+
+        """
+        control command
+        """
+        if cmd_name in self._ctrl.cmd_func.keys():
+            (ok, interrupt_flag, msg) = self.gate(client, cmd_name,
+                                                  interrupt_flag)
+            if not ok:
+                return (data, False, msg)
+
+            self._ctrl.send(cmd, interrupt_flag)
+            return (data, True, '')
+
+        msg = 'invalid control command'
+        self._log.warning('%s: %s', cmd, msg)
+        return (data, False, msg)
+
+    def exec_key(self, ch, client=None):
+        """
+        one-key command
+        """
+        if ch not in self.CMD_KEY.keys():
+            self._ctrl.send(OttoPiCtrl.CMD_STOP)
+            self._log.warning('invalid 1-key command:%a .. stop', ch)
+            return (ch, False, 'invalid 1-key command')
+
+        cmd = self.CMD_KEY[ch]
+        self._log.debug('ch=%a, cmd=%s', ch, cmd)
+
+        (ok, interrupt_flag, msg) = self.gate(client, cmd)
+        if not ok:
+            return ('%s(%s)' % (ch, cmd), False, msg)
+
+        if cmd.startswith(self.CMD_AUTO_PREFIX):
+            # auto command
+            self._auto.send(cmd.replace(self.CMD_AUTO_PREFIX, ''))
+        else:
+            # control command
+            self._ctrl.send(cmd, interrupt_flag)
+
+        return ('%s(%s)' % (ch, cmd), True, '')
+
+
 class OttoPiHandler(socketserver.StreamRequestHandler):
     def __init__(self, request, client_address, server):
         self._dbg = server._dbg
         self._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('client_address: %s', client_address)
 
-        self._svr     = server
-        self._ctrl = server._ctrl
-        self._auto = server._auto
-
-        self.cmd_key = {
-            # auto switch commands
-            '@': 'auto_on',
-            ' ': 'auto_off',
-
-            # robot control commands
-            'w': 'forward',
-            'q': 'left_forward',
-            'e': 'right_forward',
-            'x': 'backward',
-            'W': 'suriashi_fwd',
-            'a': 'turn_left',
-            'd': 'turn_right',
-            'A': 'slide_left',
-            'D': 'slide_right',
-            '1': 'happy',
-            '2': 'hi_right',
-            '3': 'hi_left',
-            '4': 'bye_right',
-            '5': 'bye_left',
-            '6': 'surprised',
-            '8': 'ojigi',
-            '9': 'ojigi2',
-            '0': 'home',
-
-            'h': 'move_up0',
-            'H': 'move_down0',
-            'j': 'move_up1',
-            'J': 'move_down1',
-            'k': 'move_up2',
-            'K': 'move_down2',
-            'l': 'move_up3',
-            'L': 'move_down3',
-
-            'u': 'home_up0',
-            'U': 'home_down0',
-            'i': 'home_up1',
-            'I': 'home_down1',
-            'o': 'home_up2',
-            'O': 'home_down2',
-            'p': 'home_up3',
-            'P': 'home_down3',
-
-            's': OttoPiCtrl.CMD_STOP,
-            'S': OttoPiCtrl.CMD_STOP,
-            '' : OttoPiCtrl.CMD_END}
+        self._svr  = server
+        self._disp = server._disp
 
         return super().__init__(request, client_address, server)
 
     def setup(self):
         self._log.debug('')
+        self._svr.conn_open()
+        if self.request.family in (socket.AF_INET, socket.AF_INET6):
+            # 短いコマンドと返信なので、Nagle を止める
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                    True)
         return super().setup()
 
     def net_write(self, msg):
@@ -112,20 +514,17 @@ class OttoPiHandler(socketserver.StreamRequestHandler):
         except Exception as e:
             self._log.warning('%s:%s', type(e).__name__, e)
 
-    def send_reply(self, cmd, accept=True, msg=''):
-        self._log.debug('cmd=%s, accept=%s, msg=%s', cmd, accept, msg)
-
-        ret_str = json.dumps({
-            'CMD': cmd,
-            'ACCEPT': accept,
-            'MSG': msg
-        })
-        self._log.debug('ret_str=%s', ret_str)
+    def push(self, session):
+        """
+        購読中のフレームを送る
 
-        ret = ret_str.encode('utf-8')
-        self._log.info('ret=%a', ret)
-
-        self.net_write(ret)
+        送信バッファが空いていない(クライアントが遅れている)場合、
+        そのフレームは捨てる
+        """
+        (_, w, _) = select.select([], [self.request], [], 0)
+        out = session.tick(time.monotonic(), writable=len(w) > 0)
+        if len(out) > 0:
+            self.net_write(out)
 
     def handle(self):
         self._log.debug('')
@@ -138,11 +537,23 @@ class OttoPiHandler(socketserver.StreamRequestHandler):
         #  0x22 LINEMODE
         # self.net_write(b'\xff\xfd\x22')
 
-        self.net_write('#Ready\r\n'.encode('utf-8'))
+        self.net_write(READY)
 
+        client = 'unix'
+        if isinstance(self.client_address, tuple):
+            client = self.client_address[0]
+        session = ProtoSession(self._disp, client, debug=self._dbg)
         net_data = b''
-        flag_continue = True
-        while flag_continue:
+        while True:
+            # 購読中は、次のフレームの時刻まで待つ
+            t_next = session.next_tick()
+            if t_next is not None:
+                timeout = max(t_next - time.monotonic(), 0)
+                (r, _, _) = select.select([self.request], [], [], timeout)
+                if len(r) == 0:
+                    self.push(session)
+                    continue
+
             # データー受信
             try:
                 net_data = self.request.recv(512)
@@ -152,198 +563,114 @@ class OttoPiHandler(socketserver.StreamRequestHandler):
             except BaseException as e:
                 self._log.warning('BaseException:%s:%s.', type(e), e)
                 self._log.warning('send: OttoPiCtrl.CMD_STOP')
-                self._ctrl.send(OttoPiCtrl.CMD_STOP)
+                self._disp.stop()
                 return
             else:
                 self._log.debug('net_data:%a', net_data)
 
-            # デコード(UTF-8)
-            try:
-                decoded_data = net_data.decode('utf-8')
-            except UnicodeDecodeError as e:
-                self._log.warning('%s:%s .. ignored', type(e), e)
-                continue
-            else:
-                self._log.debug('decoded_data:%a', decoded_data)
-
-            self.net_write('\r\n'.encode('utf-8'))
-
-            # 文字列抽出(コントロールキャラクター削除)
-            data = ''
-            for ch in decoded_data:
-                if ord(ch) >= 0x20:
-                    data += ch
-            self._log.debug('data=%a', data)
-
-            # 文字数が0の場合、コネクションが切断されたと判断し終了
-            if len(data) == 0:
-                msg = 'No data .. disconnect'
-                self._log.warning(msg)
-                self.net_write((msg + '\r\n').encode('utf-8'))
+            (out, done) = session.feed(net_data)
+            if len(out) > 0:
+                self.net_write(out)
+            if done:
                 break
 
-            # 制御スレッドが動いていない場合は(異常終了など?)、再起動
-            if not self._ctrl.is_active():
-                self._log.warning('robot control thread is dead !? .. restart')
-                self._svr._ctrl = OttoPiCtrl(self._svr._pi,
-                                             debug=self._svr._dbg)
-
-                self._ctrl = self._svr._ctrl
-                self._ctrl.start()
-
-            # 自動運転スレッドが動いていない場合は(異常終了など?)、再起動
-            if not self._auto.is_active():
-                self._log.warning('auto control thread is dead !? .. restart')
-                self._svr._auto = OttoPiAuto(self._ctrl, debug=self._svr._dbg)
-
-                self._auto = self._svr._auto
-                self._auto.start()
-
-            """
-            word command
-            
-              ex. ":.forward 2", ":happy 1", ":auto_off"
-
-            """
-            if data[0] == OttoPiServer.CMD_PREFIX:
-                cmd = data[1:]
-                interrupt_flag = True
-
-                if data[1] == OttoPiServer.CMD_PREFIX2:
-                    cmd = data[2:]
-                    interrupt_flag = False
-
-                cmd_name = cmd.split()[0]
-
-                self._log.info('cmd=%s, cmd_name=%s, interrupt_flag=%s',
-                               cmd, cmd_name, interrupt_flag)
-
-                if cmd.startswith(OttoPiServer.CMD_AUTO_PREFIX):
-                    """
-                    auto command
-
-                    注意
-                    ----
-                    auto commandは、回数パラメータがないため、
-                    cmd_nameだけをsendする。
-
-                    """
-                    auto_cmd = cmd.replace(OttoPiServer.CMD_AUTO_PREFIX, '')
-                    cmd_name = cmd_name.replace(OttoPiServer.CMD_AUTO_PREFIX,
-                                                '')
-                    self._log.info('auto_cmd=%s, cmd_name=%s',
-                                   auto_cmd, cmd_name)
-
-                    if cmd_name in self._auto.cmd_func.keys():
-                        d = self._auto.send(cmd_name)
-                        self._log.info('d=%smm', '{:,}'.format(d))
-
-                        self.send_reply(data, True, {'d': d})
-                    else:
-                        self._log.warning('%s: invalid auto command', auto_cmd)
-                        self.send_reply(data, False, 'invalid auto command')
-                else:
-                    """
-                    control command
-                    """
-                    if cmd_name in self._ctrl.cmd_func.keys():
-                        self._ctrl.send(cmd, interrupt_flag)
-                        self.send_reply(data, True, '')
-                    else:
-                        msg = 'invalid control command'
-                        self._log.warning('%s: %s', cmd, msg)
-                        self.send_reply(data, False, msg)
-
-                continue
-
-            # one-key command
-            for ch in data:
-                self._log.info('ch=%a', ch)
-
-                if ch not in self.cmd_key.keys():
-                    self._ctrl.send(OttoPiCtrl.CMD_STOP)
-                    self._log.warning('invalid 1-key command:%a .. stop', ch)
-                    self.send_reply(ch, False, 'invalid 1-key command')
-                    continue
-
-                cmd = self.cmd_key[ch]
-                self._log.info('cmd=%s', cmd)
-
-                if cmd.startswith(OttoPiServer.CMD_AUTO_PREFIX):
-                    # auto command
-                    auto_cmd = cmd.replace(OttoPiServer.CMD_AUTO_PREFIX, '')
-                    self._log.info('auto_cmd=%s', auto_cmd)
-
-                    self._auto.send(auto_cmd)
-                    self.send_reply('%s(%s)' % (ch, cmd), True, '')
-
-                else:
-                    # control command
-                    self._ctrl.send(cmd)
-                    self.send_reply('%s(%s)' % (ch, cmd), True, '')
+            # 受信が続いていても、時刻が来ていればフレームを送る
+            t_next = session.next_tick()
+            if t_next is not None and t_next <= time.monotonic():
+                self.push(session)
 
         self._log.debug('done')
 
     def finish(self):
         self._log.debug('')
+        self._svr.conn_close()
         return super().finish()
 
 
 class OttoPiServer(socketserver.ThreadingTCPServer):
     DEF_PORT = 12345
-    CMD_PREFIX = ':'           # word command
-    CMD_PREFIX2 = '.'          # interupt off
-    CMD_AUTO_PREFIX = 'auto_'  # auto command
-
-    def __init__(self, pi=None, port=DEF_PORT, debug=False):
+    CMD_PREFIX = OttoPiDispatcher.CMD_PREFIX
+    CMD_PREFIX2 = OttoPiDispatcher.CMD_PREFIX2
+    CMD_AUTO_PREFIX = OttoPiDispatcher.CMD_AUTO_PREFIX
+
+    def __init__(self, pi=None, port=DEF_PORT, unix=True,
+                 lease_sec=OttoPiLease.DEF_LEASE_SEC,
+                 lease_mode=OttoPiLease.DEF_MODE, sim=False, debug=False):
+        """
+        Parameters
+        ----------
+        unix: bool
+            True なら、Unix ドメインソケット(unix_path(port))でも待ち受ける
+        lease_sec, lease_mode, sim:
+            OttoPiDispatcher と同じ
+        """
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('pi=%s, port=%s', pi, port)
+        self._log.debug('pi=%s, port=%s, unix=%s, lease_sec=%s, lease_mode=%s',
+                        pi, port, unix, lease_sec, lease_mode)
+        self._log.debug('sim=%s', sim)
 
-        if type(pi) == pigpio.pi:
-            self._pi   = pi
-            self._mypi = False
-        else:
-            self._pi   = pigpio.pi()
-            self._mypi = True
-        self._log.debug('mypi = %s', self._mypi)
-
-        self._ctrl = OttoPiCtrl(self._pi, debug=self._dbg)
-        self._ctrl.start()
-
-        self._auto = OttoPiAuto(self._ctrl, debug=self._dbg)
-        self._auto.start()
-
-        time.sleep(1)
+        self._conn_lock = threading.Lock()
+        self.conn_n = 0
+        self.conn_total = 0
 
         self._port  = port
 
+        # 同じポートのサーバーが動いている場合は、ここで失敗する
+        # (状態共有メモリや Unix ドメインソケットに触る前に)
+        super().__init__(('', self._port), OttoPiHandler)
+
         try:
-            super().__init__(('', self._port), OttoPiHandler)
-        except Exception as e:
-            self._log.warning('%s:%s', type(e).__name__, e)
-            return None
+            self._disp = OttoPiDispatcher(pi, lease_sec, lease_mode, sim,
+                                          state_name=state_name(port),
+                                          debug=self._dbg)
+        except BaseException:
+            self.server_close()
+            raise
+        self._disp.stat_func = self.get_stat
+
+        self._unix_svr = None
+        if unix:
+            try:
+                self._unix_svr = OttoPiUnixServer(unix_path(port), self,
+                                                  debug=self._dbg)
+            except OSError as e:
+                self._log.warning('%s:%s', type(e).__name__, e)
+
+    def conn_open(self):
+        with self._conn_lock:
+            self.conn_n += 1
+            self.conn_total += 1
+
+    def conn_close(self):
+        with self._conn_lock:
+            self.conn_n -= 1
+
+    def get_stat(self):
+        """
+        接続数とスレッド数
+        """
+        return {'server': 'thread',
+                'clients': self.conn_n,
+                'accepted': self.conn_total,
+                'threads': threading.active_count()}
 
     def serve_forever(self):
         self._log.debug('')
+
+        if self._unix_svr is not None:
+            threading.Thread(target=self._unix_svr.serve_forever,
+                             daemon=True).start()
+
         return super().serve_forever()
 
     def end(self):
         self._log.debug('')
-
-        if self._auto.is_active():
-            self._auto.end()
-            self._log.debug('_auto thread: done')
-
-        if self._ctrl.is_active():
-            self._ctrl.end()
-            self._log.debug('_ctrl thread: done')
-
-        if self._mypi:
-            self._log.debug('clean up pigpio')
-            self._pi.stop()
-            self._mypi = False
-
+        if self._unix_svr is not None:
+            self._unix_svr.shutdown()
+            self._unix_svr.server_close()
+            self._unix_svr = None
+        self._disp.end()
         self._log.debug('done')
 
     def _del_(self):
@@ -351,14 +678,60 @@ class OttoPiServer(socketserver.ThreadingTCPServer):
         self.end()
 
 
+class OttoPiUnixServer(socketserver.ThreadingUnixStreamServer):
+    """
+    OttoPiServer の Unix ドメインソケット版の待ち受け
+
+    ディスパッチャーと接続数は、OttoPiServer と共有する
+    """
+    def __init__(self, path, tcp_svr, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, debug)
+        self._log.debug('path=%s', path)
+
+        self._path = path
+        self._tcp_svr = tcp_svr
+        self._disp = tcp_svr._disp
+
+        # 前回の異常終了などで残っている場合は、削除する
+        if remove_stale_unix(path):
+            self._log.warning('%s: stale .. removed', path)
+
+        # bind できた場合だけ、server_close() でパスを削除する
+        self._bound = False
+        super().__init__(path, OttoPiHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        self._bound = True
+
+    def conn_open(self):
+        self._tcp_svr.conn_open()
+
+    def conn_close(self):
+        self._tcp_svr.conn_close()
+
+    def server_close(self):
+        super().server_close()
+        if not self._bound:
+            return
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
 class OttoPiServerApp:
-    def __init__(self, port, debug=False):
+    def __init__(self, port, unix, lease_sec, lease_mode, sim, debug=False):
         self._dbg = debug
         self._log = get_logger(__class__.__name__, debug)
-        self._log.debug('port=%d', port)
+        self._log.debug('port=%d, unix=%s, lease_sec=%s, lease_mode=%s',
+                        port, unix, lease_sec, lease_mode)
+        self._log.debug('sim=%s', sim)
 
         self._port = port
-        self._svr = OttoPiServer(None, self._port, debug=self._dbg)
+        self._svr = OttoPiServer(None, self._port, unix, lease_sec, lease_mode,
+                                 sim, debug=self._dbg)
 
     def main(self):
         self._log.debug('')
@@ -373,13 +746,26 @@ class OttoPiServerApp:
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('port', type=int, default=OttoPiServer.DEF_PORT)
+@click.option('--no_unix', '-U', 'no_unix', is_flag=True, default=False,
+              help='do not listen on unix domain socket')
+@click.option('--lease_sec', '-l', 'lease_sec', type=float,
+              default=OttoPiLease.DEF_LEASE_SEC,
+              help='control lease [sec] (0: no arbitration)')
+@click.option('--lease_mode', '-m', 'lease_mode',
+              type=click.Choice(OttoPiLease.MODES),
+              default=OttoPiLease.DEF_MODE,
+              help='commands from non-holders')
+@click.option('--sim', 'sim', is_flag=True, default=False,
+              help='simulate servos and ToF sensors (no hardware)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(port, debug):
+def main(port, no_unix, lease_sec, lease_mode, sim, debug):
     _log = get_logger(__name__, debug)
-    _log.info('port=%d', port)
+    _log.info('port=%d, no_unix=%s, lease_sec=%s, lease_mode=%s, sim=%s',
+              port, no_unix, lease_sec, lease_mode, sim)
 
-    obj = OttoPiServerApp(port, debug=debug)
+    obj = OttoPiServerApp(port, not no_unix, lease_sec, lease_mode, sim,
+                          debug=debug)
     try:
         obj.main()
     finally:
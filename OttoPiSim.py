@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+ハードウェアのシミュレーション (サーボと距離センサー)
+
+Raspberry Pi のない普通の Linux で、OttoPiServer を動かすための代用品。
+負荷試験(OttoPiLoadGen)や、ブリッジの動作確認に使う。
+
+ * SimPi: pigpio.pi の代わり。サーボのパルス幅を覚えておくだけ
+ * SimToF: VL53L0X / VL53L0XPy の代わり。
+   測定時間(モードごとの timing budget)だけ待って、
+   ゆっくり近づいたり離れたりする障害物の距離を返す
+
+OttoPiServer などの --sim で使う (OttoPiDispatcher(sim=True))。
+ToFSampler の driver は 'sim'。
+
+-----------------------------------------------------------------
+OttoPiServer --sim
+ |
+ +- OttoPiAuto -- ToFSampler -- SimToF (driver='sim')
+ +- OttoPiCtrl -- OttoPiMotion -- PiServo -- SimPi
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from VL53L0XPy import VL53L0XPy
+import VL53L0X as VL53L0X
+import threading
+import random
+import math
+import time
+
+from MyLogger import get_logger
+
+
+class SimCallback:
+    """
+    pigpio.pi.callback() の戻り値の代わり
+    """
+    def cancel(self):
+        pass
+
+
+class SimPi:
+    """
+    pigpio.pi の代わり
+    """
+    connected = True
+
+    def __init__(self, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('')
+
+        self._lock = threading.Lock()
+        self.pulse = {}
+        self.write_count = 0
+
+    def set_servo_pulsewidth(self, pin, pulse):
+        with self._lock:
+            self.pulse[pin] = pulse
+            self.write_count += 1
+        return 0
+
+    def get_servo_pulsewidth(self, pin):
+        with self._lock:
+            return self.pulse.get(pin, 0)
+
+    def set_mode(self, pin, mode):
+        return 0
+
+    def set_pull_up_down(self, pin, pud):
+        return 0
+
+    def set_watchdog(self, pin, timeout):
+        return 0
+
+    def callback(self, pin, edge, func=None):
+        return SimCallback()
+
+    def stop(self):
+        self._log.debug('write_count=%d', self.write_count)
+
+
+class SimToF:
+    """
+    VL53L0X / VL53L0XPy の代わり (ToFSampler の driver='sim')
+
+    障害物の距離は、SCENE_SEC 周期で D_MIN .. D_MAX を行き来する
+    (センサーごとに位相をずらし、NOISE_MM のノイズをのせる)
+    """
+    D_MIN = 150       # mm
+    D_MAX = 1500      # mm
+    SCENE_SEC = 20.0  # sec
+    NOISE_MM = 10     # mm
+
+    DEF_BUDGET_US = 33000
+
+    def __init__(self, TCA9548A_Num=255, TCA9548A_Addr=0, debug=False,
+                 **kwargs):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('TCA9548A_Num=%s, TCA9548A_Addr=0x%02x',
+                        TCA9548A_Num, TCA9548A_Addr)
+
+        self.ch = TCA9548A_Num
+        self.phase = (TCA9548A_Num % 8) / 8
+        self.budget_us = self.DEF_BUDGET_US
+        self._t0 = time.monotonic()
+
+    def start_ranging(self, mode=VL53L0X.VL53L0X_GOOD_ACCURACY_MODE):
+        self._log.debug('mode=%s', mode)
+        self.budget_us = VL53L0XPy.MODE_PARAM[mode][0]
+
+    def stop_ranging(self):
+        self._log.debug('')
+
+    def get_timing(self):
+        """
+        測定周期 [us] (VL53L0X.get_timing() と同じく、budget + 1ms)
+        """
+        return self.budget_us + 1000
+
+    def distance(self, t):
+        x = (t - self._t0) / self.SCENE_SEC + self.phase
+        d = (self.D_MIN + self.D_MAX) / 2 + \
+            (self.D_MAX - self.D_MIN) / 2 * math.cos(2 * math.pi * x)
+        return int(d + random.gauss(0, self.NOISE_MM))
+
+    def get_distance(self):
+        time.sleep(self.get_timing() / 1000000)
+        return max(self.distance(time.monotonic()), 0)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+ロボットの状態を共有メモリで公開する
+
+OttoPiCtrl, OttoPiAuto が、現在の状態(サーボのパルス幅、距離、
+自動運転のON/OFF、実行中のコマンドなど)を、固定レイアウトの
+共有メモリ(multiprocessing.shared_memory)に書き込む。
+
+同じPi上の他のプロセス(HTTP/WebSocket/BLEブリッジ、状態表示など)は、
+TCPでコマンドを送らずに、状態のスナップショットを読むことができる。
+
+共有メモリの名前は、OttoPiServer のポート番号ごと(state_name(port))。
+同じホストで複数のサーバーを動かしても、ブロックは別々になる。
+
+書き込みと読み込みの整合性は、シーケンスロック(seqlock)で保証する。
+ * 書き込み側: seqを奇数にしてから書き込み、終わったら偶数に戻す。
+ * 読み込み側: seqが偶数で、読み込み前後でseqが変わっていなければ有効。
+
+-----------------------------------------------------------------
+OttoPiState -- 状態共有メモリ
+ ^  ^
+ |  +- OttoPiAuto -- ロボットの自動運転 (距離, ON/OFF, enable)
+ +---- OttoPiCtrl -- コマンド制御 (パルス幅, 実行中のコマンド)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from multiprocessing import shared_memory, resource_tracker
+import threading
+import struct
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+DEF_PORT = 12345  # OttoPiServer.DEF_PORT
+NAME_FMT = 'OttoPiState-%d'
+
+
+def state_name(port):
+    """
+    OttoPiServer のポート番号に対応する共有メモリの名前
+    """
+    return NAME_FMT % port
+
+
+class OttoPiState:
+    """
+    固定レイアウトの状態ブロック
+
+    offset  size  field
+    ------  ----  -----------------------------------
+         0     4  magic (b'OTPI')
+         4     2  version
+         6     2  (reserved)
+         8     4  seq (seqlock)
+        12     4  (reserved)
+        16     8  ctrl_ts: OttoPiCtrl の最終更新時刻
+        24     8  auto_ts: OttoPiAuto の最終更新時刻
+        32     8  pulse[4] (uint16)
+        40     4  distance [mm] (int32)
+        44     1  ctrl_active
+        45     1  auto_active
+        46     1  auto_on
+        47     1  auto_enable
+        48    32  cmd (UTF-8, NUL padding)
+    """
+    DEF_NAME = state_name(DEF_PORT)
+
+    MAGIC   = b'OTPI'
+    VERSION = 1
+
+    HDR_FMT = '<4sHH'
+    SEQ_FMT = '<I'
+    SEQ_OFFSET = 8
+
+    BODY_OFFSET = 16
+    BODY_FMT = '<dd4HiBBBB32s'
+    SIZE = BODY_OFFSET + struct.calcsize(BODY_FMT)
+
+    PULSE_N = 4
+    CMD_LEN = 32
+
+    # field name: (offset, struct format)
+    FIELD = {
+        'ctrl_ts':     (16, '<d'),
+        'auto_ts':     (24, '<d'),
+        'pulse':       (32, '<4H'),
+        'distance':    (40, '<i'),
+        'ctrl_active': (44, '<B'),
+        'auto_active': (45, '<B'),
+        'auto_on':     (46, '<B'),
+        'auto_enable': (47, '<B'),
+        'cmd':         (48, '<32s'),
+    }
+
+    READ_RETRY = 100
+
+    def __init__(self, name=DEF_NAME, create=False, debug=False):
+        """
+        Parameters
+        ----------
+        name: str
+            共有メモリの名前
+        create: bool
+            True: 作成して初期化する(書き込み側)
+            False: 既存のブロックに接続する(読み込み側)
+            作成したプロセスだけが、close() でブロックを削除する
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('name=%s, create=%s', name, create)
+
+        self.name = name
+        self.owner = create
+
+        # 同一プロセス内の複数の書き込みスレッドを排他する
+        self._wlock = threading.Lock()
+
+        if create:
+            try:
+                self._shm = shared_memory.SharedMemory(name, create=True,
+                                                       size=self.SIZE)
+            except FileExistsError:
+                # 前回の異常終了などで残っている場合は、再利用する
+                # (このプロセスが作成したものではないので、削除はしない)
+                self._log.warning('%s: already exists .. reuse', name)
+                self._shm = self._attach(name)
+                self.owner = False
+
+            self._buf = self._shm.buf
+            self._buf[:self.SIZE] = bytes(self.SIZE)
+            struct.pack_into(self.HDR_FMT, self._buf, 0,
+                             self.MAGIC, self.VERSION, 0)
+        else:
+            self._shm = self._attach(name)
+            self._buf = self._shm.buf
+
+            (magic, ver, _) = struct.unpack_from(self.HDR_FMT, self._buf, 0)
+            if magic != self.MAGIC or ver != self.VERSION:
+                self.close()
+                raise ValueError('%s: invalid state block (%a, %s)' % (
+                    name, magic, ver))
+
+    def _attach(self, name):
+        self._log.debug('name=%s', name)
+
+        shm = shared_memory.SharedMemory(name, create=False)
+        if shm.size < self.SIZE:
+            shm.close()
+            raise ValueError('%s: too small (%d < %d)' % (
+                name, shm.size, self.SIZE))
+
+        # 接続しただけのプロセスが終了時にブロックを削除しないように
+        # resource_trackerの登録を外す
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+
+        return shm
+
+    def close(self):
+        self._log.debug('owner=%s', self.owner)
+
+        if self._shm is None:
+            return
+
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._shm = None
+
+        self._log.debug('done')
+
+    def _get_seq(self):
+        return struct.unpack_from(self.SEQ_FMT, self._buf, self.SEQ_OFFSET)[0]
+
+    def _set_seq(self, seq):
+        struct.pack_into(self.SEQ_FMT, self._buf, self.SEQ_OFFSET,
+                         seq & 0xffffffff)
+
+    def update(self, **fields):
+        """
+        指定されたフィールドだけを書き換える
+
+        ex. state.update(distance=150, auto_ts=time.time())
+        """
+        if self._buf is None:
+            return
+
+        with self._wlock:
+            seq = self._get_seq()
+            self._set_seq(seq + 1)  # odd: writing
+
+            for (key, val) in fields.items():
+                (offset, fmt) = self.FIELD[key]
+                if key == 'pulse':
+                    struct.pack_into(fmt, self._buf, offset,
+                                     *[int(p) for p in val[:self.PULSE_N]])
+                elif key == 'cmd':
+                    struct.pack_into(fmt, self._buf, offset,
+                                     val.encode('utf-8')[:self.CMD_LEN])
+                else:
+                    struct.pack_into(fmt, self._buf, offset, val)
+
+            self._set_seq(seq + 2)  # even: done
+
+    def read(self):
+        """
+        整合性のとれたスナップショットを読む
+
+        Returns
+        -------
+        state: dict
+            書き込み中でリトライ回数を超えた場合は None
+        """
+        for retry in range(self.READ_RETRY):
+            seq1 = self._get_seq()
+            if seq1 & 1:
+                time.sleep(0)
+                continue
+
+            body = bytes(self._buf[self.BODY_OFFSET:self.SIZE])
+
+            if self._get_seq() == seq1:
+                break
+        else:
+            self._log.warning('retry over')
+            return None
+
+        (ctrl_ts, auto_ts, p0, p1, p2, p3, distance,
+         ctrl_active, auto_active, auto_on, auto_enable,
+         cmd) = struct.unpack(self.BODY_FMT, body)
+
+        return {
+            'seq': seq1,
+            'ctrl_ts': ctrl_ts,
+            'auto_ts': auto_ts,
+            'pulse': [p0, p1, p2, p3],
+            'distance': distance,
+            'ctrl_active': bool(ctrl_active),
+            'auto_active': bool(auto_active),
+            'auto_on': bool(auto_on),
+            'auto_enable': bool(auto_enable),
+            'cmd': cmd.rstrip(b'\0').decode('utf-8', 'replace'),
+        }
+
+
+class OttoPiStateApp:
+    def __init__(self, name, interval, count, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('name=%s, interval=%s, count=%s',
+                        name, interval, count)
+
+        self._interval = interval
+        self._count = count
+        self._state = OttoPiState(name, create=False, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        n = 0
+        prev_seq = None
+        while self._count == 0 or n < self._count:
+            st = self._state.read()
+            if st is not None and st['seq'] != prev_seq:
+                prev_seq = st['seq']
+                print('%s pulse=%s d=%5dmm on=%d enable=%d cmd=\'%s\'' % (
+                    time.strftime('%H:%M:%S'),
+                    st['pulse'], st['distance'],
+                    st['auto_on'], st['auto_enable'],
+                    st['cmd']))
+            n += 1
+            time.sleep(self._interval)
+
+    def end(self):
+        self._log.debug('')
+        self._state.close()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+print robot state from shared memory
+''')
+@click.option('--port', '-p', 'port', type=int, default=DEF_PORT,
+              help='port number of OttoPiServer')
+@click.option('--name', '-n', 'name', type=str, default=None,
+              help='shared memory name (default: by port)')
+@click.option('--interval', '-i', 'interval', type=float, default=0.5,
+              help='interval [sec]')
+@click.option('--count', '-c', 'count', type=int, default=0,
+              help='count (0: forever)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(port, name, interval, count, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('port=%s, name=%s, interval=%s, count=%s',
+               port, name, interval, count)
+
+    if name is None:
+        name = state_name(port)
+
+    app = OttoPiStateApp(name, interval, count, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,16 @@
 #
 """
 OttoPi WebSocket Server
+
+コマンドは AsyncOttoPiClient で送るので、ロボットの返信を待つ間も
+イベントループは止まらない (複数のユーザーのコマンドを同時に中継する)。
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2020'
 
-from OttoPiClient import OttoPiClient
+from OttoPiAsyncClient import AsyncOttoPiClient
 import asyncio
+import json
 import websockets
 import time
 import click
@@ -30,6 +34,8 @@ class OttoPiWebsockServer():
 
         self.svrhost = svrhost
         self.svrport = svrport
+        self._client = AsyncOttoPiClient(self.svrhost, self.svrport,
+                                         debug=False)
 
         # websockets
         self.start_server = websockets.serve(self.handle, host, port)
@@ -46,22 +52,25 @@ class OttoPiWebsockServer():
 
     def end(self):
         self._log.debug('')
+        self._log.info('client: %s', self._client.stat)
+        self.loop.run_until_complete(self._client.close())
 
     async def handle(self, websocket, path):
         self._log.debug('websocket=%s:%s, path=%s',
                         websocket.local_address,
                         websocket.host,
                         path)
-        msg = await websocket.recv()
-        self._log.debug('msg=%s', msg)
+        name = 'ws:%s' % websocket.remote_address[0]
+
+        async for msg in websocket:
+            self._log.debug('msg=%s', msg)
 
-        robot_client = OttoPiClient(self.svrhost, self.svrport, debug=False)
-        ret = robot_client.send_cmd(msg)
-        self._log.debug('ret=%a', ret)
+            # 1つの接続を、すべてのユーザーで共有する
+            ret = await self._client.send_cmd(msg, name=name)
+            self._log.debug('ret=%a', ret)
 
-        await websocket.send(ret)
+            await websocket.send(json.dumps(ret))
 
-        robot_client.close()
         self._log.info('done')
 
 class App:
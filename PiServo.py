@@ -9,6 +9,7 @@ __author__ = 'Yoichi Tanibayashi'
 __date__   = '2019'
 
 import pigpio
+import threading
 import time
 
 #####
@@ -43,7 +44,7 @@ class PiServo:
         self.logger.debug('pulse_min  = %s', pulse_min)
         self.logger.debug('pulse_max  = %s', pulse_max)
 
-        if type(pi) == pigpio.pi:
+        if pi is not None:
             self.pi   = pi
             self.mypi = False
         else:
@@ -75,12 +76,35 @@ class PiServo:
 
         self.cur_pulse = [0] * self.pin_n
 
+        # パルス幅が変わる度に呼ばれる (ex. 状態共有メモリへの書き込み)
+        self.pulse_cb = None
+
+        # 非常停止: halt()からclear_halt()まで、パルス幅を変えない(off()以外)
+        # (別スレッドから呼ばれるので、書き込み中のset_pulse()とは排他する)
+        self.halted = False
+        self._halt_lock = threading.Lock()
+
         self.home()
         self.off()
 
     def off(self):
         self.logger.debug('')
-        self.set_pulse(self.pulse_off)
+        self.set_pulse(self.pulse_off, force=True)
+
+    def halt(self):
+        """
+        非常停止: 現在の位置で止める
+
+        これ以降、clear_halt()まで、set_pulse(), move()は何もしない。
+        """
+        with self._halt_lock:
+            self.halted = True
+        self.logger.warning('cur_pulse=%s', self.cur_pulse)
+
+    def clear_halt(self):
+        self.logger.debug('')
+        with self._halt_lock:
+            self.halted = False
 
     def get_cur_position(self):
         cur_pos = [(self.cur_pulse[i] - self.pulse_home[i])
@@ -88,24 +112,35 @@ class PiServo:
         self.logger.debug('cur_pos = %s', cur_pos)
         return cur_pos
 
-    def set_pulse(self, pulse):
-        self.logger.debug('pulse=%s', pulse)
+    def set_pulse(self, pulse, force=False):
+        """
+        force: True の場合、非常停止中でも変更する
+        """
+        self.logger.debug('pulse=%s, force=%s', pulse, force)
 
-        for i in range(self.pin_n):
-            if pulse[i] != 0:
-                if pulse[i] < self.pulse_min[i]:
-                    self.logger.warn('[%d]: %d < %d !', i, pulse[i],
-                                     self.pulse_min[i])
-                    pulse[i] = self.pulse_min[i]
+        with self._halt_lock:
+            if self.halted and not force:
+                self.logger.debug('halted .. ignored')
+                return
 
-                if pulse[i] > self.pulse_max[i]:
-                    self.logger.warn('[%d]: %d > %d !', i, pulse[i],
-                                     self.pulse_max[i])
-                    pulse[i] = self.pulse_max[i]
+            for i in range(self.pin_n):
+                if pulse[i] != 0:
+                    if pulse[i] < self.pulse_min[i]:
+                        self.logger.warn('[%d]: %d < %d !', i, pulse[i],
+                                         self.pulse_min[i])
+                        pulse[i] = self.pulse_min[i]
+
+                    if pulse[i] > self.pulse_max[i]:
+                        self.logger.warn('[%d]: %d > %d !', i, pulse[i],
+                                         self.pulse_max[i])
+                        pulse[i] = self.pulse_max[i]
+
+                    self.cur_pulse[i] = pulse[i]
 
-                self.cur_pulse[i] = pulse[i]
+                self.pi.set_servo_pulsewidth(self.pin[i], pulse[i])
 
-            self.pi.set_servo_pulsewidth(self.pin[i], pulse[i])
+        if self.pulse_cb is not None:
+            self.pulse_cb(self.cur_pulse)
 
     def home(self):
         self.logger.debug('')
@@ -130,6 +165,10 @@ class PiServo:
     def move_p(self, pulse, v=None, quick=False):
         self.logger.debug('pulse=%s, v=%s, quick=%s', pulse, v, quick)
 
+        if self.halted:
+            self.logger.debug('halted .. ignored')
+            return
+
         if v is None:
             v = INTERVAL_FACTOR
 
@@ -177,6 +216,10 @@ class PiServo:
 
         p = [0] * self.pin_n
         for s in range(step_n):
+            if self.halted:
+                self.logger.debug('halted')
+                return
+
             for i in range(self.pin_n):
                 p[i] = pulse0[i] + dp[i] * (s + 1)
 
@@ -8,7 +8,7 @@ __date__   = '2019'
 
 '''
 
-from OttoPiClient import OttoPiClient
+from OttoPiClient import OttoPiClientPool
 from Led import Led
 from Switch import Switch, SwitchListener, SwitchEvent
 
@@ -72,6 +72,9 @@ class App:
         self.sl  = SwitchListener([self.sw], self.cb_sw, debug=self.debug)
         self.led = Led(self.led_pin)
 
+        self.robot = OttoPiClientPool('localhost', 12345, size=1,
+                                      debug=self.debug)
+
         self.blink_alive()
 
     def main(self):
@@ -83,6 +86,7 @@ class App:
 
     def end(self):
         self.logger.debug('')
+        self.robot.close()
 
     def blink_alive(self):
         self.logger.debug('')
@@ -146,9 +150,7 @@ class App:
     def call_robot(self, cmd):
         self.logger.debug('cmd')
 
-        rc = OttoPiClient('localhost', 12345, self.debug)
-        rc.send_cmd(cmd)
-        rc.close()
+        self.robot.send_cmd(cmd, name='button')
 
     def cb_sw(self, event):
         '''
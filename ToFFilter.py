@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+距離サンプルのフィルター
+
+直近のサンプル(ウィンドウ)に対して、まとめて(NumPyで)計算する。
+
+ 1. 無効値(0以下)は D_FAR とみなす (従来の補正と同じ)
+ 2. 中央値とMAD(中央絶対偏差)による外れ値除去 (Hampel filter)
+ 3. 外れ値を中央値で置き換えた系列に、EMA(指数移動平均)をかける
+ 4. 外れ値・無効値の割合と、ばらつき(MAD)から、信頼度(0..1)を求める
+
+velocity() で、タイムスタンプ付きの履歴から、接近速度を求める。
+
+信頼度が高ければ、1サンプルで判断を確定できる。
+
+-----------------------------------------------------------------
+OttoPiAuto -- ロボットの自動運転
+ |
+ +- ToFFilter -- 距離サンプルのフィルター
+ +- ToFSampler -- 距離センサーの測定
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import collections
+import numpy as np
+
+from MyLogger import get_logger
+
+
+FilterResult = collections.namedtuple(
+    'FilterResult', ['d', 'raw', 'median', 'mad', 'conf', 'n'])
+
+
+class ToFFilter:
+    DEF_WINDOW     = 5      # samples
+    DEF_WINDOW_SEC = 0.5    # sec
+    DEF_HAMPEL_K   = 3.0
+    DEF_ALPHA      = 0.6    # EMA
+    DEF_D_FAR      = 8000   # mm
+
+    # MADの下限 (量子化ノイズで、全て外れ値扱いにならないように)
+    MAD_MIN   = 10.0  # mm
+    # ばらつきによる信頼度の減衰 (MAD - MAD_MIN がこの値で信頼度 1/2)
+    CONF_MAD  = 30.0  # mm
+
+    # MAD を標準偏差相当に換算する係数
+    MAD_SCALE = 1.4826
+
+    # 速度を求めるのに必要なサンプル数と時間幅
+    VEL_SAMPLES_MIN = 4
+    VEL_SPAN_MIN    = 0.15  # sec
+
+    def __init__(self, window=DEF_WINDOW, window_sec=DEF_WINDOW_SEC,
+                 k=DEF_HAMPEL_K, alpha=DEF_ALPHA, d_far=DEF_D_FAR,
+                 debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('window=%s, window_sec=%s, k=%s, alpha=%s, d_far=%s',
+                        window, window_sec, k, alpha, d_far)
+
+        self.window = window
+        self.window_sec = window_sec
+        self.k = k
+        self.alpha = alpha
+        self.d_far = d_far
+
+    @staticmethod
+    def median(x):
+        """
+        np.median() より速い (小さい配列では、前処理の時間が大きい)
+        """
+        s = np.sort(x)
+        n = len(s)
+        return (s[(n - 1) // 2] + s[n // 2]) / 2
+
+    @staticmethod
+    def line_fit(t, y):
+        """
+        直線のあてはめ (np.polyfit(t, y, 1) と同じ結果)
+
+        Returns
+        -------
+        (slope, intercept): tuple
+        """
+        t_mean = np.sum(t) / len(t)
+        y_mean = np.sum(y) / len(y)
+        dt = t - t_mean
+        slope = np.dot(dt, y - y_mean) / np.dot(dt, dt)
+        return (slope, y_mean - slope * t_mean)
+
+    def apply(self, ts_list, mm_list):
+        """
+        Parameters
+        ----------
+        ts_list: list of float
+            タイムスタンプ [sec] (古い順)
+        mm_list: list of int
+            距離 [mm] (古い順)
+
+        Returns
+        -------
+        result: FilterResult
+            サンプルがない場合は None
+        """
+        if len(mm_list) == 0:
+            return None
+
+        ts = np.asarray(ts_list[-self.window:], dtype=float)
+        mm = np.asarray(mm_list[-self.window:], dtype=float)
+
+        # 古すぎるサンプルは使わない
+        fresh = ts >= ts[-1] - self.window_sec
+        ts = ts[fresh]
+        mm = mm[fresh]
+        raw = int(mm[-1])
+
+        valid = mm > 0
+        mm = np.where(valid, mm, self.d_far)
+
+        med = self.median(mm)
+        mad = max(self.median(np.abs(mm - med)) * self.MAD_SCALE, self.MAD_MIN)
+
+        inlier = np.abs(mm - med) <= self.k * mad
+        cleaned = np.where(inlier, mm, med)
+
+        # EMA: y = (1-a)^(n-1) x0 + sum_{i>=1} a (1-a)^(n-1-i) xi
+        n = len(cleaned)
+        w = self.alpha * (1 - self.alpha) ** np.arange(n - 1, -1, -1)
+        w[0] = (1 - self.alpha) ** (n - 1)
+        d = float(np.dot(w, cleaned))
+
+        # サンプル数が少ない場合も、信頼度を下げる
+        conf = (float(np.mean(inlier & valid))
+                * self.CONF_MAD / (self.CONF_MAD + mad - self.MAD_MIN)
+                * min(n / self.window, 1.0))
+
+        return FilterResult(int(round(d)), raw, float(med), float(mad),
+                            round(float(conf), 3), n)
+
+    def velocity(self, ts_list, mm_list):
+        """
+        距離の変化率 (最小二乗法の傾き)
+
+        直線からの残差で外れ値を除いてから、もう一度あてはめる。
+        無効値(0以下, d_far以上)は使わない。
+
+        Parameters
+        ----------
+        ts_list: list of float
+            タイムスタンプ [sec] (古い順)
+        mm_list: list of int
+            距離 [mm] (古い順)
+
+        Returns
+        -------
+        v: float
+            [mm/sec] (負: 近づいている)
+            サンプルが足りない場合は None
+        """
+        ts = np.asarray(ts_list, dtype=float)
+        mm = np.asarray(mm_list, dtype=float)
+
+        valid = (mm > 0) & (mm < self.d_far)
+        ts = ts[valid]
+        mm = mm[valid]
+        if len(mm) < self.VEL_SAMPLES_MIN:
+            return None
+
+        t = ts - ts[-1]
+        if -t[0] < self.VEL_SPAN_MIN:
+            return None
+
+        (slope, icpt) = self.line_fit(t, mm)
+
+        resid = np.abs(mm - (slope * t + icpt))
+        mad = max(self.median(resid) * self.MAD_SCALE, self.MAD_MIN)
+        inlier = resid <= self.k * mad
+        if np.count_nonzero(inlier) < self.VEL_SAMPLES_MIN:
+            return None
+
+        if not np.all(inlier):
+            (slope, icpt) = self.line_fit(t[inlier], mm[inlier])
+
+        return float(slope)
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+距離センサー(VL53L0X)のバックグラウンド測定
+
+専用スレッドがセンサーの測定周期(timing budget)で距離を読み、
+タイムスタンプ付きでリングバッファに書き込む。
+
+距離を使う側(OttoPiAuto, OttoPiServerのハンドラーなど)は、
+I2Cバスに触らずに、最新のサンプルとその経過時間を読む。
+
+リングバッファの書き込みは、このスレッドだけが行う(single writer)。
+読み込み側はロックを取らない。
+
+trace を指定すると、測定値をトレースファイル(ToFTrace)に記録する。
+
+drdy (センサーの GPIO1 をつないだピン)を指定すると、スレッドで
+測定完了を待つ代わりに、GPIO1 の割り込み(データレディ)で読み出す。
+pigpio のコールバックで読むので、待ち続けるスレッドがなく、
+測定完了から読み出しまでの遅れも小さい。
+
+subscribe(cb) で登録した関数は、サンプルごとに cb(ts, mm_list) で呼ばれる。
+
+driver で、センサーのドライバーを選ぶ。
+  'st': VL53L0X (ST API の vl53l0x_python.so)
+  'py': VL53L0XPy (smbus2 で直接読み書きする)
+  'sim': SimToF (OttoPiSim: センサーなしのシミュレーション)
+
+-----------------------------------------------------------------
+ToFSampler -- 距離センサーの測定スレッド (または割り込み)
+ |
+ +- SampleRing -- タイムスタンプ付きリングバッファ
+ +- VL53L0X, VL53L0XPy or SimToF -- 距離センサー (複数の場合は TCA9548A 経由)
+ +- pigpio -- データレディ割り込み (drdy)
+ +- ToFTraceWriter -- トレースファイルの記録
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from LatencyStat import LatencyStat
+from ToFTrace import ToFTraceWriter
+import VL53L0X as VL53L0X
+from VL53L0XPy import VL53L0XPy
+from OttoPiSim import SimToF
+from array import array
+import pigpio
+import threading
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class SampleRing:
+    """
+    (timestamp, mm[ch_n]) のリングバッファ
+
+    複数のセンサー(チャンネル)の値を、同じタイムスタンプで保持する。
+
+    書き込み側がデータを書き終えてから count を更新するので、
+    読み込み側は count を見てから、該当するスロットを読めばよい。
+    読んでいる間に上書きされた場合は、count の差で検出して読み直す。
+    """
+    DEF_SIZE = 256
+
+    def __init__(self, size=DEF_SIZE, ch_n=1):
+        self.size = size
+        self.ch_n = ch_n
+        self._ts = array('d', [0.0] * size)
+        self._mm = array('i', [0] * (size * ch_n))
+
+        # 書き込まれたサンプルの総数
+        self.count = 0
+
+    def put(self, ts, *mm):
+        """
+        ex. ring.put(ts, mm_center, mm_left, mm_right)
+        """
+        idx = self.count % self.size
+        self._ts[idx] = ts
+        self._mm[idx * self.ch_n:(idx + 1) * self.ch_n] = array('i', mm)
+        self.count += 1
+
+    def latest(self, ch=0):
+        """
+        Returns
+        -------
+        (count, ts, mm): tuple
+            サンプルがない場合は None
+        """
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+
+            idx = (count - 1) % self.size
+            ts = self._ts[idx]
+            mm = self._mm[idx * self.ch_n + ch]
+
+            if self.count - count < self.size - 1:
+                return (count, ts, mm)
+
+    def latest_vec(self):
+        """
+        Returns
+        -------
+        (count, ts, mm_list): tuple
+            全チャンネルの同じ時刻の値
+            サンプルがない場合は None
+        """
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+
+            idx = (count - 1) % self.size
+            ts = self._ts[idx]
+            mm_list = self._mm[idx * self.ch_n:(idx + 1) * self.ch_n].tolist()
+
+            if self.count - count < self.size - 1:
+                return (count, ts, mm_list)
+
+    def window(self, n, ch=0):
+        """
+        直近n個のサンプル (古い順)
+
+        Returns
+        -------
+        (ts_list, mm_list): tuple
+        """
+        while True:
+            count = self.count
+            n1 = min(n, count, self.size - 1)
+
+            ts_list = [0.0] * n1
+            mm_list = [0] * n1
+            for i in range(n1):
+                idx = (count - n1 + i) % self.size
+                ts_list[i] = self._ts[idx]
+                mm_list[i] = self._mm[idx * self.ch_n + ch]
+
+            if self.count - count < self.size - n1:
+                return (ts_list, mm_list)
+
+
+class ToFSampler(threading.Thread):
+    """
+    複数のセンサーを、マルチプレクサー(TCA9548A)経由で使える。
+
+      sensors: [(name, TCA9548A channel), ..]
+        ex. [('center', 0), ('left', 1), ('right', 2)]
+        最初のセンサーが正面(チャンネル0)。
+
+    全センサーを連続測定モードで動かしておき、順番に読み出すので、
+    各センサーの測定時間(timing budget)は重なり、
+    1周の時間は、センサーの数にかかわらず、ほぼ1個分になる。
+
+    adaptive=True の場合、距離帯に応じて測定モードを切り替える
+
+      距離 <= d_near                 : HIGH_SPEED (障害物が近いときは周期優先)
+      d_near < 距離 < d_long         : BETTER_ACCURACY
+      d_long <= 距離 (または測定不能) : LONG_RANGE
+
+    切り替えにはヒステリシス(距離と最短滞在時間)を持たせる。
+    ただし、HIGH_SPEEDへの切り替えは、最短滞在時間を待たない。
+
+    drdy: [GPIO pin, ..] (sensors と同じ順)
+      データレディ割り込みで読み出す (スレッドは起動しない)。
+      正面のセンサーの割り込みごとに、全センサーの最新値を書き込む。
+      割り込みを取りこぼしても止まらないように、
+      測定周期の DRDY_TIMEOUT 倍の間、割り込みがなければ読み出す。
+    """
+    DEF_MODE = VL53L0X.VL53L0X_BETTER_ACCURACY_MODE
+
+    MODE_NEAR  = VL53L0X.VL53L0X_HIGH_SPEED_MODE
+    MODE_CLEAR = VL53L0X.VL53L0X_BETTER_ACCURACY_MODE
+    MODE_FAR   = VL53L0X.VL53L0X_LONG_RANGE_MODE
+
+    MODE_NAME = {
+        VL53L0X.VL53L0X_GOOD_ACCURACY_MODE:   'good',
+        VL53L0X.VL53L0X_BETTER_ACCURACY_MODE: 'better',
+        VL53L0X.VL53L0X_BEST_ACCURACY_MODE:   'best',
+        VL53L0X.VL53L0X_LONG_RANGE_MODE:      'long_range',
+        VL53L0X.VL53L0X_HIGH_SPEED_MODE:      'high_speed',
+    }
+
+    # マルチプレクサーなし(TCA9548A_Num=255)の正面センサー1個
+    DEF_SENSORS = [('center', 255)]
+    DEF_MUX_ADDR = 0x70
+
+    DRIVER = {'st': VL53L0X.VL53L0X, 'py': VL53L0XPy, 'sim': SimToF}
+    DEF_DRIVER = 'st'
+
+    DEF_D_NEAR = 250   # mm
+    DEF_D_LONG = 1200  # mm
+    D_HYST     = 50    # mm
+    D_INVALID  = 8190  # mm: これ以上は測定範囲外
+
+    # 同じモードに最低限とどまる時間
+    MODE_DWELL_MIN = 0.5  # sec
+
+    # モード判定に使うサンプル数 (中央値)
+    MODE_SAMPLES = 3
+
+    # 読み込みエラーのときの待ち時間
+    ERR_SLEEP = 0.1  # sec
+
+    # データレディ割り込みのタイムアウト (測定周期の倍数)
+    DRDY_TIMEOUT = 3
+
+    # 非常停止に必要な、d_estop 以下の連続したサンプル数
+    # (1回だけのノイズで止めないように)
+    ESTOP_COUNT = 2
+
+    def __init__(self, mode=DEF_MODE, ring_size=SampleRing.DEF_SIZE,
+                 adaptive=False, d_near=DEF_D_NEAR, d_long=DEF_D_LONG,
+                 sensors=DEF_SENSORS, mux_addr=DEF_MUX_ADDR,
+                 trace=None, drdy=None, pi=None, driver=DEF_DRIVER,
+                 debug=False):
+        """
+        trace: str
+            トレースファイル名 (None: 記録しない)
+        drdy: list of int
+            センサーの GPIO1 をつないだピン (None: スレッドで読む)
+        pi: pigpio.pi
+            drdy の場合に使う (None: 新たに接続する)
+        driver: str
+            'st', 'py' or 'sim' (DRIVER)
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('mode=%s, ring_size=%s', mode, ring_size)
+        self._log.debug('adaptive=%s, d_near=%s, d_long=%s',
+                        adaptive, d_near, d_long)
+        self._log.debug('sensors=%s, mux_addr=0x%02x', sensors, mux_addr)
+        self._log.debug('trace=%s, drdy=%s, driver=%s', trace, drdy, driver)
+
+        if drdy is not None and len(drdy) != len(sensors):
+            raise ValueError('drdy=%s: need %d pins' % (drdy, len(sensors)))
+
+        self._clock = time.monotonic
+
+        self.sensor_name = [name for (name, ch) in sensors]
+        self.ring = SampleRing(ring_size, len(sensors))
+
+        self.adaptive = adaptive
+        self.d_near = d_near
+        self.d_long = d_long
+
+        self.drdy = drdy
+        self.pi = pi
+        self.my_pi = False
+        if self.drdy is not None and self.pi is None:
+            self.pi = pigpio.pi()
+            self.my_pi = True
+        self._drdy_cb = []
+
+        # drdy: センサーごとの最新値
+        self._mm = [0] * len(sensors)
+
+        self._subscriber = []
+
+        self.mode = mode
+        self.driver = driver
+        self.tof = [self.DRIVER[driver](TCA9548A_Num=ch,
+                                        TCA9548A_Addr=mux_addr,
+                                        debug=self._dbg)
+                    for (name, ch) in sensors]
+        self.start_ranging(self.mode)
+        self._log.info('tof_timing = %.02f ms', self.tof_timing / 1000)
+
+        self.mode_t = self._clock()
+        self.mode_sec = {name: 0.0 for name in self.MODE_NAME.values()}
+        self.stat_switch = LatencyStat('switch')
+
+        self.err_count = 0
+        self.timeout_count = 0
+
+        # 非常停止: 正面の距離が d_estop 以下のサンプルが ESTOP_COUNT 回
+        # 続いたら、このスレッドから直接 estop_cb(ts) を呼ぶ
+        # (None: 何もしない)
+        self.estop_cb = None
+        self.d_estop = 0
+        self.estop_n = 0
+
+        self.trace = None
+        if trace is not None:
+            self.trace = ToFTraceWriter(trace, self.sensor_name,
+                                        clock=self._clock, debug=self._dbg)
+
+        self.active = False
+        super().__init__(daemon=True)
+
+    def start(self):
+        if self.drdy is None:
+            super().start()
+            return
+
+        self._log.debug('drdy=%s', self.drdy)
+        self.active = True
+        for pin in self.drdy:
+            self.pi.set_mode(pin, pigpio.INPUT)
+            self.pi.set_pull_up_down(pin, pigpio.PUD_UP)
+            self._drdy_cb.append(
+                self.pi.callback(pin, pigpio.FALLING_EDGE, self.drdy_cb))
+        self.set_watchdog()
+
+    def end(self):
+        self._log.debug('')
+
+        self.active = False
+        if self.is_alive():
+            self.join()
+
+        for cb in self._drdy_cb:
+            cb.cancel()
+        if len(self._drdy_cb) > 0:
+            for pin in self.drdy:
+                self.pi.set_watchdog(pin, 0)
+            self._drdy_cb = []
+
+        self.stop_ranging()
+
+        if self.my_pi:
+            self.pi.stop()
+
+        if self.trace is not None:
+            self.trace.close()
+
+        self._log.debug('done')
+
+    def start_ranging(self, mode):
+        for tof in self.tof:
+            tof.start_ranging(mode)
+            if self.drdy is not None:
+                tof.set_data_ready()
+
+        # 全センサーが並行して測定するので、周期は最も遅いセンサーで決まる
+        self.tof_timing = max([tof.get_timing() for tof in self.tof])
+
+        if len(self._drdy_cb) > 0:
+            self.set_watchdog()
+
+    def set_watchdog(self):
+        """
+        データレディ割り込みのタイムアウト (測定周期に合わせる)
+        """
+        ms = max(int(self.tof_timing / 1000 * self.DRDY_TIMEOUT), 1)
+        for pin in self.drdy:
+            self.pi.set_watchdog(pin, ms)
+
+    def stop_ranging(self):
+        for tof in self.tof:
+            tof.stop_ranging()
+
+    def subscribe(self, cb):
+        """
+        cb(ts, mm_list): サンプルごとに、測定スレッド(またはpigpioの
+        コールバック)から呼ばれるので、すぐに戻ること
+        """
+        self._log.debug('cb=%s', cb)
+        # 呼び出し側がロックなしで回せるように、リストごと置き換える
+        self._subscriber = self._subscriber + [cb]
+
+    def unsubscribe(self, cb):
+        self._log.debug('cb=%s', cb)
+        self._subscriber = [c for c in self._subscriber if c != cb]
+
+    def ch(self, name):
+        """
+        センサー名に対応するチャンネル番号 (ない場合は None)
+        """
+        if name in self.sensor_name:
+            return self.sensor_name.index(name)
+        return None
+
+    def period(self):
+        """
+        測定周期 [sec]
+        """
+        return self.tof_timing / 1000000
+
+    def latest(self):
+        """
+        正面センサーの最新値
+
+        Returns
+        -------
+        (count, ts, mm): tuple
+        """
+        return self.ring.latest()
+
+    def latest_vec(self):
+        """
+        全センサーの最新値
+
+        Returns
+        -------
+        (count, ts, {name: mm}): tuple
+        """
+        sample = self.ring.latest_vec()
+        if sample is None:
+            return None
+
+        (count, ts, mm_list) = sample
+        return (count, ts, dict(zip(self.sensor_name, mm_list)))
+
+    def age(self, ts):
+        """
+        サンプルの経過時間 [sec]
+        """
+        return self._clock() - ts
+
+    def get_stat(self):
+        """
+        モードごとの滞在時間 [sec] と、切り替えにかかった時間 [msec]
+        """
+        mode_sec = dict(self.mode_sec)
+        mode_sec[self.MODE_NAME[self.mode]] += self._clock() - self.mode_t
+
+        return {'mode': self.MODE_NAME[self.mode],
+                'mode_sec': {k: round(v, 1) for (k, v) in mode_sec.items()},
+                'switch': self.stat_switch.summary(),
+                'count': self.ring.count,
+                'err_count': self.err_count,
+                'drdy': self.drdy is not None,
+                'timeout_count': self.timeout_count}
+
+    def select_mode(self, d):
+        """
+        距離dに対するモード (ヒステリシス付き)
+        """
+        if d <= 0 or d >= self.D_INVALID:
+            return self.MODE_FAR
+
+        if self.mode == self.MODE_NEAR:
+            if d <= self.d_near + self.D_HYST:
+                return self.MODE_NEAR
+        elif d <= self.d_near:
+            return self.MODE_NEAR
+
+        if self.mode == self.MODE_FAR:
+            if d >= self.d_long - self.D_HYST:
+                return self.MODE_FAR
+        elif d >= self.d_long:
+            return self.MODE_FAR
+
+        return self.MODE_CLEAR
+
+    def set_mode(self, mode):
+        self._log.info('mode: %s -> %s',
+                       self.MODE_NAME[self.mode], self.MODE_NAME[mode])
+
+        t1 = self._clock()
+        self.mode_sec[self.MODE_NAME[self.mode]] += t1 - self.mode_t
+
+        self.stop_ranging()
+        self.start_ranging(mode)
+
+        self.mode = mode
+        self.mode_t = self._clock()
+        self.stat_switch.add(self.mode_t - t1)
+
+    def adapt_mode(self):
+        (ts_list, mm_list) = self.ring.window(self.MODE_SAMPLES)
+        if len(mm_list) < self.MODE_SAMPLES:
+            return
+
+        d = sorted(mm_list)[len(mm_list) // 2]
+        mode = self.select_mode(d)
+        if mode == self.mode:
+            return
+
+        if (mode != self.MODE_NEAR and
+                self._clock() - self.mode_t < self.MODE_DWELL_MIN):
+            return
+
+        self.set_mode(mode)
+
+    def read1(self):
+        """
+        全センサーを1回ずつ読んで、リングバッファに書き込む
+
+        タイムスタンプは、読み出しの中間の時刻とする。
+        """
+        t1 = self._clock()
+        try:
+            mm = [tof.get_distance() for tof in self.tof]
+        except Exception as e:
+            self.err_count += 1
+            self._log.warning('%s:%s', type(e).__name__, e)
+            time.sleep(self.ERR_SLEEP)
+            return None
+
+        ts = (t1 + self._clock()) / 2
+        self.put(ts, mm)
+        return (ts, mm)
+
+    def put(self, ts, mm):
+        """
+        サンプルを書き込んで、非常停止の判定と subscriber の呼び出しをする
+        """
+        self.ring.put(ts, *mm)
+        if self.trace is not None:
+            self.trace.write(ts, mm)
+
+        if self.estop_cb is not None and 0 < mm[0] <= self.d_estop:
+            self.estop_n += 1
+            if self.estop_n >= self.ESTOP_COUNT:
+                self.estop_cb(ts)
+        else:
+            self.estop_n = 0
+
+        for cb in self._subscriber:
+            cb(ts, mm)
+
+    def drdy_cb(self, pin, level, tick):
+        """
+        pigpio のコールバック: GPIO1 の立ち下がり、またはタイムアウト
+        """
+        if not self.active:
+            return
+
+        ts = self._clock()
+        ch = self.drdy.index(pin)
+
+        if level == pigpio.TIMEOUT:
+            # 割り込みを取りこぼした: 読み出して割り込みをクリアする
+            self.timeout_count += 1
+
+        try:
+            self._mm[ch] = self.tof[ch].read_data_ready()
+        except Exception as e:
+            self.err_count += 1
+            self._log.warning('%s: %s:%s', pin, type(e).__name__, e)
+            return
+
+        if ch != 0:
+            return
+
+        self.put(ts, list(self._mm))
+        if self.adaptive:
+            self.adapt_mode()
+
+    def run(self):
+        self._log.debug('')
+
+        self.active = True
+        while self.active:
+            if self.read1() is not None and self.adaptive:
+                self.adapt_mode()
+
+        self._log.info('done(stat=%s)', self.get_stat())
+
+
+class ToFSamplerApp:
+    def __init__(self, count, adaptive=False, sensors=ToFSampler.DEF_SENSORS,
+                 trace=None, drdy=None, driver=ToFSampler.DEF_DRIVER,
+                 debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('count=%s, adaptive=%s, sensors=%s, trace=%s',
+                        count, adaptive, sensors, trace)
+        self._log.debug('drdy=%s, driver=%s', drdy, driver)
+
+        self._count = count
+        self._sampler = ToFSampler(adaptive=adaptive, sensors=sensors,
+                                   trace=trace, drdy=drdy, driver=driver,
+                                   debug=self._dbg)
+        self._sampler.start()
+
+    def main(self):
+        self._log.debug('')
+
+        prev_count = 0
+        t_start = time.monotonic()
+        while self._count == 0 or prev_count < self._count:
+            time.sleep(self._sampler.period())
+
+            sample = self._sampler.latest_vec()
+            if sample is None:
+                continue
+
+            (count, ts, mm) = sample
+            if count == prev_count:
+                continue
+            prev_count = count
+
+            rate = count / (time.monotonic() - t_start)
+            print('%6d: %s (age %.1f ms, %.1f Hz, %s)' % (
+                count, mm, self._sampler.age(ts) * 1000, rate,
+                ToFSampler.MODE_NAME[self._sampler.mode]))
+
+    def end(self):
+        self._log.debug('')
+        self._sampler.end()
+        print(self._sampler.get_stat())
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+ToF sampler
+''')
+@click.option('--count', '-c', 'count', type=int, default=0,
+              help='count (0: forever)')
+@click.option('--adaptive', '-a', 'adaptive', is_flag=True, default=False,
+              help='switch ranging mode by distance')
+@click.option('--sensor', '-s', 'sensor', type=str, multiple=True,
+              help='NAME:CH (TCA9548A channel), ex. -s center:0 -s left:1')
+@click.option('--trace', '-t', 'trace', type=click.Path(), default=None,
+              help='record trace file')
+@click.option('--drdy', '-g', 'drdy', type=int, multiple=True,
+              help='GPIO pin of data ready (GPIO1), one per sensor')
+@click.option('--driver', '-r', 'driver',
+              type=click.Choice(sorted(ToFSampler.DRIVER.keys())),
+              default=ToFSampler.DEF_DRIVER, help='sensor driver')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(count, adaptive, sensor, trace, drdy, driver, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('count=%s, adaptive=%s, sensor=%s, trace=%s, drdy=%s',
+               count, adaptive, sensor, trace, drdy)
+    _log.debug('driver=%s', driver)
+
+    sensors = ToFSampler.DEF_SENSORS
+    if len(sensor) > 0:
+        sensors = [(s1.split(':')[0], int(s1.split(':')[1])) for s1 in sensor]
+
+    app = ToFSamplerApp(count, adaptive, sensors, trace, list(drdy) or None,
+                        driver, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+距離サンプルのトレースファイル
+
+ToFSamplerが測定した値を、タイムスタンプ付きで記録する。
+OttoPiAutoSimで再生して、自動運転の判断をオフラインで検証する。
+
+ファイル形式 (リトルエンディアン):
+
+  header:  magic(b'TOFT') version(H) ch_n(H) t0(d: 記録開始時刻 time.time())
+  names:   センサー名 (16s) x ch_n
+  record:  ts(f: 記録開始からの秒数) mm(h) x ch_n
+
+1レコードは、センサー1個で 6バイト (30Hzで 1時間 約650KB)
+
+Usage:
+--
+from ToFTrace import ToFTraceWriter, ToFTraceReader
+
+w = ToFTraceWriter('a.tof', ['center'])
+w.write(ts, [mm])
+w.close()
+
+r = ToFTraceReader('a.tof')
+for (ts, mm) in r:
+    ...
+--
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import struct
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+MAGIC   = b'TOFT'
+VERSION = 1
+
+HDR_FMT  = '<4sHHd'
+NAME_FMT = '<16s'
+
+
+class ToFTraceWriter:
+    def __init__(self, path, names, clock=time.monotonic, debug=False):
+        """
+        Parameters
+        ----------
+        path: str
+            ファイル名
+        names: list of str
+            センサー名 (チャンネル順)
+        clock: function
+            サンプルのタイムスタンプと同じ時計
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s, names=%s', path, names)
+
+        self.path = path
+        self.names = names
+        self.rec = struct.Struct('<f%dh' % len(names))
+        self.count = 0
+
+        # 記録開始時のタイムスタンプを 0 とする
+        self._t0 = clock()
+
+        self._f = open(path, 'wb')
+        self._f.write(struct.pack(HDR_FMT, MAGIC, VERSION, len(names),
+                                  time.time()))
+        for name in names:
+            self._f.write(struct.pack(NAME_FMT, name.encode('utf-8')))
+
+    def write(self, ts, mm):
+        """
+        mm: list of int (チャンネル順)
+        """
+        if self._f is None:
+            return
+
+        mm = [max(min(v, 0x7fff), -0x8000) for v in mm]
+        self._f.write(self.rec.pack(ts - self._t0, *mm))
+        self.count += 1
+
+    def close(self):
+        self._log.debug('count=%s', self.count)
+        if self._f is None:
+            return
+
+        self._f.close()
+        self._f = None
+
+
+class ToFTraceReader:
+    def __init__(self, path, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s', path)
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            buf = f.read()
+
+        (magic, ver, ch_n, self.t0) = struct.unpack_from(HDR_FMT, buf, 0)
+        if magic != MAGIC or ver != VERSION:
+            raise ValueError('%s: invalid trace file (%a, %s)' % (
+                path, magic, ver))
+
+        offset = struct.calcsize(HDR_FMT)
+        self.names = []
+        for i in range(ch_n):
+            (name,) = struct.unpack_from(NAME_FMT, buf, offset)
+            self.names.append(name.rstrip(b'\0').decode('utf-8'))
+            offset += struct.calcsize(NAME_FMT)
+
+        # 途中で切れたレコードは捨てる
+        rec = struct.Struct('<f%dh' % ch_n)
+        n = (len(buf) - offset) // rec.size
+        self.records = [(r[0], list(r[1:])) for r in
+                        rec.iter_unpack(buf[offset:offset + n * rec.size])]
+        self._log.debug('names=%s, records=%s', self.names, len(self.records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        """
+        (ts, mm_list)
+        """
+        return iter(self.records)
+
+    def duration(self):
+        if len(self.records) == 0:
+            return 0.0
+        return self.records[-1][0] - self.records[0][0]
+
+
+class ToFTraceApp:
+    def __init__(self, path, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s', path)
+
+        self._trace = ToFTraceReader(path, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        print('# %s %s' % (time.strftime('%Y/%m/%d %H:%M:%S',
+                                          time.localtime(self._trace.t0)),
+                           ' '.join(self._trace.names)))
+        for (ts, mm) in self._trace:
+            print('%.4f %s' % (ts, ' '.join([str(v) for v in mm])))
+        print('# %d records, %.1f sec' % (len(self._trace),
+                                          self._trace.duration()))
+
+    def end(self):
+        self._log.debug('')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+print ToF trace file
+''')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(path, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('path=%s', path)
+
+    app = ToFTraceApp(path, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
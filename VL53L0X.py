@@ -22,9 +22,33 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import time
+"""
+VL53L0X ToF sensor (ST API library + Python I2C callbacks)
+
+The I2C bus and the shared library are opened lazily on first use,
+so this module can be imported on hosts without I2C or the library.
+
+Library path (first match):
+  1. set_lib_path(path)
+  2. environment variable VL53L0X_LIB
+  3. vl53l0x_python.so in the same directory as this module
+
+Data ready interrupt (continuous ranging):
+  set_data_ready() configures GPIO1 to go low when a new measurement
+  is ready. Wait for the edge (ex. pigpio callback), then call
+  read_data_ready() to read the result and clear the interrupt.
+
+TCA9548A multiplexer:
+  The library selects the channel only in startRanging/getDistance.
+  The ST API functions called from Python (set_data_ready(),
+  read_data_ready(), get_timing()) select it here first. All library
+  calls are serialized, so a data ready callback for one sensor cannot
+  run while another sensor's channel is selected.
+"""
+
+import os
+import threading
 from ctypes import *
-import smbus2 as smbus
 
 VL53L0X_GOOD_ACCURACY_MODE      = 0   # Good Accuracy mode
 VL53L0X_BETTER_ACCURACY_MODE    = 1   # Better Accuracy mode
@@ -32,40 +56,88 @@ VL53L0X_BEST_ACCURACY_MODE      = 2   # Best Accuracy mode
 VL53L0X_LONG_RANGE_MODE         = 3   # Longe Range mode
 VL53L0X_HIGH_SPEED_MODE         = 4   # High Speed mode
 
-i2cbus = smbus.SMBus(1)
+# ST API constants (vl53l0x_def.h, vl53l0x_device.h)
+VL53L0X_DEVICEMODE_CONTINUOUS_RANGING       = 1
+VL53L0X_GPIOFUNCTIONALITY_NEW_MEASURE_READY = 4
+VL53L0X_INTERRUPTPOLARITY_LOW               = 0
+VL53L0X_INTERRUPTPOLARITY_HIGH              = 1
+
+LIB_NAME = 'vl53l0x_python.so'
+LIB_PATH_ENV = 'VL53L0X_LIB'
+I2C_BUS = 1
+
+# I2C_RDWR message flag (linux/i2c.h)
+I2C_M_RD = 0x0001
+
+_lib_path = None
+_bus_num = I2C_BUS
+
+_i2cbus = None
+_i2c_msg = None
+tof_lib = None
+_init_lock = threading.Lock()
+
+# the callbacks reuse one buffer: register + data (max 255 bytes)
+_wbuf = (c_ubyte * (1 + 255))()
+_wbuf_lock = threading.Lock()
+
+# one library call (and its channel selection) at a time
+_dev_lock = threading.RLock()
+
+TCA9548A_CH_NUM = 8
+
+
+def set_lib_path(path):
+    """Set the path of vl53l0x_python.so (before first use)"""
+    global _lib_path
+    _lib_path = path
+
+
+def set_i2c_bus(bus):
+    """Set the I2C bus number (before first use)"""
+    global _bus_num
+    _bus_num = bus
+
+
+def get_lib_path():
+    if _lib_path is not None:
+        return _lib_path
+    if os.environ.get(LIB_PATH_ENV):
+        return os.environ[LIB_PATH_ENV]
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), LIB_NAME)
+
+
+def _msg(address, flags, length, buf):
+    """i2c_msg pointing at buf (no copy)"""
+    return _i2c_msg(addr=address, flags=flags, len=length,
+                    buf=cast(buf, POINTER(c_char)))
+
 
 # i2c bus read callback
 def i2c_read(address, reg, data_p, length):
-    ret_val = 0;
-    result = []
- 
-    try:
-        result = i2cbus.read_i2c_block_data(address, reg, length)
-    except IOError:
-        ret_val = -1; 
-
-    if (ret_val == 0):
-        for index in range(length):
-            data_p[index] = result[index]
+    # write the register, then read directly into the library's buffer
+    # (one combined transaction, no intermediate list)
+    with _wbuf_lock:
+        _wbuf[0] = reg
+        try:
+            _i2cbus.i2c_rdwr(_msg(address, 0, 1, _wbuf),
+                             _msg(address, I2C_M_RD, length, data_p))
+        except IOError:
+            return -1
 
-    return ret_val
+    return 0
 
 # i2c bus write callback
 def i2c_write(address, reg, data_p, length):
-    ret_val = 0;
-    data = []
-
-    for index in range(length):
-        data.append(data_p[index])
-    try:
-        i2cbus.write_i2c_block_data(address, reg, data)
-    except IOError:
-        ret_val = -1; 
-
-    return ret_val
+    with _wbuf_lock:
+        _wbuf[0] = reg
+        memmove(addressof(_wbuf) + 1, data_p, length)
+        try:
+            _i2cbus.i2c_rdwr(_msg(address, 0, 1 + length, _wbuf))
+        except IOError:
+            return -1
 
-# Load VL53L0X shared lib 
-tof_lib = CDLL("./vl53l0x_python.so")
+    return 0
 
 # Create read function pointer
 READFUNC = CFUNCTYPE(c_int, c_ubyte, c_ubyte, POINTER(c_ubyte), c_ubyte)
@@ -75,8 +147,43 @@ read_func = READFUNC(i2c_read)
 WRITEFUNC = CFUNCTYPE(c_int, c_ubyte, c_ubyte, POINTER(c_ubyte), c_ubyte)
 write_func = WRITEFUNC(i2c_write)
 
-# pass i2c read and write function pointers to VL53L0X library
-tof_lib.VL53L0X_set_i2c(read_func, write_func)
+
+class RangingMeasurementData(Structure):
+    """VL53L0X_RangingMeasurementData_t"""
+    _fields_ = [('TimeStamp', c_uint32),
+                ('MeasurementTimeUsec', c_uint32),
+                ('RangeMilliMeter', c_uint16),
+                ('RangeDMaxMilliMeter', c_uint16),
+                ('SignalRateRtnMegaCps', c_uint32),
+                ('AmbientRateRtnMegaCps', c_uint32),
+                ('EffectiveSpadRtnCount', c_uint16),
+                ('ZoneId', c_uint8),
+                ('RangeFractionalPart', c_uint8),
+                ('RangeStatus', c_uint8)]
+
+
+def get_lib():
+    """Open the I2C bus and load the VL53L0X shared lib (first call only)"""
+    global _i2cbus, _i2c_msg, tof_lib
+
+    if tof_lib is not None:
+        return tof_lib
+
+    with _init_lock:
+        if tof_lib is None:
+            import smbus2 as smbus
+            _i2cbus = smbus.SMBus(_bus_num)
+            _i2c_msg = smbus.i2c_msg
+
+            lib = CDLL(get_lib_path())
+            lib.getDev.restype = c_void_p
+
+            # pass i2c read and write function pointers to VL53L0X library
+            lib.VL53L0X_set_i2c(read_func, write_func)
+            tof_lib = lib
+
+    return tof_lib
+
 
 class VL53L0X(object):
     """VL53L0X ToF."""
@@ -91,27 +198,68 @@ class VL53L0X(object):
         self.my_object_number = VL53L0X.object_number
         VL53L0X.object_number += 1
 
+        self._data = RangingMeasurementData()
+
+    def _dev(self):
+        return c_void_p(get_lib().getDev(self.my_object_number))
+
+    def _select(self):
+        """Select this sensor's multiplexer channel (call with _dev_lock)"""
+        if self.TCA9548A_Device < TCA9548A_CH_NUM:
+            _i2cbus.write_byte(self.TCA9548A_Address,
+                               1 << self.TCA9548A_Device)
+
     def start_ranging(self, mode = VL53L0X_GOOD_ACCURACY_MODE):
         """Start VL53L0X ToF Sensor Ranging"""
-        tof_lib.startRanging(self.my_object_number, mode, self.device_address, self.TCA9548A_Device, self.TCA9548A_Address)
+        with _dev_lock:
+            get_lib().startRanging(self.my_object_number, mode, self.device_address, self.TCA9548A_Device, self.TCA9548A_Address)
         
     def stop_ranging(self):
         """Stop VL53L0X ToF Sensor Ranging"""
-        tof_lib.stopRanging(self.my_object_number)
+        with _dev_lock:
+            get_lib().stopRanging(self.my_object_number)
 
     def get_distance(self):
         """Get distance from VL53L0X ToF Sensor"""
-        return tof_lib.getDistance(self.my_object_number)
+        with _dev_lock:
+            return get_lib().getDistance(self.my_object_number)
 
     # This function included to show how to access the ST library directly
     # from python instead of through the simplified interface
     def get_timing(self):
-        Dev = POINTER(c_void_p)
-        Dev = tof_lib.getDev(self.my_object_number)
+        Dev = self._dev()
         budget = c_uint(0)
         budget_p = pointer(budget)
-        Status =  tof_lib.VL53L0X_GetMeasurementTimingBudgetMicroSeconds(Dev, budget_p)
+        with _dev_lock:
+            self._select()
+            Status =  get_lib().VL53L0X_GetMeasurementTimingBudgetMicroSeconds(Dev, budget_p)
         if (Status == 0):
             return (budget.value + 1000)
         else:
             return 0
+
+    def set_data_ready(self, polarity=VL53L0X_INTERRUPTPOLARITY_LOW):
+        """Signal new measurements on GPIO1 (after start_ranging)"""
+        lib = get_lib()
+        Dev = self._dev()
+        with _dev_lock:
+            self._select()
+            Status = lib.VL53L0X_SetGpioConfig(
+                Dev, 0, VL53L0X_DEVICEMODE_CONTINUOUS_RANGING,
+                VL53L0X_GPIOFUNCTIONALITY_NEW_MEASURE_READY, polarity)
+            if Status == 0:
+                Status = lib.VL53L0X_ClearInterruptMask(Dev, 0)
+        if Status != 0:
+            raise IOError('VL53L0X_SetGpioConfig: %d' % Status)
+
+    def read_data_ready(self):
+        """Read the measurement that raised GPIO1, and clear the interrupt"""
+        lib = get_lib()
+        Dev = self._dev()
+        with _dev_lock:
+            self._select()
+            Status = lib.VL53L0X_GetRangingMeasurementData(Dev, byref(self._data))
+            lib.VL53L0X_ClearInterruptMask(Dev, 0)
+        if Status != 0:
+            raise IOError('VL53L0X_GetRangingMeasurementData: %d' % Status)
+        return self._data.RangeMilliMeter
@@ -0,0 +1,854 @@
+#!/usr/bin/env python3
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+距離センサー(VL53L0X)の Python ドライバー
+
+vl53l0x_python.so (ST API) を使わずに、smbus2 で直接レジスターを読み書きする。
+初期化の手順は、Pololu の VL53L0X ライブラリ(ST API を移植したもの)に従う。
+
+ * 連続したレジスターは、1回のブロック転送で読み書きする
+   (測定結果は、割り込み状態 0x13 から距離 0x1E-0x1F までを 1回で読む)
+ * 設定用のレジスター(タイミング、VCSEL周期など)の値はキャッシュして、
+   初期化後のモード切り替えでは読み直さない
+ * 測定モードは VL53L0X.py と同じ (VL53L0X_*_MODE)
+
+VL53L0X.VL53L0X と同じメソッドを持つので、ToFSampler で置き換えられる。
+  ex. ToFSampler(driver='py')
+
+RegMapBus は、レジスターマップを持つ偽のI2Cバスで、
+センサーなしでドライバーを動かせる。
+実機のレジスターマップを dump() で記録(JSON)して、読み込むこともできる。
+
+-----------------------------------------------------------------
+VL53L0XPy -- VL53L0X ドライバー
+ |
+ +- smbus2.SMBus -- I2Cバス (または RegMapBus)
+-----------------------------------------------------------------
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from VL53L0X import VL53L0X_GOOD_ACCURACY_MODE, VL53L0X_BETTER_ACCURACY_MODE
+from VL53L0X import VL53L0X_BEST_ACCURACY_MODE, VL53L0X_LONG_RANGE_MODE
+from VL53L0X import VL53L0X_HIGH_SPEED_MODE
+from VL53L0X import VL53L0X_INTERRUPTPOLARITY_LOW
+import threading
+import json
+import time
+
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+# registers
+SYSRANGE_START                          = 0x00
+SYSTEM_SEQUENCE_CONFIG                  = 0x01
+SYSTEM_INTERRUPT_CONFIG_GPIO            = 0x0A
+SYSTEM_INTERRUPT_CLEAR                  = 0x0B
+RESULT_INTERRUPT_STATUS                 = 0x13
+RESULT_RANGE_STATUS                     = 0x14
+ALGO_PHASECAL_CONFIG_TIMEOUT            = 0x30
+ALGO_PHASECAL_LIM                       = 0x30  # page 1
+GLOBAL_CONFIG_VCSEL_WIDTH               = 0x32
+FINAL_RANGE_CONFIG_MIN_COUNT_RATE_RTN_LIMIT = 0x44
+MSRC_CONFIG_TIMEOUT_MACROP              = 0x46
+FINAL_RANGE_CONFIG_VALID_PHASE_LOW      = 0x47
+DYNAMIC_SPAD_NUM_REQUESTED_REF_SPAD     = 0x4E
+DYNAMIC_SPAD_REF_EN_START_OFFSET        = 0x4F
+PRE_RANGE_CONFIG_VCSEL_PERIOD           = 0x50
+PRE_RANGE_CONFIG_VALID_PHASE_LOW        = 0x56
+MSRC_CONFIG_CONTROL                     = 0x60
+FINAL_RANGE_CONFIG_VCSEL_PERIOD         = 0x70
+FINAL_RANGE_CONFIG_TIMEOUT_MACROP_HI    = 0x71
+POWER_MANAGEMENT_GO1_POWER_FORCE        = 0x80
+GPIO_HV_MUX_ACTIVE_HIGH                 = 0x84
+VHV_CONFIG_PAD_SCL_SDA__EXTSUP_HV       = 0x89
+GLOBAL_CONFIG_SPAD_ENABLES_REF_0        = 0xB0
+GLOBAL_CONFIG_REF_EN_START_SELECT       = 0xB6
+IDENTIFICATION_MODEL_ID                 = 0xC0
+PAGE_SELECT                             = 0xFF
+
+MODEL_ID = 0xEE
+
+# 0x13(割り込み状態) .. 0x1F(距離の下位バイト)
+RESULT_LEN = 13
+
+# ST API のデフォルトのチューニング (DefaultTuningSettings)
+TUNING = [
+    (0xFF, 0x01), (0x00, 0x00),
+    (0xFF, 0x00), (0x09, 0x00), (0x10, 0x00), (0x11, 0x00),
+    (0x24, 0x01), (0x25, 0xFF), (0x75, 0x00),
+    (0xFF, 0x01), (0x4E, 0x2C), (0x48, 0x00), (0x30, 0x20),
+    (0xFF, 0x00), (0x30, 0x09), (0x54, 0x00), (0x31, 0x04),
+    (0x32, 0x03), (0x40, 0x83), (0x46, 0x25), (0x60, 0x00),
+    (0x27, 0x00), (0x50, 0x06), (0x51, 0x00), (0x52, 0x96),
+    (0x56, 0x08), (0x57, 0x30), (0x61, 0x00), (0x62, 0x00),
+    (0x64, 0x00), (0x65, 0x00), (0x66, 0xA0),
+    (0xFF, 0x01), (0x22, 0x32), (0x47, 0x14), (0x49, 0xFF), (0x4A, 0x00),
+    (0xFF, 0x00), (0x7A, 0x0A), (0x7B, 0x00), (0x78, 0x21),
+    (0xFF, 0x01), (0x23, 0x34), (0x42, 0x00), (0x44, 0xFF), (0x45, 0x26),
+    (0x46, 0x05), (0x40, 0x40), (0x0E, 0x06), (0x20, 0x1A), (0x43, 0x40),
+    (0xFF, 0x00), (0x34, 0x03), (0x35, 0x44),
+    (0xFF, 0x01), (0x31, 0x04), (0x4B, 0x09), (0x4C, 0x05), (0x4D, 0x04),
+    (0xFF, 0x00), (0x44, 0x00), (0x45, 0x20), (0x47, 0x08), (0x48, 0x28),
+    (0x67, 0x00), (0x70, 0x04), (0x71, 0x01), (0x72, 0xFE),
+    (0x76, 0x00), (0x77, 0x00),
+    (0xFF, 0x01), (0x0D, 0x01),
+    (0xFF, 0x00), (0x80, 0x01), (0x01, 0xF8),
+    (0xFF, 0x01), (0x8E, 0x01), (0x00, 0x01),
+    (0xFF, 0x00), (0x80, 0x00),
+]
+
+# 順番に意味がある(ページ切り替えなど)ので、まとめて書かないレジスター
+NO_BLOCK = set([0x00, 0x80, 0x88, 0x91, PAGE_SELECT])
+
+# ページ0の設定用レジスター (読み書きした値をキャッシュする)
+CACHE_REG = set([SYSTEM_SEQUENCE_CONFIG, SYSTEM_INTERRUPT_CONFIG_GPIO,
+                 0x44, 0x45, MSRC_CONFIG_TIMEOUT_MACROP,
+                 0x50, 0x51, 0x52, MSRC_CONFIG_CONTROL, 0x70, 0x71, 0x72,
+                 GPIO_HV_MUX_ACTIVE_HIGH, VHV_CONFIG_PAD_SCL_SDA__EXTSUP_HV,
+                 IDENTIFICATION_MODEL_ID])
+
+# timing budget の計算 [us]
+START_OVERHEAD       = 1910
+END_OVERHEAD         = 960
+MSRC_OVERHEAD        = 660
+TCC_OVERHEAD         = 590
+DSS_OVERHEAD         = 690
+PRE_RANGE_OVERHEAD   = 660
+FINAL_RANGE_OVERHEAD = 550
+MIN_TIMING_BUDGET    = 20000
+
+
+class VL53L0XPy:
+    DEF_ADDR = 0x29
+    MUX_NONE = 255
+    I2C_BUS = 1
+
+    # 測定モードごとの設定
+    #   (timing budget [us], signal rate limit [MCPS],
+    #    pre-range VCSEL周期 [PCLK], final-range VCSEL周期 [PCLK])
+    MODE_PARAM = {
+        VL53L0X_GOOD_ACCURACY_MODE:   (33000,  0.25, 14, 10),
+        VL53L0X_BETTER_ACCURACY_MODE: (66000,  0.25, 14, 10),
+        VL53L0X_BEST_ACCURACY_MODE:   (200000, 0.25, 14, 10),
+        VL53L0X_LONG_RANGE_MODE:      (33000,  0.1,  18, 14),
+        VL53L0X_HIGH_SPEED_MODE:      (20000,  0.25, 14, 10),
+    }
+
+    # VCSEL周期ごとの設定
+    #  pre-range: PRE_RANGE_CONFIG_VALID_PHASE_HIGH
+    #  final-range: (FINAL_RANGE_CONFIG_VALID_PHASE_HIGH,
+    #                GLOBAL_CONFIG_VCSEL_WIDTH, ALGO_PHASECAL_CONFIG_TIMEOUT,
+    #                ALGO_PHASECAL_LIM)
+    VCSEL_PRE = {12: 0x18, 14: 0x30, 16: 0x40, 18: 0x50}
+    VCSEL_FINAL = {8:  (0x10, 0x02, 0x0C, 0x30),
+                   10: (0x28, 0x03, 0x09, 0x20),
+                   12: (0x38, 0x03, 0x08, 0x20),
+                   14: (0x48, 0x03, 0x07, 0x20)}
+
+    IO_TIMEOUT = 0.5   # sec
+    POLL_SLEEP = 0.001  # sec
+
+    # 共有するI2Cバス (最初に使うときに開く)
+    _bus = None
+    _bus_lock = threading.Lock()
+
+    # マルチプレクサーで選択中のチャンネル {(bus, mux addr): ch}
+    _mux_ch = {}
+
+    def __init__(self, address=DEF_ADDR, TCA9548A_Num=MUX_NONE,
+                 TCA9548A_Addr=0, bus=None, debug=False):
+        """
+        Parameters
+        ----------
+        address: int
+            I2Cアドレス
+        TCA9548A_Num: int
+            マルチプレクサーのチャンネル (255: マルチプレクサーなし)
+        TCA9548A_Addr: int
+            マルチプレクサーのI2Cアドレス
+        bus: smbus2.SMBus or RegMapBus
+            None: I2C_BUS を開いて共有する
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('address=0x%02x,'
+                        ' TCA9548A_Num=%s, TCA9548A_Addr=0x%02x',
+                        address, TCA9548A_Num, TCA9548A_Addr)
+
+        self.address = address
+        self.mux_ch = TCA9548A_Num
+        self.mux_addr = TCA9548A_Addr
+        self.bus = bus
+
+        self._page = 0
+        self._force = 0
+        self._cache = {}
+
+        self.initialized = False
+        self.stop_variable = 0
+        self.signal_limit = None
+        self.budget_us = 0
+        self.mode = None
+        self.range_status = 0
+
+        # I2C転送の回数
+        self.xfer = 0
+
+    @classmethod
+    def get_bus(cls):
+        if cls._bus is None:
+            with cls._bus_lock:
+                if cls._bus is None:
+                    import smbus2
+                    cls._bus = smbus2.SMBus(cls.I2C_BUS)
+        return cls._bus
+
+    @staticmethod
+    def decode_timeout(v):
+        return ((v & 0xFF) << (v >> 8)) + 1
+
+    @staticmethod
+    def encode_timeout(mclks):
+        if mclks <= 0:
+            return 0
+
+        ls = mclks - 1
+        ms = 0
+        while ls & 0xFFFFFF00:
+            ls >>= 1
+            ms += 1
+        return (ms << 8) | (ls & 0xFF)
+
+    @staticmethod
+    def macro_period_ns(pclks):
+        return (2304 * pclks * 1655 + 500) // 1000
+
+    @classmethod
+    def mclks_to_us(cls, mclks, pclks):
+        mp = cls.macro_period_ns(pclks)
+        return (mclks * mp + mp // 2) // 1000
+
+    @classmethod
+    def us_to_mclks(cls, us, pclks):
+        mp = cls.macro_period_ns(pclks)
+        return (us * 1000 + mp // 2) // mp
+
+    #
+    # register access
+    #
+    def _select(self):
+        """
+        バスを開いて、マルチプレクサーのチャンネルを選ぶ (変わった場合だけ)
+        """
+        if self.bus is None:
+            self.bus = self.get_bus()
+
+        if self.mux_ch >= 8:
+            return
+
+        key = (id(self.bus), self.mux_addr)
+        if VL53L0XPy._mux_ch.get(key) != self.mux_ch:
+            self.bus.write_byte(self.mux_addr, 1 << self.mux_ch)
+            self.xfer += 1
+            VL53L0XPy._mux_ch[key] = self.mux_ch
+
+    def _cacheable(self):
+        return self._page == 0 and self._force == 0
+
+    def write(self, reg, *data):
+        """
+        reg から連続して書き込む (1回の転送)
+        """
+        if len(data) == 1:
+            self.bus.write_byte_data(self.address, reg, data[0])
+        else:
+            self.bus.write_i2c_block_data(self.address, reg, list(data))
+        self.xfer += 1
+
+        if reg == PAGE_SELECT:
+            self._page = data[0]
+        elif reg == POWER_MANAGEMENT_GO1_POWER_FORCE:
+            self._force = data[0]
+        elif self._cacheable():
+            for (i, v) in enumerate(data):
+                if reg + i in CACHE_REG:
+                    self._cache[reg + i] = v
+
+    def read(self, reg, n=1):
+        """
+        reg から n バイト (1回の転送)
+        全てキャッシュにある場合は、転送しない
+        """
+        cacheable = self._cacheable()
+        if cacheable and all([reg + i in self._cache for i in range(n)]):
+            return [self._cache[reg + i] for i in range(n)]
+
+        if n == 1:
+            data = [self.bus.read_byte_data(self.address, reg)]
+        else:
+            data = self.bus.read_i2c_block_data(self.address, reg, n)
+        self.xfer += 1
+
+        if cacheable:
+            for (i, v) in enumerate(data):
+                if reg + i in CACHE_REG:
+                    self._cache[reg + i] = v
+        return data
+
+    def write16(self, reg, v):
+        self.write(reg, (v >> 8) & 0xFF, v & 0xFF)
+
+    def read16(self, reg):
+        (hi, lo) = self.read(reg, 2)
+        return (hi << 8) | lo
+
+    def write_seq(self, seq):
+        """
+        [(reg, v), ..] を順に書き込む
+        アドレスが連続している部分は、まとめて1回で書く
+        """
+        i = 0
+        while i < len(seq):
+            (reg, v) = seq[i]
+            data = [v]
+            i += 1
+
+            if reg not in NO_BLOCK:
+                while (i < len(seq) and seq[i][0] == reg + len(data) and
+                       seq[i][0] not in NO_BLOCK and len(data) < 32):
+                    data.append(seq[i][1])
+                    i += 1
+
+            self.write(reg, *data)
+
+    def wait_reg(self, reg, mask):
+        """
+        reg & mask が 0 でなくなるまで待つ
+        """
+        t_end = time.monotonic() + self.IO_TIMEOUT
+        while True:
+            v = self.read(reg)[0]
+            if v & mask:
+                return v
+            if time.monotonic() > t_end:
+                raise TimeoutError('0x%02x: reg 0x%02x timeout' % (
+                    self.address, reg))
+            time.sleep(self.POLL_SLEEP)
+
+    #
+    # initialize
+    #
+    def init(self):
+        """
+        データシートにない手順は、ST API (Pololu版) のとおり
+        """
+        self._log.debug('')
+        t1 = time.monotonic()
+        xfer1 = self.xfer
+
+        self._cache = {}
+        self.initialized = False
+
+        model = self.read(IDENTIFICATION_MODEL_ID)[0]
+        if model != MODEL_ID:
+            raise IOError('0x%02x: not VL53L0X (model id 0x%02x)' % (
+                self.address, model))
+
+        # 2.8V I/O
+        self.write(VHV_CONFIG_PAD_SCL_SDA__EXTSUP_HV,
+                   self.read(VHV_CONFIG_PAD_SCL_SDA__EXTSUP_HV)[0] | 0x01)
+
+        self.write(0x88, 0x00)
+        self.write_seq([(0x80, 0x01), (0xFF, 0x01), (0x00, 0x00)])
+        self.stop_variable = self.read(0x91)[0]
+        self.write_seq([(0x00, 0x01), (0xFF, 0x00), (0x80, 0x00)])
+
+        # SIGNAL_RATE_MSRC と SIGNAL_RATE_PRE_RANGE のチェックを無効にする
+        self.write(MSRC_CONFIG_CONTROL,
+                   self.read(MSRC_CONFIG_CONTROL)[0] | 0x12)
+        self.set_signal_rate_limit(0.25)
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0xFF)
+
+        # reference SPAD
+        (spad_count, aperture) = self.get_spad_info()
+        spad_map = self.read(GLOBAL_CONFIG_SPAD_ENABLES_REF_0, 6)
+        self.write_seq([(0xFF, 0x01),
+                        (DYNAMIC_SPAD_REF_EN_START_OFFSET, 0x00),
+                        (DYNAMIC_SPAD_NUM_REQUESTED_REF_SPAD, 0x2C),
+                        (0xFF, 0x00),
+                        (GLOBAL_CONFIG_REF_EN_START_SELECT, 0xB4)])
+
+        first_spad = 12 if aperture else 0
+        enabled = 0
+        for i in range(48):
+            if i < first_spad or enabled == spad_count:
+                spad_map[i // 8] &= ~(1 << (i % 8)) & 0xFF
+            elif (spad_map[i // 8] >> (i % 8)) & 0x01:
+                enabled += 1
+        self.write(GLOBAL_CONFIG_SPAD_ENABLES_REF_0, *spad_map)
+
+        self.write_seq(TUNING)
+
+        # 割り込み: 新しい測定値 (active low)
+        self.write(SYSTEM_INTERRUPT_CONFIG_GPIO, 0x04)
+        self.write(GPIO_HV_MUX_ACTIVE_HIGH,
+                   self.read(GPIO_HV_MUX_ACTIVE_HIGH)[0] & ~0x10 & 0xFF)
+        self.write(SYSTEM_INTERRUPT_CLEAR, 0x01)
+
+        self.budget_us = self.get_timing_budget()
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0xE8)
+        self.set_timing_budget(self.budget_us)
+
+        # VHV, phase calibration
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0x01)
+        self.ref_calibration(0x40)
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0x02)
+        self.ref_calibration(0x00)
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0xE8)
+
+        self.initialized = True
+        self._log.info('0x%02x(%s): init %.1f ms, %d transfers',
+                       self.address, self.mux_ch,
+                       (time.monotonic() - t1) * 1000, self.xfer - xfer1)
+
+    def get_spad_info(self):
+        """
+        Returns
+        -------
+        (count, aperture): (int, bool)
+        """
+        self.write_seq([(0x80, 0x01), (0xFF, 0x01), (0x00, 0x00),
+                        (0xFF, 0x06)])
+        self.write(0x83, self.read(0x83)[0] | 0x04)
+        self.write_seq([(0xFF, 0x07), (0x81, 0x01), (0x80, 0x01),
+                        (0x94, 0x6B), (0x83, 0x00)])
+        self.wait_reg(0x83, 0xFF)
+        self.write(0x83, 0x01)
+        tmp = self.read(0x92)[0]
+
+        self.write_seq([(0x81, 0x00), (0xFF, 0x06)])
+        self.write(0x83, self.read(0x83)[0] & ~0x04 & 0xFF)
+        self.write_seq([(0xFF, 0x01), (0x00, 0x01), (0xFF, 0x00),
+                        (0x80, 0x00)])
+
+        return (tmp & 0x7F, bool((tmp >> 7) & 0x01))
+
+    def ref_calibration(self, vhv_init):
+        self.write(SYSRANGE_START, 0x01 | vhv_init)
+        self.wait_reg(RESULT_INTERRUPT_STATUS, 0x07)
+        self.write(SYSTEM_INTERRUPT_CLEAR, 0x01)
+        self.write(SYSRANGE_START, 0x00)
+
+    #
+    # ranging parameters
+    #
+    def set_signal_rate_limit(self, mcps):
+        if not 0 <= mcps <= 511.99:
+            raise ValueError('mcps=%s: out of range' % mcps)
+
+        self.write16(FINAL_RANGE_CONFIG_MIN_COUNT_RATE_RTN_LIMIT,
+                     int(mcps * (1 << 7)))
+        self.signal_limit = mcps
+
+    def get_sequence(self):
+        """
+        初期化後は、全てキャッシュから読む
+
+        Returns
+        -------
+        (enables, timeouts): (dict, dict)
+        """
+        sc = self.read(SYSTEM_SEQUENCE_CONFIG)[0]
+        en = {'tcc':         (sc >> 4) & 1,
+              'dss':         (sc >> 3) & 1,
+              'msrc':        (sc >> 2) & 1,
+              'pre_range':   (sc >> 6) & 1,
+              'final_range': (sc >> 7) & 1}
+
+        msrc = self.read(MSRC_CONFIG_TIMEOUT_MACROP)[0]
+        (pre_vcsel, pre_hi, pre_lo) = self.read(
+            PRE_RANGE_CONFIG_VCSEL_PERIOD, 3)
+        (fin_vcsel, fin_hi, fin_lo) = self.read(
+            FINAL_RANGE_CONFIG_VCSEL_PERIOD, 3)
+
+        to = {'pre_pclks':   (pre_vcsel + 1) << 1,
+              'final_pclks': (fin_vcsel + 1) << 1}
+        to['msrc_dss_tcc_us'] = self.mclks_to_us(msrc + 1, to['pre_pclks'])
+        to['pre_range_mclks'] = self.decode_timeout((pre_hi << 8) | pre_lo)
+        to['pre_range_us'] = self.mclks_to_us(to['pre_range_mclks'],
+                                              to['pre_pclks'])
+
+        fin_mclks = self.decode_timeout((fin_hi << 8) | fin_lo)
+        if en['pre_range']:
+            fin_mclks -= to['pre_range_mclks']
+        to['final_range_us'] = self.mclks_to_us(fin_mclks, to['final_pclks'])
+
+        return (en, to)
+
+    @staticmethod
+    def _budget_used(en, to):
+        used = START_OVERHEAD + END_OVERHEAD
+        if en['tcc']:
+            used += to['msrc_dss_tcc_us'] + TCC_OVERHEAD
+        if en['dss']:
+            used += 2 * (to['msrc_dss_tcc_us'] + DSS_OVERHEAD)
+        elif en['msrc']:
+            used += to['msrc_dss_tcc_us'] + MSRC_OVERHEAD
+        if en['pre_range']:
+            used += to['pre_range_us'] + PRE_RANGE_OVERHEAD
+        return used
+
+    def get_timing_budget(self):
+        (en, to) = self.get_sequence()
+        budget_us = self._budget_used(en, to)
+        if en['final_range']:
+            budget_us += to['final_range_us'] + FINAL_RANGE_OVERHEAD
+        return budget_us
+
+    def set_timing_budget(self, budget_us):
+        if budget_us < MIN_TIMING_BUDGET:
+            raise ValueError('budget_us=%s: too short' % budget_us)
+
+        (en, to) = self.get_sequence()
+        used = self._budget_used(en, to)
+        if en['final_range']:
+            used += FINAL_RANGE_OVERHEAD
+            if used > budget_us:
+                raise ValueError('budget_us=%s: too short (%s)' % (
+                    budget_us, used))
+
+            mclks = self.us_to_mclks(budget_us - used, to['final_pclks'])
+            if en['pre_range']:
+                mclks += to['pre_range_mclks']
+            self.write16(FINAL_RANGE_CONFIG_TIMEOUT_MACROP_HI,
+                         self.encode_timeout(mclks))
+
+        self.budget_us = budget_us
+
+    def set_vcsel_period(self, pre_pclks, final_pclks):
+        """
+        VCSEL のパルス周期 [PCLK]
+        変わった場合だけ書き込んで、phase calibration をやり直す
+        """
+        (en, to) = self.get_sequence()
+        if (pre_pclks, final_pclks) == (to['pre_pclks'], to['final_pclks']):
+            return
+
+        self._log.debug('pre_pclks=%s, final_pclks=%s', pre_pclks, final_pclks)
+
+        if pre_pclks != to['pre_pclks']:
+            self.write(PRE_RANGE_CONFIG_VALID_PHASE_LOW,
+                       0x08, self.VCSEL_PRE[pre_pclks])
+
+            mclks = self.us_to_mclks(to['pre_range_us'], pre_pclks)
+            timeout = self.encode_timeout(mclks)
+            self.write(PRE_RANGE_CONFIG_VCSEL_PERIOD, (pre_pclks >> 1) - 1,
+                       (timeout >> 8) & 0xFF, timeout & 0xFF)
+
+            mclks = self.us_to_mclks(to['msrc_dss_tcc_us'], pre_pclks)
+            self.write(MSRC_CONFIG_TIMEOUT_MACROP,
+                       255 if mclks > 256 else mclks - 1)
+
+            (en, to) = self.get_sequence()
+
+        if final_pclks != to['final_pclks']:
+            (phase_high, width, phasecal_timeout,
+             phasecal_lim) = self.VCSEL_FINAL[final_pclks]
+            self.write(FINAL_RANGE_CONFIG_VALID_PHASE_LOW, 0x08, phase_high)
+            self.write(GLOBAL_CONFIG_VCSEL_WIDTH, width)
+            self.write(ALGO_PHASECAL_CONFIG_TIMEOUT, phasecal_timeout)
+            self.write_seq([(0xFF, 0x01), (ALGO_PHASECAL_LIM, phasecal_lim),
+                            (0xFF, 0x00)])
+
+            mclks = self.us_to_mclks(to['final_range_us'], final_pclks)
+            if en['pre_range']:
+                mclks += to['pre_range_mclks']
+            timeout = self.encode_timeout(mclks)
+            self.write(FINAL_RANGE_CONFIG_VCSEL_PERIOD, (final_pclks >> 1) - 1,
+                       (timeout >> 8) & 0xFF, timeout & 0xFF)
+
+        self.set_timing_budget(self.budget_us)
+
+        sc = self.read(SYSTEM_SEQUENCE_CONFIG)[0]
+        self.write(SYSTEM_SEQUENCE_CONFIG, 0x02)
+        self.ref_calibration(0x00)
+        self.write(SYSTEM_SEQUENCE_CONFIG, sc)
+
+    #
+    # VL53L0X.VL53L0X と同じメソッド
+    #
+    def start_ranging(self, mode=VL53L0X_GOOD_ACCURACY_MODE):
+        """
+        連続測定 (back-to-back) を始める
+        最初の呼び出しで初期化する
+        """
+        self._log.debug('mode=%s', mode)
+        self._select()
+        if not self.initialized:
+            self.init()
+
+        (budget_us, limit, pre_pclks, final_pclks) = self.MODE_PARAM[mode]
+        if limit != self.signal_limit:
+            self.set_signal_rate_limit(limit)
+
+        (en, to) = self.get_sequence()
+        if (pre_pclks, final_pclks) != (to['pre_pclks'], to['final_pclks']):
+            # 周期を変える間は、長いほうの budget にしておく
+            self.budget_us = max(self.budget_us, budget_us)
+            self.set_vcsel_period(pre_pclks, final_pclks)
+
+        if budget_us != self.budget_us:
+            self.set_timing_budget(budget_us)
+        self.mode = mode
+
+        self.write_seq([(0x80, 0x01), (0xFF, 0x01), (0x00, 0x00),
+                        (0x91, self.stop_variable),
+                        (0x00, 0x01), (0xFF, 0x00), (0x80, 0x00)])
+        self.write(SYSRANGE_START, 0x02)
+
+    def stop_ranging(self):
+        self._log.debug('')
+        if not self.initialized:
+            return
+
+        self._select()
+        self.write(SYSRANGE_START, 0x01)
+        self.write_seq([(0xFF, 0x01), (0x00, 0x00), (0x91, 0x00),
+                        (0x00, 0x01), (0xFF, 0x00)])
+
+    def get_distance(self):
+        """
+        次の測定値を待って読む [mm]
+        割り込み状態と距離を、同じ転送で読む
+        """
+        self._select()
+        t_end = time.monotonic() + self.IO_TIMEOUT
+        while True:
+            data = self.read(RESULT_INTERRUPT_STATUS, RESULT_LEN)
+            if data[0] & 0x07:
+                return self._result(data)
+            if time.monotonic() > t_end:
+                raise TimeoutError('0x%02x: ranging timeout' % self.address)
+            time.sleep(self.POLL_SLEEP)
+
+    def _result(self, data):
+        self.write(SYSTEM_INTERRUPT_CLEAR, 0x01)
+        self.range_status = (data[1] >> 3) & 0x0F
+        return (data[11] << 8) | data[12]
+
+    def get_timing(self):
+        """
+        測定周期 [us] (VL53L0X.VL53L0X と同じく、budget + 1ms)
+        """
+        return self.budget_us + 1000
+
+    def set_data_ready(self, polarity=VL53L0X_INTERRUPTPOLARITY_LOW):
+        self._select()
+        self.write(SYSTEM_INTERRUPT_CONFIG_GPIO, 0x04)
+
+        mux = self.read(GPIO_HV_MUX_ACTIVE_HIGH)[0] & ~0x10 & 0xFF
+        if polarity != VL53L0X_INTERRUPTPOLARITY_LOW:
+            mux |= 0x10
+        self.write(GPIO_HV_MUX_ACTIVE_HIGH, mux)
+        self.write(SYSTEM_INTERRUPT_CLEAR, 0x01)
+
+    def read_data_ready(self):
+        self._select()
+        return self._result(self.read(RESULT_INTERRUPT_STATUS, RESULT_LEN))
+
+    def dump(self):
+        """
+        ページ0のレジスターマップ (RegMapBus で読み込める)
+
+        Returns
+        -------
+        regs: {page: [v0, .. v255]}
+        """
+        self._select()
+        regs = []
+        for reg in range(0, 0x100, 32):
+            regs += self.bus.read_i2c_block_data(self.address, reg, 32)
+            self.xfer += 1
+        return {0: regs}
+
+
+class RegMapBus:
+    """
+    レジスターマップを持つ偽のI2Cバス (smbus2.SMBus のうち使うメソッドだけ)
+
+    ページ(0xFF)ごとにレジスターを持ち、ドライバーが待つところ
+    (SPAD情報、測定の完了、割り込みのクリア)だけ、センサーの動きを真似る。
+    距離は distance (int、または時刻なしで呼ばれる関数) で与える。
+    """
+    DEF_REGS = {
+        (0, IDENTIFICATION_MODEL_ID): MODEL_ID,
+        (0, 0x50): 0x06,    # pre-range VCSEL 14 PCLK
+        (0, 0x70): 0x04,    # final-range VCSEL 10 PCLK
+        (0, GPIO_HV_MUX_ACTIVE_HIGH): 0x11,
+        (1, 0x91): 0x3C,    # stop variable
+        (7, 0x92): 0x85,    # SPAD: aperture, 5個
+    }
+    for _i in range(6):
+        DEF_REGS[(0, GLOBAL_CONFIG_SPAD_ENABLES_REF_0 + _i)] = 0xFF
+
+    def __init__(self, regs=None, distance=500, debug=False):
+        """
+        Parameters
+        ----------
+        regs: {page: [v0, .. v255]} or str
+            dump() の結果、または それを保存した JSON ファイル
+        distance: int or function
+        """
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('regs=%s, distance=%s', type(regs), distance)
+
+        self.regs = dict(self.DEF_REGS)
+        if isinstance(regs, str):
+            with open(regs) as f:
+                regs = json.load(f)
+        for (page, v_list) in (regs or {}).items():
+            for (reg, v) in enumerate(v_list):
+                self.regs[(int(page), reg)] = v
+
+        self.distance = distance
+        self.page = 0
+        self.continuous = False
+        self.mux = None
+        self.xfer = 0
+
+    def _sample(self):
+        """
+        新しい測定値
+        """
+        d = self.distance() if callable(self.distance) else self.distance
+        self.regs[(0, RESULT_INTERRUPT_STATUS)] = 0x04
+        self.regs[(0, RESULT_RANGE_STATUS)] = 11 << 3
+        self.regs[(0, RESULT_RANGE_STATUS + 10)] = (d >> 8) & 0xFF
+        self.regs[(0, RESULT_RANGE_STATUS + 11)] = d & 0xFF
+
+    def _write1(self, reg, v):
+        if reg == PAGE_SELECT:
+            self.page = v
+            return
+
+        self.regs[(self.page, reg)] = v
+        if self.page == 0 and reg == SYSRANGE_START:
+            self.continuous = bool(v & 0x02)
+            if v & 0x07:
+                self._sample()
+        elif self.page == 0 and reg == SYSTEM_INTERRUPT_CLEAR:
+            self.regs[(0, RESULT_INTERRUPT_STATUS)] = 0x00
+            if self.continuous:
+                self._sample()
+        elif self.page == 7 and reg == 0x83 and v == 0x00:
+            # SPAD情報の準備ができた
+            self.regs[(7, 0x83)] = 0x10
+
+    def _read1(self, reg):
+        return self.regs.get((self.page, reg), 0)
+
+    def write_byte(self, addr, v):
+        self.xfer += 1
+        self.mux = v
+
+    def write_byte_data(self, addr, reg, v):
+        self.xfer += 1
+        self._write1(reg, v)
+
+    def write_i2c_block_data(self, addr, reg, data):
+        self.xfer += 1
+        for (i, v) in enumerate(data):
+            self._write1(reg + i, v)
+
+    def read_byte_data(self, addr, reg):
+        self.xfer += 1
+        return self._read1(reg)
+
+    def read_i2c_block_data(self, addr, reg, n):
+        self.xfer += 1
+        return [self._read1(reg + i) for i in range(n)]
+
+
+class VL53L0XPyApp:
+    def __init__(self, count, mode, fake=None, dump=None, debug=False):
+        self._dbg = debug
+        self._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('count=%s, mode=%s, fake=%s, dump=%s',
+                        count, mode, fake, dump)
+
+        self._count = count
+        self._mode = mode
+        self._dump = dump
+
+        bus = None
+        if fake is not None:
+            bus = RegMapBus(fake or None, debug=self._dbg)
+        self._tof = VL53L0XPy(bus=bus, debug=self._dbg)
+
+    def main(self):
+        self._log.debug('')
+
+        if self._dump is not None:
+            with open(self._dump, 'w') as f:
+                json.dump(self._tof.dump(), f)
+            print('%s: saved' % self._dump)
+            return
+
+        t1 = time.monotonic()
+        self._tof.start_ranging(self._mode)
+        print('start: %.1f ms, %d transfers, timing %d us' % (
+            (time.monotonic() - t1) * 1000, self._tof.xfer,
+            self._tof.get_timing()))
+
+        n = 0
+        xfer1 = self._tof.xfer
+        t1 = time.monotonic()
+        while self._count == 0 or n < self._count:
+            d = self._tof.get_distance()
+            n += 1
+            print('%6d: %4d mm (status %d)' % (n, d, self._tof.range_status))
+
+        sec = time.monotonic() - t1
+        print('%d reads, %.1f Hz, %.1f transfers/read' % (
+            n, n / sec if sec > 0 else 0, (self._tof.xfer - xfer1) / n))
+
+    def end(self):
+        self._log.debug('')
+        self._tof.stop_ranging()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='''
+VL53L0X python driver
+''')
+@click.option('--count', '-c', 'count', type=int, default=10,
+              help='count (0: forever)')
+@click.option('--mode', '-m', 'mode', type=int,
+              default=VL53L0X_BETTER_ACCURACY_MODE,
+              help='ranging mode (0:good 1:better 2:best 3:long 4:fast)')
+@click.option('--fake', '-f', 'fake', type=str, default=None,
+              help='use fake bus with register map JSON (\'\': defaults)')
+@click.option('--dump', 'dump', type=click.Path(), default=None,
+              help='save register map to JSON file')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(count, mode, fake, dump, debug):
+    _log = get_logger(__name__, debug)
+    _log.debug('count=%s, mode=%s, fake=%s, dump=%s',
+               count, mode, fake, dump)
+
+    app = VL53L0XPyApp(count, mode, fake, dump, debug=debug)
+    try:
+        app.main()
+    finally:
+        _log.debug('finally')
+        app.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,7 @@ HTTP_SVR_OPT="-d"
 HTTP_LOG="${LOGDIR}/http.log"
 
 ROBOT_SVR="OttoPiServer.py"
+#ROBOT_SVR="OttoPiAsyncServer.py"  # asyncio version (same protocol)
 ROBOT_SVR_OPT="12345"
 ROBOT_LOG="${LOGDIR}/robot.log"
 ROBOT_CLIENT="OttoPiClient.py"
@@ -7,12 +7,16 @@ LOGDIR=${HOME}/tmp
 PKGS="pigpio vlc python3-pip python3-venv"
 
 CMDS="boot.sh"
-CMDS="${CMDS} MyLogger.py OttoPiAuto.py OttoPiClient.py"
-CMDS="${CMDS} OttoPiConfig.py OttoPiCtrl.py"
+CMDS="${CMDS} MyLogger.py LatencyStat.py OttoPiAuto.py OttoPiClient.py"
+CMDS="${CMDS} OttoPiConfig.py OttoPiCtrl.py OttoPiMap.py OttoPiState.py"
 CMDS="${CMDS} OttoPiHttpServer.py templates static"
 CMDS="${CMDS} OttoPiMotion.py OttoPiServer.py PiServo.py RobotButton.py"
+CMDS="${CMDS} OttoPiAsyncServer.py OttoPiProto.py OttoPiProtoBench.py"
+CMDS="${CMDS} OttoPiLinkBench.py OttoPiLease.py OttoPiAsyncClient.py"
+CMDS="${CMDS} OttoPiFleet.py OttoPiSim.py OttoPiLoadGen.py"
 CMDS="${CMDS} OttoPiWebsockServer.py OttoPiBleServer.py BlePeripheral.py"
-CMDS="${CMDS} VL53L0X.py vl53l0x_python.so"
+CMDS="${CMDS} ToFSampler.py ToFFilter.py ToFTrace.py VL53L0X.py vl53l0x_python.so"
+CMDS="${CMDS} VL53L0XPy.py"
 CMDS="${CMDS} loop.sh speech.sh speech.txt music.sh speakipaddr2.sh"
 # CMDS="${CMDS} activate-do.sh"
 
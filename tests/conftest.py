@@ -0,0 +1,40 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+テストの共通部品
+
+サーバーのテストは、シミュレーション (OttoPiServer --sim) を
+空いているポートで起動して使う (Raspberry Pi がなくても動く)。
+
+    python3 -m pytest tests
+"""
+import socket
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OttoPiLoadGen import SimServer  # noqa: E402
+
+
+def free_port():
+    """
+    いま使われていない TCP のポート番号
+    """
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def sim_server():
+    """
+    OttoPiServer --sim (モジュールごとに 1つ)
+    """
+    svr = SimServer('thread', free_port())
+    svr.start()
+    yield svr
+    svr.stop()
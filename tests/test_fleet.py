@@ -0,0 +1,81 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiFleet: 応答しない・止まっているロボットの打ち切り
+"""
+import asyncio
+import socket
+import time
+
+import pytest
+
+from OttoPiFleet import OttoPiFleet
+from conftest import free_port
+
+
+@pytest.fixture
+def silent():
+    """
+    接続は受け付けるが、何も返さないロボット
+    """
+    with socket.create_server(('', 0)) as sock:
+        yield sock.getsockname()[1]
+
+
+def run_fleet(robots, func, timeout):
+    async def run():
+        fleet = OttoPiFleet(robots, timeout=timeout)
+        try:
+            return (await func(fleet), fleet.get_stat())
+        finally:
+            await fleet.close()
+
+    return asyncio.run(run())
+
+
+def test_fleet_timeout(sim_server, silent):
+    live = 'localhost:%d' % sim_server.port
+    slow = 'localhost:%d' % silent
+    dead = 'localhost:%d' % free_port()
+
+    t0 = time.monotonic()
+    (result, stat) = run_fleet([live, slow, dead],
+                               lambda f: f.broadcast(':.auto_null'), 0.5)
+    sec = time.monotonic() - t0
+
+    assert result[live]['ERR'] is None
+    assert isinstance(result[live]['MSG']['d'], int)
+
+    # 遅いロボットは timeout で打ち切り、他のロボットを待たせない
+    assert result[slow]['ERR'].startswith('timeout')
+    assert 450 <= result[slow]['ms'] < 1000
+    assert result[dead]['ERR'].startswith('ConnectionRefused')
+    assert result[dead]['ms'] < 450
+    assert sec < 1.5
+
+    assert (stat[slow]['timeout'], stat[slow]['error']) == (1, 0)
+    assert (stat[dead]['timeout'], stat[dead]['error']) == (0, 1)
+    assert stat[live]['latency']['n'] == 1
+
+
+def test_fleet_scatter(sim_server, silent):
+    live = 'localhost:%d' % sim_server.port
+    slow = 'localhost:%d' % silent
+
+    (result, stat) = run_fleet([live, slow],
+                               lambda f: f.scatter([':.auto_null', None]), 0.5)
+
+    # None のロボットには送らない (待たない)
+    assert list(result) == [live]
+    assert result[live]['ERR'] is None
+    assert stat[slow]['timeout'] == 0
+
+
+def test_fleet_empty_cmd(sim_server):
+    live = 'localhost:%d' % sim_server.port
+
+    (result, stat) = run_fleet([live], lambda f: f.broadcast(''), 0.5)
+    assert result[live]['ERR'] is None
+    assert not result[live]['ACCEPT']
+    assert result[live]['MSG'] == 'empty command'
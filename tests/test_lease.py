@@ -0,0 +1,115 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiLease: サーバー (--sim) での、リースの受け付けと拒否
+"""
+import time
+
+import pytest
+
+from OttoPiClient import OttoPiClient
+from OttoPiState import OttoPiState, state_name
+
+
+@pytest.fixture
+def clients(sim_server):
+    cl = {}
+
+    def client(name, binary=False):
+        cl[name] = OttoPiClient('localhost', sim_server.port, binary=binary,
+                                name=name, debug=False)
+        return cl[name]
+
+    yield client
+
+    for c in cl.values():
+        c.send_cmd(':auto_off')
+        c.send_cmd(':stop')
+        c.send_cmd(':release')
+        c.close()
+
+
+def test_lease_accept_reject(clients):
+    a = clients('a')
+    b = clients('b')
+
+    assert a.send_cmd(':forward')['ACCEPT']
+
+    ret = b.send_cmd(':forward')
+    assert not ret['ACCEPT']
+    assert ret['MSG'].startswith('lease: held by a')
+
+    # 停止は、リースがなくても受け付ける
+    assert b.send_cmd(':stop')['ACCEPT']
+
+    assert a.send_cmd(':release')['ACCEPT']
+    assert b.send_cmd(':forward')['ACCEPT']
+
+
+def test_lease_binary_client(clients):
+    """
+    binary のクライアントも、名前 (":client") で調停される
+    """
+    b = clients('b')
+    ble = clients('ble', binary=True)
+
+    assert b.send_cmd(':forward')['ACCEPT']
+    assert not ble.send_cmd(':forward')['ACCEPT']
+
+    stat = b.send_cmd(':lease_stat')['MSG']
+    assert stat['holder'] == 'b'
+    assert stat['clients']['ble']['denied'] == 1
+
+
+def wait_auto_on(sim_server, on, sec=2.0):
+    """
+    自動運転の ON/OFF (共有メモリ) が on になるまで待つ
+    (auto command は、OttoPiAuto のスレッドで実行される)
+    """
+    st = OttoPiState(state_name(sim_server.port), create=False)
+    try:
+        t_end = time.monotonic() + sec
+        while st.read()['auto_on'] != on:
+            if time.monotonic() >= t_end:
+                return False
+            time.sleep(0.05)
+        return True
+    finally:
+        st.close()
+
+
+@pytest.mark.parametrize('cmd', [':auto_off', ':auto_disable', ' '])
+def test_lease_auto_off(sim_server, clients, cmd):
+    """
+    holder でなくても、自動運転を止められる (' ' は 1文字コマンドの auto_off)
+    """
+    web = clients('web')
+    button = clients('button')
+
+    assert web.send_cmd(':auto_enable')['ACCEPT']
+    assert web.send_cmd(':auto_on')['ACCEPT']
+    assert wait_auto_on(sim_server, True)
+
+    assert not button.send_cmd(':auto_on')['ACCEPT']
+    assert button.send_cmd(cmd)['ACCEPT']
+    assert wait_auto_on(sim_server, False)
+
+    assert web.send_cmd(':auto_enable')['ACCEPT']
+
+
+def test_lease_estop_clear(clients):
+    """
+    緊急停止は誰でも、解除は holder だけ
+    """
+    web = clients('web')
+    button = clients('button')
+
+    assert web.send_cmd(':forward')['ACCEPT']
+    assert button.send_cmd(':estop')['ACCEPT']
+
+    ret = button.send_cmd(':estop_clear')
+    assert not ret['ACCEPT']
+    assert ret['MSG'].startswith('lease: held by web')
+
+    assert web.send_cmd(':estop_clear')['ACCEPT']
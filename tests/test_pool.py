@@ -0,0 +1,65 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiClientPool: 接続の使い回しと、サーバー再起動後の再接続
+"""
+import time
+
+import pytest
+
+from OttoPiClient import OttoPiClientPool
+from OttoPiLoadGen import SimServer
+from conftest import free_port
+
+
+@pytest.fixture
+def server():
+    # 接続を残したまま止めても、すぐに終了する async のサーバー
+    svr = SimServer('async', free_port())
+    svr.start()
+    yield svr
+    svr.stop()
+
+
+def test_pool_reconnect(server):
+    pool = OttoPiClientPool('localhost', server.port, size=2, timeout=1)
+    try:
+        assert pool.send_cmd(':.auto_null')['ACCEPT']
+        assert pool.send_cmd(':.auto_null')['ACCEPT']
+        stat = pool.get_stat()
+        assert (stat['created'], stat['reused']) == (1, 1)
+
+        # サーバーが止まると、残っていた接続は捨てて、接続失敗
+        server.stop()
+        assert not pool.send_cmd(':.auto_null')['ACCEPT']
+        stat = pool.get_stat()
+        assert (stat['health_fail'], stat['connect_fail']) == (1, 1)
+
+        # backoff の間は、接続しないですぐにエラー
+        ret = pool.send_cmd(':.auto_null')
+        assert not ret['ACCEPT'] and 'backoff' in ret['MSG']
+        assert pool.get_stat()['backoff_reject'] == 1
+
+        # 同じポートで再起動すると、backoff の後に再接続する
+        server.start()
+        t_end = time.monotonic() + OttoPiClientPool.BACKOFF_MAX
+        while not pool.send_cmd(':.auto_null')['ACCEPT']:
+            assert time.monotonic() < t_end
+            time.sleep(OttoPiClientPool.BACKOFF_MIN)
+
+        stat = pool.get_stat()
+        assert stat['created'] == 2
+        assert stat['open'] == 1
+    finally:
+        pool.close()
+
+
+def test_pool_empty_cmd(server):
+    pool = OttoPiClientPool('localhost', server.port)
+    try:
+        ret = pool.send_cmd('', name='http:127.0.0.1')
+        assert ret == {'CMD': '', 'ACCEPT': False, 'MSG': 'empty command'}
+        assert pool.send_cmd(':.auto_null', name='http:127.0.0.1')['ACCEPT']
+    finally:
+        pool.close()
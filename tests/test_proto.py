@@ -0,0 +1,227 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+OttoPiProto: framed (NDJSON) と binary の区切りと、サーバーとの往復
+"""
+import asyncio
+import socket
+
+import pytest
+
+from OttoPiProto import ProtoError, ProtoSession, LineBuffer, READY
+from OttoPiProto import encode_request, decode_request, decode_reply
+from OttoPiProto import BIN_REQ, BIN_NAME_MAX, OPCODE
+from OttoPiProto import encode_bin_request, decode_bin_request
+from OttoPiProto import bin_request_size, encode_bin_reply, decode_bin_reply
+from OttoPiClient import OttoPiClient
+from OttoPiAsyncClient import AsyncOttoPiClient
+from OttoPiAuto import OttoPiAuto
+
+
+class EchoDispatcher:
+    """
+    OttoPiDispatcher の代わり: コマンドとクライアント名を返す
+    """
+    def dispatch(self, data, client=None):
+        return [(data, True, client)]
+
+
+def test_request_roundtrip():
+    line = encode_request(5, ':.happy')
+    assert line.endswith(b'\n')
+    assert decode_request(line.rstrip(b'\n')) == (5, ':.happy')
+
+
+@pytest.mark.parametrize('line', [b'{"id": 1', b'[1, 2]', b'{"id": 1}',
+                                  b'{"v": 99, "id": 1, "cmd": "w"}'])
+def test_bad_request(line):
+    with pytest.raises(ProtoError):
+        decode_request(line)
+
+
+def test_line_buffer_split():
+    lines = LineBuffer()
+    assert lines.feed(b'{"id": 1, "cmd"') == []
+    assert lines.feed(b': "w"}\n{"id": 2,') == [b'{"id": 1, "cmd": "w"}']
+    assert lines.feed(b' "cmd": "s"}\n') == [b'{"id": 2, "cmd": "s"}']
+
+
+def test_line_buffer_too_long():
+    with pytest.raises(ProtoError):
+        LineBuffer(max_line=16).feed(b'x' * 17)
+
+
+def test_session_pipeline():
+    """
+    返信を待たずに送ったリクエストは、id 付きで順番に返る
+    (1回の受信に複数行、行の途中で切れた受信も)
+    """
+    session = ProtoSession(EchoDispatcher(), client='tcp')
+    data = (encode_request(1, ':client a') + encode_request(2, ':.happy') +
+            encode_request(3, ':.home'))
+
+    (out1, done1) = session.feed(data[:30])
+    (out2, done2) = session.feed(data[30:])
+    assert not done1 and not done2
+
+    reps = [decode_reply(line) for line in (out1 + out2).splitlines()]
+    assert [r['id'] for r in reps] == [1, 2, 3]
+    assert reps[1]['CMD'] == ':.happy'
+    assert reps[1]['MSG'] == 'a'
+
+
+def test_session_bad_line_keeps_connection():
+    session = ProtoSession(EchoDispatcher())
+    session.feed(encode_request(1, ':.home'))
+
+    (out, done) = session.feed(b'{"id": 2\n' + encode_request(3, ':.happy'))
+    assert not done
+    reps = [decode_reply(line) for line in out.splitlines()]
+    assert reps[0]['id'] is None and not reps[0]['ACCEPT']
+    assert reps[1]['id'] == 3 and reps[1]['ACCEPT']
+
+
+def recv_replies(sock, n):
+    buf = b''
+    while buf.count(b'\n') < n + 1:  # READY の行を含む
+        data = sock.recv(4096)
+        assert data != b''
+        buf += data
+    lines = buf.splitlines()
+    assert lines[0] == READY.rstrip()
+    return [decode_reply(line) for line in lines[1:]]
+
+
+def test_server_pipeline(sim_server):
+    with socket.create_connection(('localhost', sim_server.port), 5) as sock:
+        sock.sendall(encode_request(10, ':.auto_null') +
+                     encode_request(11, ':lease_stat') +
+                     b'not json\n' +
+                     encode_request(12, ':.auto_null'))
+        reps = recv_replies(sock, 4)
+
+    assert [r['id'] for r in reps] == [10, 11, None, 12]
+    assert isinstance(reps[0]['MSG']['d'], int)
+    assert 'holder' in reps[1]['MSG']
+    assert not reps[2]['ACCEPT']
+    assert reps[3]['ACCEPT']
+
+
+#
+# binary
+#
+
+
+def test_bin_request_roundtrip():
+    rec = encode_bin_request(0x1234, ':.forward 3')
+    assert len(rec) == BIN_REQ.size
+    assert decode_bin_request(rec) == (0x1234, OPCODE['forward'],
+                                       ':.forward 3')
+
+
+def test_bin_client_request():
+    """
+    ":client name" だけは可変長 (名前が後ろに付く)
+    """
+    rec = encode_bin_request(1, ':client ble')
+    assert len(rec) == BIN_REQ.size + len('ble')
+    assert bin_request_size(rec[:-1]) is None
+    assert bin_request_size(rec) == len(rec)
+    assert decode_bin_request(rec) == (1, OPCODE['client'], ':client ble')
+
+    with pytest.raises(ProtoError):
+        encode_bin_request(1, ':client ' + 'x' * (BIN_NAME_MAX + 1))
+
+
+@pytest.mark.parametrize('cmd', [':nosuchcmd', ':forward x',
+                                 ':forward 65536'])
+def test_bin_bad_request(cmd):
+    with pytest.raises(ProtoError):
+        encode_bin_request(1, cmd)
+
+
+@pytest.mark.parametrize('d', [0, 1402, OttoPiAuto.D_STALE])
+def test_bin_reply_distance(d):
+    """
+    距離 (古い場合の D_STALE も) は、固定長の返信で往復する
+    """
+    rep = encode_bin_reply(7, OPCODE['stop'], True, {'d': d})
+    assert decode_bin_reply(rep) == ({'id': 7, 'CMD': 'stop',
+                                      'ACCEPT': True, 'MSG': {'d': d}},
+                                     len(rep))
+
+
+def test_bin_session_split():
+    """
+    レコードの途中で切れた受信も、名前付きのリクエストも区切れる
+    """
+    session = ProtoSession(EchoDispatcher(), client='tcp')
+    data = (encode_bin_request(1, ':client ble') +
+            encode_bin_request(2, ':.happy'))
+
+    out = b''
+    for i in range(len(data)):
+        (o, done) = session.feed(data[i:i + 1])
+        assert not done
+        out += o
+
+    (rep1, size1) = decode_bin_reply(out)
+    (rep2, size2) = decode_bin_reply(out[size1:])
+    assert size1 + size2 == len(out)
+    assert (rep1['id'], rep1['MSG']) == (1, 'ble')
+    assert (rep2['id'], rep2['MSG']) == (2, 'ble')
+
+
+def test_bin_session_bad_magic():
+    session = ProtoSession(EchoDispatcher())
+    session.feed(encode_bin_request(1, ':.home'))
+    (out, done) = session.feed(b'\x00' * BIN_REQ.size)
+    assert done
+    assert not decode_bin_reply(out)[0]['ACCEPT']
+
+
+def test_server_binary(sim_server):
+    cl = OttoPiClient('localhost', sim_server.port, binary=True,
+                      name='bin', debug=False)
+    try:
+        assert isinstance(cl.send_cmd(':.auto_null')['MSG']['d'], int)
+
+        # JSON の MSG (固定長の後ろ)
+        ret = cl.send_cmd(':lease_stat')
+        assert ret['ACCEPT'] and 'holder' in ret['MSG']
+    finally:
+        cl.close()
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_client_empty_cmd(sim_server, binary):
+    """
+    空のコマンドは送らない (最初のコマンドでも ":client" の返信を返さない)
+    """
+    cl = OttoPiClient('localhost', sim_server.port, binary=binary,
+                      name='empty', debug=False)
+    try:
+        assert cl.request('') == []
+        assert cl.send_cmd('') == {'CMD': '', 'ACCEPT': False,
+                                   'MSG': 'empty command'}
+        assert isinstance(cl.send_cmd(':.auto_null')['MSG']['d'], int)
+    finally:
+        cl.close()
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_async_client_empty_cmd(sim_server, binary):
+    async def run():
+        cl = AsyncOttoPiClient('localhost', sim_server.port, binary=binary,
+                               name='empty', debug=False)
+        try:
+            return (await cl.request(''), await cl.send_cmd(''),
+                    await cl.send_cmd(':.auto_null'))
+        finally:
+            await cl.close()
+
+    (replies, ret, ret2) = asyncio.run(run())
+    assert replies == []
+    assert ret == {'CMD': '', 'ACCEPT': False, 'MSG': 'empty command'}
+    assert isinstance(ret2['MSG']['d'], int)
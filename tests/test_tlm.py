@@ -0,0 +1,73 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+テレメトリー (":subscribe"): コマンドを送り続けている間も届く
+"""
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from OttoPiProto import encode_request
+from OttoPiLoadGen import SimServer
+from conftest import free_port
+
+
+@pytest.fixture(scope='module', params=['thread', 'async'])
+def server(request):
+    svr = SimServer(request.param, free_port())
+    svr.start()
+    yield svr
+    svr.stop()
+
+
+def test_tlm_while_busy(server):
+    """
+    受信データが途切れなくても (パイプライン)、購読の周期でフレームが来る
+    """
+    sec = 1.0
+    window = 200  # 返信を待たずに送るリクエスト数
+    sent = []
+    last_id = [0]
+
+    def send_loop(sock):
+        req_id = 1
+        t_end = time.monotonic() + sec
+        while time.monotonic() < t_end:
+            if req_id - last_id[0] > window:
+                time.sleep(0.001)
+                continue
+            sock.sendall(b''.join([encode_request(req_id + i, ':.auto_null')
+                                   for i in range(20)]))
+            req_id += 20
+        sent.append(req_id - 1)
+
+    with socket.create_connection(('localhost', server.port), 5) as sock:
+        sock.sendall(encode_request(0, ':subscribe 100 d'))
+
+        th = threading.Thread(target=send_loop, args=(sock,))
+        th.start()
+
+        frames = []
+        buf = b''
+        t0 = time.monotonic()
+        while len(sent) == 0 or last_id[0] < sent[0]:
+            data = sock.recv(65536)
+            assert data != b''
+            buf += data
+            (*lines, buf) = buf.split(b'\n')
+            for line in lines:
+                if line.startswith(b'#'):  # READY
+                    continue
+                rep = json.loads(line)
+                if 'TLM' in rep:
+                    frames.append(time.monotonic() - t0)
+                elif rep['id'] is not None:
+                    last_id[0] = rep['id']
+        th.join()
+
+    # 送っている間 (sec) に、周期 (100 ms) ごとに届く
+    assert len([t for t in frames if t < sec]) >= 5
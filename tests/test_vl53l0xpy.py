@@ -0,0 +1,95 @@
+#
+# (c) 2020 Yoichi Tanibayashi
+#
+"""
+VL53L0XPy: 偽のI2Cバス (RegMapBus) での測定と、モード切り替え
+"""
+import pytest
+
+from VL53L0X import VL53L0X_GOOD_ACCURACY_MODE, VL53L0X_LONG_RANGE_MODE
+from VL53L0X import VL53L0X_HIGH_SPEED_MODE
+from VL53L0XPy import VL53L0XPy, RegMapBus, CACHE_REG
+
+
+class RecBus(RegMapBus):
+    """
+    読んだレジスター (page, reg) を記録する
+    """
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.read_regs = []
+
+    def read_byte_data(self, addr, reg):
+        self.read_regs.append((self.page, reg))
+        return super().read_byte_data(addr, reg)
+
+    def read_i2c_block_data(self, addr, reg, n):
+        self.read_regs += [(self.page, reg + i) for i in range(n)]
+        return super().read_i2c_block_data(addr, reg, n)
+
+
+@pytest.fixture
+def tof():
+    dist = [500]
+    bus = RecBus(distance=lambda: dist[0])
+    tof = VL53L0XPy(bus=bus)
+    tof.dist = dist
+    tof.start_ranging(VL53L0X_GOOD_ACCURACY_MODE)
+    yield tof
+    tof.stop_ranging()
+
+
+def xfer_per_read(tof, read, n=10):
+    """
+    距離が変わると、次の測定値から変わる
+    (RegMapBus は、割り込みのクリアで次の値を測る)
+    """
+    xfer1 = tof.xfer
+    prev = tof.dist[0]
+    for i in range(n):
+        tof.dist[0] = 100 + i
+        assert read() == prev
+        prev = tof.dist[0]
+    return (tof.xfer - xfer1) / n
+
+
+def test_start_ranging(tof):
+    assert tof.initialized
+    assert tof.get_timing() == 33000 + 1000
+    assert tof.xfer == tof.bus.xfer
+
+
+def test_get_distance(tof):
+    # 割り込み状態と距離を 1回で読み、割り込みのクリアを 1回書く
+    assert xfer_per_read(tof, tof.get_distance) == 2
+    assert tof.range_status == 11
+
+
+def test_read_data_ready(tof):
+    tof.set_data_ready()
+    assert tof.bus.regs[(0, 0x0A)] == 0x04  # 新しい測定値で割り込み
+    assert xfer_per_read(tof, tof.read_data_ready) == 2
+
+
+@pytest.mark.parametrize('mode, timing', [
+    (VL53L0X_HIGH_SPEED_MODE, 20000 + 1000),  # budget だけ
+    (VL53L0X_LONG_RANGE_MODE, 33000 + 1000),  # VCSEL周期も
+])
+def test_mode_switch(tof, mode, timing):
+    """
+    モード切り替えでは、キャッシュしたレジスターを読み直さない
+    """
+    tof.bus.read_regs = []
+    tof.start_ranging(mode)
+
+    assert tof.get_timing() == timing
+    reread = [reg for (page, reg) in tof.bus.read_regs
+              if page == 0 and reg in CACHE_REG]
+    assert reread == []
+
+    # 設定はセンサーに書かれている
+    (_, _, pre_pclks, final_pclks) = VL53L0XPy.MODE_PARAM[mode]
+    assert tof.bus.regs[(0, 0x50)] == (pre_pclks >> 1) - 1
+    assert tof.bus.regs[(0, 0x70)] == (final_pclks >> 1) - 1
+
+    assert xfer_per_read(tof, tof.get_distance) == 2